@@ -0,0 +1,62 @@
+# coding: utf-8
+""" Micro-benchmark of room fanout: messages/sec versus room size.
+
+    Compares per waiter `write_message` (encode and frame for every
+    connection) with writing one PreparedMessage frame to all waiters.
+    Streams are fake, so only the CPU cost of fanout is measured.
+
+    Usage: python benchmarks/bench_broadcast.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tornado.websocket import WebSocketProtocol13
+
+from wschat.broadcast import PreparedMessage
+
+
+class FakeStream(object):
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+    def closed(self):
+        return False
+
+
+class FakeHandler(object):
+    request = None
+
+    def __init__(self):
+        self.stream = FakeStream()
+        self.ws_connection = WebSocketProtocol13(self)
+
+
+def fanout_write_message(waiters, text):
+    for waiter in waiters:
+        waiter.ws_connection.write_message(text)
+
+
+def fanout_prepared(waiters, text):
+    mess = PreparedMessage(text)
+    for waiter in waiters:
+        waiter.ws_connection.stream.write(mess.frame)
+
+
+def main(sizes=(10, 100, 1000, 5000), messages=200):
+    text = u'MESSAGE:[Free Chat] Bender: Bite my shiny metal ass! ' * 3
+    print('%10s %18s %18s %8s' % ('waiters', 'write_message/s', 'prepared/s', 'speedup'))
+    for size in sizes:
+        waiters = [FakeHandler() for _ in range(size)]
+        old = timeit.timeit(lambda: fanout_write_message(waiters, text), number=messages)
+        new = timeit.timeit(lambda: fanout_prepared(waiters, text), number=messages)
+        print('%10d %18.1f %18.1f %7.1fx' % (size, messages / old, messages / new, old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+# coding: utf-8
+""" "#change nick * nick" cost on REDIS for user joined to many rooms.
+
+    Compares the old layout, where rooms and nicks of user are json
+    list in field of user hash (every change is HGET, json parsing,
+    list scan, json dumping and HSET), with hash of nicks (one atomic
+    command per change). Reports changes/sec and REDIS round trips
+    per "#change nick *" command.
+    Needs running REDIS at localhost:6379 (keys of benchmark user are
+    removed after run), or fakeredis with Lua support ("lupa").
+
+    Usage: python benchmarks/bench_change_nick.py [rooms] [changes]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import redis
+
+from wschat.db import DBRedis
+
+
+LOGIN = 'bench_change_nick'
+
+
+class JSONRooms(object):
+    """ Rooms of user as it was stored before hash of nicks """
+    def __init__(self, r, pre):
+        self.r = r
+        self.key = '%sUSER:%s' % (pre, LOGIN)
+
+    def join(self, rooms):
+        self.r.hset(self.key, 'current_rooms', json.dumps([(room, LOGIN) for room in rooms]))
+
+    def change_nick_in_room(self, login, room, nick):
+        rooms = json.loads(self.r.hget(self.key, 'current_rooms'))
+        for _room in rooms[:]:
+            if room == _room[0]:
+                rooms[rooms.index(_room)] = (room, nick,)
+        self.r.hset(self.key, 'current_rooms', json.dumps(rooms))
+
+
+class HashRooms(object):
+    """ Rooms of user in hash of nicks (DBRedis) """
+    def __init__(self, db):
+        self.db = db
+
+    def join(self, rooms):
+        for room in rooms:
+            self.db.add_room_to_current(LOGIN, room)
+
+    def change_nick_in_room(self, login, room, nick):
+        self.db.change_nick_in_room(login, room, nick)
+
+
+def count_round_trips(r):
+    """ Count commands and pipelines sent by client
+    :return: list, which first item is number of round trips
+    """
+    counter = [0]
+    execute_command = r.execute_command
+    pipeline = r.pipeline
+
+    def counted_command(*args, **kwargs):
+        counter[0] += 1
+        return execute_command(*args, **kwargs)
+
+    def counted_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def counted_execute(*a, **kw):
+            counter[0] += 1
+            return execute(*a, **kw)
+        pipe.execute = counted_execute
+        return pipe
+
+    r.execute_command = counted_command
+    r.pipeline = counted_pipeline
+    return counter
+
+
+def bench(layout, counter, rooms, changes):
+    layout.join(rooms)
+    counter[0] = 0
+    start = time.time()
+    for n in range(changes):
+        # "#change nick *" changes nick in every room
+        for room in rooms:
+            layout.change_nick_in_room(LOGIN, room, 'nick%d' % n)
+    spent = time.time() - start
+    return changes * len(rooms) / spent, counter[0] / float(changes)
+
+
+def main(rooms=100, changes=20):
+    r = redis.Redis(decode_responses=True)
+    try:
+        r.ping()
+    except redis.exceptions.ConnectionError:
+        import fakeredis
+        print('REDIS is not available, fakeredis is used (no network round trips)')
+        r = fakeredis.FakeRedis(decode_responses=True)
+    db = DBRedis(r)
+    counter = count_round_trips(r)
+    names = ['Bench room %d' % n for n in range(rooms)]
+    print('user in %d rooms, %d "#change nick *" commands' % (rooms, changes))
+    print('%12s %14s %22s' % ('layout', 'changes/s', 'round trips/command'))
+    try:
+        for name, layout in (('json', JSONRooms(r, db._pre)), ('hash', HashRooms(db))):
+            per_second, round_trips = bench(layout, counter, names, changes)
+            print('%12s %14.1f %22.1f' % (name, per_second, round_trips))
+    finally:
+        r.delete('%sUSER:%s' % (db._pre, LOGIN), '%sNICKS:%s' % (db._pre, LOGIN))
+
+
+if __name__ == '__main__':
+    args = [int(x) for x in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,60 @@
+# coding: utf-8
+""" Memory footprint of room history under sustained traffic.
+
+    Writes messages into one room of DBPython and prints number of
+    stored messages and process RSS every `step` messages. With bounded
+    history both must stay flat after first history_size messages.
+    If REDIS is reachable, the same is done for DBRedis (size of
+    history sorted set).
+
+    Usage: python benchmarks/bench_history_memory.py [messages] [history_size]
+"""
+import os
+import sys
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from wschat.db import DBPython, DBRedis, redis
+
+
+def rss_kb():
+    """ Current resident set size of process in KB """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * resource.getpagesize() // 1024
+    except IOError:
+        # Not linux, peak RSS only
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run(db, room, messages, step, size_of):
+    print('%12s %12s %12s' % ('messages', 'stored', 'rss, KB'))
+    text = u'Bender: Bite my shiny metal ass! ' * 4
+    for n in range(1, messages + 1):
+        db.new_message(room, text)
+        if not n % step:
+            print('%12d %12d %12d' % (n, size_of(), rss_kb()))
+
+
+def main(messages=1000000, history_size=1000):
+    step = messages // 10
+    print('DBPython, history_size=%d' % history_size)
+    db = DBPython(history_size=history_size)
+    room = db.default_room
+    run(db, room, messages, step, lambda: len(db._rooms[room]))
+
+    if redis is None:
+        return
+    try:
+        db = DBRedis(history_size=history_size)
+    except redis.exceptions.ConnectionError:
+        return
+    key = db._history_key(room)
+    print('DBRedis, history_size=%d' % history_size)
+    run(db, room, messages // 10, step // 10, lambda: db.r.zcard(key))
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:3]])
@@ -0,0 +1,124 @@
+# coding: utf-8
+""" Reconnect storm benchmark: history replay over WebSocket.
+
+    Starts chat server (in memory DataBase) in this process. Logged in
+    user is joined to `rooms` rooms with `depth` messages of history.
+    `clients` WebSocket clients of the user reconnect, `concurrency`
+    at a time, and read frames until they are connected to every room.
+    Compares reconnect without last_seen (HISTORY frame of every room)
+    with resume by last_seen when nothing was missed (no history).
+    Reports reconnects/sec, time of reconnect (p50, p99), frames and
+    bytes received per client. Client and server share one process
+    and IOLoop, so absolute numbers are lower than of separate server.
+
+    Usage: python benchmarks/bench_history_replay.py [clients] [rooms] [depth] [concurrency]
+"""
+import json
+import os
+import sys
+import time
+import urllib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tornado import gen
+from tornado.httpclient import HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.web import create_signed_value
+from tornado.websocket import websocket_connect
+
+from wschat.db import AsyncDBPython
+from wschat.server import make_app
+
+
+LOGIN = 'bender'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+@gen.coroutine
+def fill(db, rooms, depth):
+    """ Rooms of user with history
+    :return: dict room -> id of last message
+    """
+    db.db.new_user(LOGIN, 'hash')
+    last_seen = dict()
+    for r in range(rooms):
+        room = 'Room %d' % r
+        yield db.new_room(room)
+        yield db.add_room_to_current(LOGIN, room)
+        for i in range(depth):
+            message = yield db.new_message(room, u'%s: message number %d' % (LOGIN, i))
+        last_seen[room] = message.id
+    raise gen.Return(last_seen)
+
+
+@gen.coroutine
+def reconnect(url, cookie, rooms):
+    """ Connect and read frames until client is connected to all rooms
+    :return: (seconds, frames, bytes)
+    """
+    start = time.time()
+    conn = yield websocket_connect(HTTPRequest(url, headers={'Cookie': cookie}))
+    frames = size = connected = 0
+    while connected < rooms:
+        frame = yield conn.read_message()
+        if frame is None:
+            raise RuntimeError('Connection closed by server')
+        frames += 1
+        size += len(frame.encode('utf-8'))
+        if frame.startswith('SERVER:You are connected to room'):
+            connected += 1
+    spent = time.time() - start
+    conn.close()
+    raise gen.Return((spent, frames, size))
+
+
+@gen.coroutine
+def storm(url, cookie, rooms, clients, concurrency):
+    results = []
+
+    @gen.coroutine
+    def worker(count):
+        for _ in range(count):
+            result = yield reconnect(url, cookie, rooms)
+            results.append(result)
+
+    start = time.time()
+    yield [worker(clients // concurrency) for _ in range(concurrency)]
+    raise gen.Return((time.time() - start, results))
+
+
+@gen.coroutine
+def main(clients=2000, rooms=5, depth=10, concurrency=50):
+    db = AsyncDBPython()
+    last_seen = yield fill(db, rooms, depth)
+    app = make_app(db, compression=None)
+    sockets = bind_sockets(0, '127.0.0.1')
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
+    url = 'ws://127.0.0.1:%d/chat' % sockets[0].getsockname()[1]
+    cookie = 'user=%s' % create_signed_value(app.settings['cookie_secret'], 'user', LOGIN)
+    clients -= clients % concurrency
+    print('%d clients (%d at a time), %d rooms, %d messages of history' % (
+        clients, concurrency, rooms, depth))
+    print('%12s %14s %10s %10s %16s %16s' % ('reconnect', 'reconnects/s', 'p50, ms',
+                                             'p99, ms', 'frames/client', 'bytes/client'))
+    resume_url = url + '?last_seen=' + urllib.quote(json.dumps(last_seen))
+    for name, _url in (('history', url), ('last_seen', resume_url)):
+        spent, results = yield storm(_url, cookie, rooms, clients, concurrency)
+        times = [x[0] for x in results]
+        print('%12s %14.1f %10.2f %10.2f %16d %16d' % (
+            name, clients / spent, percentile(times, 50) * 1000, percentile(times, 99) * 1000,
+            sum(x[1] for x in results) // clients, sum(x[2] for x in results) // clients))
+    server.stop()
+
+
+if __name__ == '__main__':
+    args = [int(x) for x in sys.argv[1:5]]
+    IOLoop.current().run_sync(lambda: main(*args))
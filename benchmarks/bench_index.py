@@ -0,0 +1,86 @@
+# coding: utf-8
+""" Index page requests/sec and DataBase calls per request.
+
+    Server with given number of rooms (in memory DataBase) serves
+    concurrent GET / requests of one client: with list of rooms
+    rendered on every request (index_cache_ttl=0, as before cache),
+    with cached list, and with cached list when client revalidates
+    page by Etag (304 responses without body).
+
+    Usage: python benchmarks/bench_index.py [rooms] [requests]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+
+from wschat.db import AsyncDBPython
+from wschat.server import make_app
+
+
+CONCURRENCY = 10
+
+
+@gen.coroutine
+def bench(rooms, requests, ttl, revalidate):
+    db = AsyncDBPython()
+    for n in range(rooms):
+        yield db.new_room('Bench room %d' % n)
+    calls = [0]
+    get_all_rooms = db.get_all_rooms
+
+    def counted_get_all_rooms():
+        calls[0] += 1
+        return get_all_rooms()
+    db.get_all_rooms = counted_get_all_rooms
+    sockets = bind_sockets(0, '127.0.0.1')
+    url = 'http://127.0.0.1:%d/' % sockets[0].getsockname()[1]
+    server = HTTPServer(make_app(db, index_cache_ttl=ttl))
+    server.add_sockets(sockets)
+    client = AsyncHTTPClient(max_clients=CONCURRENCY)
+    response = yield client.fetch(url)
+    headers = dict(Cookie=response.headers['Set-Cookie'].split(';')[0])
+    if revalidate:
+        response = yield client.fetch(url, headers=headers)
+        headers['If-None-Match'] = response.headers['Etag']
+    calls[0] = 0
+
+    @gen.coroutine
+    def worker(count):
+        for _ in range(count):
+            try:
+                yield client.fetch(url, headers=headers)
+            except HTTPError as e:
+                if e.code != 304:
+                    raise
+    start = time.time()
+    yield [worker(requests // CONCURRENCY) for _ in range(CONCURRENCY)]
+    spent = time.time() - start
+    server.stop()
+    raise gen.Return((requests / spent, calls[0] / float(requests)))
+
+
+@gen.coroutine
+def run(rooms, requests):
+    print('%d rooms, %d requests, %d concurrent' % (rooms, requests, CONCURRENCY))
+    print('%20s %14s %18s' % ('', 'requests/s', 'DB calls/request'))
+    for name, ttl, revalidate in (('no cache', 0, False), ('cached rooms', 60, False),
+                                  ('cached, 304', 60, True)):
+        per_second, calls = yield bench(rooms, requests, ttl, revalidate)
+        print('%20s %14.1f %18.2f' % (name, per_second, calls))
+
+
+def main(rooms=200, requests=2000):
+    IOLoop.current().run_sync(lambda: run(rooms, requests))
+
+
+if __name__ == '__main__':
+    args = [int(x) for x in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,66 @@
+# coding: utf-8
+""" IOLoop latency during login storm.
+
+    Starts `logins` concurrent password checks (db.AsyncDB.is_correct_user)
+    and measures how late a timer, which should fire every `interval`
+    ms, is woken by IOLoop meanwhile. Compares hashing on IOLoop
+    (workers=0) with hashing in pool of threads (passwords.PasswordHasher).
+
+    Usage: python benchmarks/bench_login_latency.py [logins] [workers] [interval]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from wschat.db import AsyncDBPython
+from wschat.passwords import PasswordHasher
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+@gen.coroutine
+def storm(db, logins, interval):
+    lags = []
+    done = []
+
+    @gen.coroutine
+    def probe():
+        while not done:
+            start = time.time()
+            yield gen.sleep(interval)
+            lags.append(time.time() - start - interval)
+
+    probing = probe()
+    start = time.time()
+    results = yield [db.is_correct_user('bender', 'shiny metal') for _ in range(logins)]
+    spent = time.time() - start
+    done.append(True)
+    yield probing
+    assert all(results)
+    raise gen.Return((spent, lags))
+
+
+@gen.coroutine
+def main(logins=500, workers=4, interval=10):
+    print('%d concurrent logins, timer every %d ms' % (logins, interval))
+    print('%10s %12s %12s %14s %14s' % ('workers', 'logins/s', 'total, s', 'p99 lag, ms', 'max lag, ms'))
+    for n in (0, workers):
+        db = AsyncDBPython(hasher=PasswordHasher(n))
+        yield db.new_user('bender', 'shiny metal')
+        spent, lags = yield storm(db, logins, interval / 1000.0)
+        lags = lags or [0]
+        print('%10d %12.1f %12.2f %14.1f %14.1f' % (n, logins / spent, spent,
+                                                    percentile(lags, 99) * 1000, max(lags) * 1000))
+
+
+if __name__ == '__main__':
+    args = [int(x) for x in sys.argv[1:4]]
+    IOLoop.current().run_sync(lambda: main(*args))
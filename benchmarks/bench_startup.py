@@ -0,0 +1,67 @@
+# coding: utf-8
+""" Import and startup time of server.
+
+    Every measurement runs in a fresh python process: import of
+    wschat.server (with connections forbidden, so import fails if it
+    goes to network) and creation of application with DataBase of
+    given backend (see server.create_backends). Reports the best and
+    median of runs.
+
+    Usage: python benchmarks/bench_startup.py [runs] [backend]
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+IMPORT = """
+import socket, sys, time
+def connect(*args):
+    raise AssertionError('connection on import')
+socket.socket.connect = connect
+sys.path.insert(0, %r)
+start = time.time()
+import wschat.server
+print(time.time() - start)
+""" % ROOT
+
+STARTUP = """
+import shutil, sys, tempfile, time
+sys.path.insert(0, %r)
+start = time.time()
+from wschat import server
+backend = %r
+data_dir = tempfile.mkdtemp() if backend == 'disk' else None
+db, bus = server.create_backends(backend, data_dir=data_dir)
+server.make_app(db, bus)
+print(time.time() - start)
+if data_dir is not None:
+    db.close()
+    shutil.rmtree(data_dir)
+"""
+
+
+def measure(code, runs):
+    times = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', code], stderr=subprocess.STDOUT)
+        times.append(float(output.split()[-1]))
+    times.sort()
+    return times[0], times[len(times) // 2]
+
+
+def main(runs=10, backend='memory'):
+    print('%d runs, seconds' % runs)
+    print('%28s %10s %10s' % ('', 'best', 'median'))
+    best, median = measure(IMPORT, runs)
+    print('%28s %10.3f %10.3f' % ('import wschat.server', best, median))
+    best, median = measure(STARTUP % (ROOT, backend), runs)
+    print('%28s %10.3f %10.3f' % ('startup (%s backend)' % backend, best, median))
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:3]
+    if args:
+        args[0] = int(args[0])
+    main(*args)
@@ -0,0 +1,286 @@
+# coding: utf-8
+""" Load generator for running server.
+
+    Opens N WebSocket clients, every client registers and logs in as
+    own user and joins one of M rooms, then clients send messages and
+    join/left rooms and change nicks in given proportion for given time.
+    Every message carries time of sending, so delivery latency is
+    measured by clients which receive it. Reports sent commands,
+    delivered messages per second, p50/p99 delivery latency and RSS of
+    server process (if its pid is given, linux only).
+
+    With --spawn-server local server (python -m wschat, in memory
+    DataBase by default) is started on free port, load is run as soon
+    as it accepts connections, and server is stopped by SIGTERM after
+    the run, so RSS of the server is reported too.
+
+    NOTE: registration and login hash passwords on purpose slowly,
+      so start of many clients takes a while.
+
+    Usage: python benchmarks/loadgen.py [--url ws://localhost:8080/chat]
+        [--clients 100] [--rooms "Free Chat,Python Developers"]
+        [--duration 30] [--rate 1] [--mix message=90,join=3,left=3,nick=4]
+        [--pid SERVER_PID] [--spawn-server [--server-args "--backend memory"]]
+"""
+import argparse
+import os
+import random
+import re
+import shlex
+import socket
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
+from tornado.locks import Condition
+from tornado.tcpclient import TCPClient
+from tornado.websocket import websocket_connect
+
+from wschat.db import DB
+
+
+message_re = re.compile(r'^MESSAGE:\d+:\[[^\]]*\] [^:]*: lg (\d+\.\d+)')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def rss_kb(pid):
+    """ Resident set size of process in KB or None """
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except (IOError, TypeError):
+        return None
+
+
+def free_port():
+    """ Port which is not used now on localhost """
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+class SpawnedServer(object):
+    """ Chat server in child process, started for one load run """
+    def __init__(self, server_args, start_timeout=30, stop_timeout=10):
+        """ :param server_args: list of options of python -m wschat
+            :param start_timeout: seconds to wait until server accepts connections
+            :param stop_timeout: seconds to wait for shutdown before kill
+        """
+        self.port = free_port()
+        self.args = ['--host', '127.0.0.1', '--port', str(self.port)] + list(server_args)
+        self.start_timeout = start_timeout
+        self.stop_timeout = stop_timeout
+        self.process = None
+
+    @property
+    def url(self):
+        return 'ws://127.0.0.1:%d/chat' % self.port
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    @gen.coroutine
+    def start(self):
+        """ Start server and wait until it accepts connections """
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        self.process = subprocess.Popen([sys.executable, '-m', 'wschat'] + self.args, cwd=root)
+        deadline = time.time() + self.start_timeout
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError('Server exited with code %d' % self.process.returncode)
+            try:
+                stream = yield TCPClient().connect('127.0.0.1', self.port)
+            except (IOError, StreamClosedError):
+                if time.time() > deadline:
+                    raise RuntimeError('Server is not started in %d s' % self.start_timeout)
+                yield gen.sleep(0.1)
+            else:
+                stream.close()
+                return
+
+    @gen.coroutine
+    def stop(self):
+        """ Stop server by SIGTERM (graceful shutdown), kill it
+            if it is not stopped in stop_timeout seconds
+        """
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        deadline = time.time() + self.stop_timeout
+        while self.process.poll() is None:
+            if time.time() > deadline:
+                self.process.kill()
+                self.process.wait()
+                break
+            yield gen.sleep(0.1)
+
+
+class Stats(object):
+    def __init__(self):
+        self.sent = dict()
+        self.delivered = 0
+        self.latencies = []
+
+
+class Client(object):
+    def __init__(self, n, url, rooms, stats, prefix):
+        self.n = n
+        self.url = url
+        self.rooms = rooms
+        self.stats = stats
+        self.login = '%s%d' % (prefix, n)
+        self.room = rooms[n % len(rooms)]
+        self.joined = set()
+        self.conn = None
+        self.answered = Condition()
+
+    @gen.coroutine
+    def connect(self):
+        self.conn = yield websocket_connect(self.url)
+        self.read()
+        # Server greets anonymous connection in default room
+        yield self.answered.wait()
+        for command in ('#register %s pw' % self.login, '#login %s pw' % self.login):
+            self.conn.write_message(command)
+            # Wait for answer, so login goes after registration
+            yield self.answered.wait()
+        self.join(self.room)
+
+    @gen.coroutine
+    def read(self):
+        while True:
+            mess = yield self.conn.read_message()
+            if mess is None:
+                return
+            if mess.startswith('SERVER:'):
+                self.answered.notify_all()
+                continue
+            match = message_re.match(mess)
+            if match is not None:
+                self.stats.delivered += 1
+                self.stats.latencies.append(time.time() - float(match.group(1)))
+
+    def send(self, kind, command):
+        self.stats.sent[kind] = self.stats.sent.get(kind, 0) + 1
+        self.conn.write_message(command)
+
+    def join(self, room):
+        self.joined.add(room)
+        self.send('join', '#join room %s' % room)
+
+    def act(self, kind):
+        if kind == 'message':
+            self.send(kind, 'lg %.6f from %s' % (time.time(), self.login))
+        elif kind == 'join':
+            self.join(random.choice(self.rooms))
+        elif kind == 'left':
+            # Keep own room, so client always receives messages
+            rooms = list(self.joined - set([self.room]))
+            if rooms:
+                room = random.choice(rooms)
+                self.joined.discard(room)
+                self.send(kind, '#left room %s' % room)
+        elif kind == 'nick':
+            self.send(kind, '#change nick "%s" %s_%d' % (self.room, self.login, random.randint(0, 99)))
+
+    @gen.coroutine
+    def run(self, until, rate, mix):
+        total = sum(weight for kind, weight in mix)
+        while time.time() < until:
+            yield gen.sleep(random.expovariate(rate))
+            point = random.uniform(0, total)
+            for kind, weight in mix:
+                point -= weight
+                if point <= 0:
+                    break
+            self.act(kind)
+
+
+def parse_mix(value):
+    mix = []
+    for item in value.split(','):
+        kind, weight = item.split('=')
+        mix.append((kind.strip(), float(weight)))
+    return mix
+
+
+@gen.coroutine
+def main(args):
+    if not args.spawn_server:
+        yield run_load(args)
+        return
+    server = SpawnedServer(shlex.split(args.server_args))
+    try:
+        yield server.start()
+        print('server started, pid %d, %s' % (server.pid, server.url))
+        args.url, args.pid = server.url, server.pid
+        yield run_load(args)
+    finally:
+        yield server.stop()
+
+
+@gen.coroutine
+def run_load(args):
+    stats = Stats()
+    prefix = 'load%d_' % int(time.time())
+    clients = [Client(n, args.url, args.rooms, stats, prefix) for n in range(args.clients)]
+    start = time.time()
+    for n in range(0, len(clients), 50):
+        yield [client.connect() for client in clients[n:n + 50]]
+    print('%d clients connected in %.1f s, server RSS: %s KB' % (
+        len(clients), time.time() - start, rss_kb(args.pid)))
+    start = time.time()
+    yield [client.run(start + args.duration, args.rate, args.mix) for client in clients]
+    # Wait for messages in flight
+    yield gen.sleep(1)
+    spent = time.time() - start
+    for client in clients:
+        client.conn.close()
+    print('%12s %12s' % ('command', 'sent'))
+    for kind, count in sorted(stats.sent.items()):
+        print('%12s %12d' % (kind, count))
+    print('delivered messages: %d (%.1f/s)' % (stats.delivered, stats.delivered / spent))
+    print('sent messages: %.1f/s' % (stats.sent.get('message', 0) / spent))
+    print('delivery latency: p50 %.1f ms, p99 %.1f ms, max %.1f ms' % (
+        percentile(stats.latencies, 50) * 1000, percentile(stats.latencies, 99) * 1000,
+        max(stats.latencies or [0]) * 1000))
+    print('server RSS: %s KB' % rss_kb(args.pid))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Load generator of chat server')
+    parser.add_argument('--url', default='ws://localhost:8080/chat')
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--rooms', default=','.join(DB._default_rooms),
+                        type=lambda x: [r.strip() for r in x.split(',') if r.strip()])
+    parser.add_argument('--duration', type=float, default=30, help='seconds')
+    parser.add_argument('--rate', type=float, default=1, help='commands per second of client')
+    parser.add_argument('--mix', type=parse_mix, default='message=90,join=3,left=3,nick=4')
+    parser.add_argument('--pid', type=int, help='pid of server process to report RSS')
+    parser.add_argument('--spawn-server', action='store_true',
+                        help='start local server for the run, --url and --pid are ignored')
+    parser.add_argument('--server-args', default='--backend memory',
+                        help='options of spawned server (python -m wschat)')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    IOLoop.current().run_sync(lambda: main(args))
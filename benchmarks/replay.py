@@ -0,0 +1,126 @@
+# coding: utf-8
+""" Replay of captured traffic (see wschat/capture.py) against server.
+
+    Connections are opened, messages sent and connections closed at
+    the captured times, divided by speed. Users which were logged in
+    by cookie or by "#login"/"#register" commands are registered first
+    with capture.PASSWORD (passwords of commands are replaced with it
+    on capture), cookies are signed with cookie secret of target server. Reports
+    replayed events, received frames and the worst lag behind
+    captured schedule.
+
+    Usage: python benchmarks/replay.py CAPTURE_FILE [--url ws://localhost:8080/chat]
+        [--speed 1] [--cookie-secret SECRET]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tornado import gen
+from tornado.httpclient import HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.web import create_signed_value
+from tornado.websocket import websocket_connect
+
+from wschat.capture import read_capture, captured_users, OPEN, MESSAGE, CLOSE, PASSWORD
+
+
+class Replay(object):
+    def __init__(self, url, cookie_secret):
+        self.url = url
+        self.cookie_secret = cookie_secret
+        # connection id -> Future of connection
+        self.conns = dict()
+        self.received = 0
+        self.events = 0
+
+    @gen.coroutine
+    def register(self, users):
+        """ Register users of capture (existing ones are kept) """
+        conn = yield websocket_connect(self.url)
+        # Greeting of anonymous connection
+        yield conn.read_message()
+        for user in users:
+            conn.write_message('#register %s %s' % (user, PASSWORD))
+            yield conn.read_message()
+        conn.close()
+
+    def open(self, cid, user):
+        request = self.url
+        if user is not None:
+            cookie = create_signed_value(self.cookie_secret, 'user', user)
+            request = HTTPRequest(self.url, headers={'Cookie': 'user=%s' % cookie})
+        future = self.conns[cid] = websocket_connect(request)
+        IOLoop.current().add_future(future, self.drain)
+
+    @gen.coroutine
+    def drain(self, future):
+        conn = future.result()
+        while (yield conn.read_message()) is not None:
+            self.received += 1
+
+    def send(self, cid, mess):
+        # Callbacks of Future are called in order of adding
+        IOLoop.current().add_future(self.conns[cid], lambda f: f.result().write_message(mess))
+
+    def close(self, cid):
+        IOLoop.current().add_future(self.conns.pop(cid), lambda f: f.result().close())
+
+    @gen.coroutine
+    def run(self, path, speed):
+        events = list(read_capture(path))
+        users = captured_users(events)
+        if users:
+            yield self.register(sorted(users))
+        if not events:
+            raise gen.Return(0)
+        first = events[0][0]
+        start = time.time()
+        worst = 0
+        for timestamp, cid, event, payload in events:
+            delay = start + (timestamp - first) / speed - time.time()
+            if delay > 0:
+                yield gen.sleep(delay)
+            worst = max(worst, -delay)
+            if event == OPEN:
+                self.open(cid, json.loads(payload)['user'])
+            elif cid not in self.conns:
+                # Connection was opened before capture started
+                continue
+            elif event == MESSAGE:
+                self.send(cid, payload)
+            elif event == CLOSE:
+                self.close(cid)
+            self.events += 1
+        raise gen.Return(worst)
+
+
+@gen.coroutine
+def main(args):
+    replay = Replay(args.url, args.cookie_secret)
+    start = time.time()
+    worst = yield replay.run(args.capture, args.speed)
+    # Wait for answers in flight
+    yield gen.sleep(1)
+    print('%d events replayed in %.1f s (speed %.1fx)' % (replay.events, time.time() - start,
+                                                         args.speed))
+    print('%d frames received, worst lag behind schedule %.1f ms' % (replay.received,
+                                                                   worst * 1000))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Replay of captured traffic')
+    parser.add_argument('capture')
+    parser.add_argument('--url', default='ws://localhost:8080/chat')
+    parser.add_argument('--speed', type=float, default=1, help='1 - captured speed')
+    parser.add_argument('--cookie-secret', default='%RamblerTask-WebSocketChat%')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args(sys.argv[1:])
+    IOLoop.current().run_sync(lambda: main(args))
@@ -0,0 +1,92 @@
+# coding: utf-8
+import json
+import urllib
+
+from tornado import gen
+from tornado.httpclient import HTTPRequest
+from tornado.testing import AsyncHTTPTestCase
+from tornado.websocket import websocket_connect
+
+from wschat.bus import LocalBus
+from wschat.db import AsyncDBPython
+from wschat.passwords import PasswordHasher
+from wschat.rooms import RoomManager
+from wschat.server import ChatMixin, make_app
+from wschat.session import Session
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+try:
+    import lupa
+except ImportError:
+    # Lua scripts of fakeredis (#change nick on REDIS)
+    lupa = None
+
+
+class ChatTestCase(AsyncHTTPTestCase):
+    """ Chat server with in memory DataBase and bus of process,
+        WebSocket clients are connected by connect.
+        Child may overwrite make_db and settings.
+    """
+    # Application settings, see server.make_app
+    settings = dict()
+
+    def setUp(self):
+        # State of rooms and sessions is shared by all connections
+        # of process, it must not leak between tests
+        ChatMixin.rooms = RoomManager()
+        ChatMixin.connections = set()
+        Session.by_login.clear()
+        super(ChatTestCase, self).setUp()
+
+    def make_db(self):
+        """ db.AsyncDB of server, passwords are hashed right away """
+        return AsyncDBPython(hasher=PasswordHasher(0))
+
+    def get_app(self):
+        self.db = self.make_db()
+        self.bus = LocalBus()
+        return make_app(self.db, self.bus, **self.settings)
+
+    @gen.coroutine
+    def connect(self, last_seen=None, compression_options=None):
+        """ WebSocket client of chat
+        :param last_seen: dict room -> id of last seen message
+        """
+        url = 'ws://127.0.0.1:%d/chat' % self.get_http_port()
+        if last_seen is not None:
+            url += '?last_seen=%s' % urllib.quote(json.dumps(last_seen))
+        conn = yield websocket_connect(HTTPRequest(url), io_loop=self.io_loop,
+                                       compression_options=compression_options)
+        raise gen.Return(conn)
+
+    @gen.coroutine
+    def read_until(self, conn, prefix):
+        """ Read frames until the one starting with prefix
+        :return: list of read frames, the last one starts with prefix
+        """
+        frames = []
+        while True:
+            frame = yield conn.read_message()
+            if frame is None:
+                raise AssertionError('Connection closed, got %r' % frames)
+            frames.append(frame)
+            if frame.startswith(prefix):
+                raise gen.Return(frames)
+
+    @gen.coroutine
+    def command(self, conn, command, prefix='SERVER:'):
+        """ Send command and return answer starting with prefix """
+        conn.write_message(command)
+        frames = yield self.read_until(conn, prefix)
+        raise gen.Return(frames[-1])
+
+    @gen.coroutine
+    def login(self, conn, login, password='pw'):
+        """ Register user and log in """
+        yield self.command(conn, '#register %s %s' % (login, password))
+        answer = yield self.command(conn, '#login %s %s' % (login, password))
+        self.assertIn('You are logged in', answer)
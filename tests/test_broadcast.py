@@ -0,0 +1,164 @@
+# coding: utf-8
+import struct
+import unittest
+import zlib
+
+from tornado.iostream import StreamClosedError
+
+from wschat.broadcast import (PreparedMessage, DeflateCompressor, OutboundQueue, RSV1,
+                              DROP_NEWEST, DISCONNECT)
+
+
+def inflate(frame):
+    """ Payload of compressed frame with short header (RFC 7692) """
+    payload = frame[4:] if ord(frame[1]) == 126 else frame[2:]
+    return zlib.decompressobj(-zlib.MAX_WBITS).decompress(payload + b'\x00\x00\xff\xff')
+
+
+def split_frames(data):
+    """ Frames of data written to stream: (first byte, payload) """
+    frames = []
+    while data:
+        length, start = ord(data[1]) & 0x7f, 2
+        if length == 126:
+            length, start = struct.unpack('!H', data[2:4])[0], 4
+        elif length == 127:
+            length, start = struct.unpack('!Q', data[2:10])[0], 10
+        frames.append((ord(data[0]), data[start:start + length]))
+        data = data[start + length:]
+    return frames
+
+
+class StalledStream(object):
+    """ Stream of slow client: buffer is not drained until drain call """
+    def __init__(self):
+        self.data = b''
+        self.writes = 0
+        self.stalled = False
+        self._closed = False
+        self._callbacks = []
+        self._write_buffer = []
+
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        self._closed = True
+
+    def writing(self):
+        return self.stalled
+
+    def write(self, data, callback=None):
+        self.data += data
+        self.writes += 1 if data else 0
+        if callback is not None:
+            self._callbacks.append(callback)
+
+    def drain(self):
+        self.stalled = False
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback()
+
+
+class DeflateCompressorTest(unittest.TestCase):
+    def test_short_message_uses_shared_frame(self):
+        mess = PreparedMessage(u'short')
+        self.assertIs(DeflateCompressor(min_size=100).frame(mess), mess.frame)
+
+    def test_long_message_is_compressed(self):
+        mess = PreparedMessage(u'long ' * 100)
+        frame = DeflateCompressor(min_size=100).frame(mess)
+        self.assertTrue(ord(frame[0]) & RSV1)
+        self.assertLess(len(frame), len(mess.frame))
+        self.assertEqual(inflate(frame), mess.data)
+
+    def test_context_is_not_kept_without_takeover(self):
+        mess = PreparedMessage(u'long ' * 100)
+        compressor = DeflateCompressor(min_size=100, persistent=False)
+        # Every frame is decompressed by new context
+        self.assertEqual(inflate(compressor.frame(mess)), mess.data)
+        self.assertEqual(inflate(compressor.frame(mess)), mess.data)
+
+    def test_dropped_frames_dont_break_context(self):
+        compressor = DeflateCompressor(min_size=100)
+        stream = StalledStream()
+        queue = OutboundQueue(stream, maxsize=1, encode=compressor.frame)
+        first, second = PreparedMessage(u'alpha ' * 50), PreparedMessage(u'bravo ' * 50)
+        queue.put(first)
+        stream.stalled = True
+        queue.put(second)
+        # Queue is full, the first "bravo" is dropped
+        queue.put(second)
+        stream.drain()
+        self.assertEqual(queue.dropped, 1)
+        # Client inflates frames with one context (context takeover)
+        decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        texts = []
+        for first_byte, payload in split_frames(stream.data):
+            self.assertTrue(first_byte & RSV1)
+            texts.append(decompressor.decompress(payload + b'\x00\x00\xff\xff'))
+        self.assertEqual(texts, [first.data, second.data])
+
+
+class OutboundQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.stream = StalledStream()
+
+    def fill(self, policy, count=5):
+        """ Queue of two frames, stream stalls after the first frame,
+            then count frames are put
+        :return: queue and results of put
+        """
+        queue = OutboundQueue(self.stream, maxsize=2, policy=policy,
+                              on_overflow=self.stream.close)
+        self.assertTrue(queue.put(b'first'))
+        self.stream.stalled = True
+        results = [queue.put(str(n)) for n in range(1, count + 1)]
+        return queue, results
+
+    def test_frames_are_written_while_stream_is_idle(self):
+        queue = OutboundQueue(self.stream)
+        queue.put(b'a')
+        queue.put(b'b')
+        self.assertEqual((self.stream.data, self.stream.writes, queue.depth), (b'ab', 2, 0))
+
+    def test_queued_frames_are_written_by_one_write(self):
+        queue = OutboundQueue(self.stream)
+        queue.put(b'first')
+        self.stream.stalled = True
+        queue.put(b'a')
+        queue.put(b'b')
+        self.assertEqual(queue.depth, 2)
+        # Queue and write buffer of stream
+        self.stream._write_buffer = [b'first']
+        self.assertEqual(queue.size, len(b'first') + 2)
+        self.stream.drain()
+        self.assertEqual((self.stream.data, self.stream.writes, queue.depth), (b'firstab', 2, 0))
+
+    def test_drop_oldest(self):
+        queue, results = self.fill(policy='drop_oldest')
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual((queue.depth, queue.dropped), (2, 3))
+        self.stream.drain()
+        self.assertEqual(self.stream.data, b'first45')
+
+    def test_drop_newest(self):
+        queue, results = self.fill(policy=DROP_NEWEST)
+        self.assertEqual(results, [True, True, False, False, False])
+        self.assertEqual((queue.depth, queue.dropped), (2, 3))
+        self.stream.drain()
+        self.assertEqual(self.stream.data, b'first12')
+
+    def test_disconnect(self):
+        queue, results = self.fill(policy=DISCONNECT, count=3)
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual((queue.depth, queue.dropped), (0, 1))
+        self.assertTrue(self.stream.closed())
+        self.assertRaises(StreamClosedError, queue.put, b'4')
+        self.stream.drain()
+        self.assertEqual(self.stream.data, b'first')
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, OutboundQueue, self.stream, policy='drop_all')
+        self.assertRaises(ValueError, OutboundQueue, self.stream, maxsize=0)
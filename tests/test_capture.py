@@ -0,0 +1,47 @@
+# coding: utf-8
+import os
+import shutil
+import tempfile
+
+from tornado.testing import AsyncTestCase
+
+from wschat.capture import (CaptureWriter, read_capture, captured_users, OPEN, MESSAGE, CLOSE,
+                            PASSWORD)
+
+
+class CaptureTest(AsyncTestCase):
+    def setUp(self):
+        super(CaptureTest, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'traffic.bin')
+
+    def capture(self):
+        """ Capture of two connections: user of cookie and
+            anonymous one, which logs in and registers
+        """
+        writer = CaptureWriter(self.path)
+        alice = writer.open('alice')
+        anonymous = writer.open()
+        writer.message(alice, u'hello')
+        writer.message(anonymous, u'#register bob secret')
+        writer.message(anonymous, u'#LOGIN  carol  other secret')
+        writer.message(anonymous, u'#login')
+        writer.close(anonymous)
+        writer.shutdown()
+        return list(read_capture(self.path))
+
+    def test_passwords_are_not_written(self):
+        events = self.capture()
+        self.assertEqual([x[2:] for x in events], [
+            (OPEN, u'{"user": "alice"}'),
+            (OPEN, u'{"user": null}'),
+            (MESSAGE, u'hello'),
+            (MESSAGE, u'#register bob %s' % PASSWORD),
+            (MESSAGE, u'#LOGIN carol %s' % PASSWORD),
+            (MESSAGE, u'#login'),
+            (CLOSE, u''),
+        ])
+
+    def test_users_of_cookies_and_commands(self):
+        self.assertEqual(captured_users(self.capture()), set(['alice', 'bob', 'carol']))
@@ -0,0 +1,231 @@
+# coding: utf-8
+import json
+import unittest
+
+from tornado import gen
+from tornado.testing import gen_test
+
+from wschat.db import AsyncDBRedis
+from wschat.metrics import COMPRESSION_BYTES_IN
+from wschat.passwords import PasswordHasher
+from wschat.server import ChatMixin
+
+from .base import ChatTestCase, fakeredis, lupa
+
+
+def history_ids(frame):
+    """ Ids of messages of HISTORY frame """
+    return [x[0] for x in json.loads(frame[len('HISTORY:'):])['messages']]
+
+
+def message_id(frame):
+    """ Id of message of MESSAGE frame """
+    return int(frame.split(':', 2)[1])
+
+
+class ChatTest(ChatTestCase):
+    @gen_test
+    def test_message_fanout(self):
+        a = yield self.connect()
+        b = yield self.connect()
+        yield self.read_until(a, 'SERVER:You are connected')
+        yield self.read_until(b, 'SERVER:You are connected')
+        a.write_message('hello <b>')
+        frame = yield a.read_message()
+        self.assertRegexpMatches(frame, r'^MESSAGE:\d+:\[Free Chat\] Anonymous: hello &lt;b&gt;$')
+        self.assertEqual((yield b.read_message()), frame)
+
+    @gen.coroutine
+    def send_messages(self, conn, count):
+        """ Send messages to Free Chat
+        :return: ids of sent messages
+        """
+        ids = []
+        for n in range(count):
+            conn.write_message('m%d' % n)
+            frame = yield conn.read_message()
+            ids.append(message_id(frame))
+        raise gen.Return(ids)
+
+    @gen_test
+    def test_history_on_connect(self):
+        a = yield self.connect()
+        yield self.read_until(a, 'SERVER:You are connected')
+        ids = yield self.send_messages(a, 3)
+        b = yield self.connect()
+        frames = yield self.read_until(b, 'SERVER:You are connected')
+        self.assertEqual(history_ids(frames[0])[-3:], ids)
+
+    @gen_test
+    def test_login_join_and_nick(self):
+        a = yield self.connect()
+        yield self.read_until(a, 'SERVER:You are connected')
+        yield self.login(a, 'bob')
+        answer = yield self.command(a, '#join room python developers')
+        self.assertEqual(answer, 'SERVER:You are connected to room: '
+                                 '&quot;Python Developers&quot; as &quot;bob&quot;')
+        a.write_message('hi')
+        frames = yield self.read_until(a, 'MESSAGE:')
+        frames += yield self.read_until(a, 'MESSAGE:')
+        self.assertEqual(sorted(x.split('] ', 1)[1] for x in frames),
+                         ['bob: hi', 'bob: hi'])
+
+    @gen_test
+    def test_change_nick(self):
+        a = yield self.connect()
+        yield self.read_until(a, 'SERVER:You are connected')
+        yield self.login(a, 'bob')
+        answer = yield self.command(a, '#change nick * robert')
+        self.assertEqual(answer, 'SERVER:Your nick changed to &quot;robert&quot; '
+                                 'in room &quot;Free Chat&quot;')
+        a.write_message('hi')
+        frame = yield self.read_until(a, 'MESSAGE:')
+        self.assertEqual(frame[-1].split(':', 2)[2], '[Free Chat] robert: hi')
+
+    @gen_test
+    def test_create_room(self):
+        a = yield self.connect()
+        yield self.read_until(a, 'SERVER:You are connected')
+        answer = yield self.command(a, '#create room Rust')
+        self.assertEqual(answer, 'SERVER:Only logged in users can create rooms')
+        yield self.login(a, 'bob')
+        answer = yield self.command(a, '#create room <b>')
+        self.assertIn('Room name must be', answer)
+        answer = yield self.command(a, '#create room Rust Devs')
+        self.assertEqual(answer, 'SERVER:Room &quot;Rust Devs&quot; created')
+        yield self.read_until(a, 'SERVER:You are connected to room: &quot;Rust Devs&quot;')
+        answer = yield self.command(a, '#create room rust devs')
+        self.assertEqual(answer, 'SERVER:Room &quot;rust devs&quot; already exists')
+        response = yield self.http_client.fetch(self.get_url('/'))
+        self.assertIn('Rust Devs', response.body)
+
+    @gen_test
+    def test_message_to_non_ascii_room_after_login(self):
+        a = yield self.connect()
+        yield self.read_until(a, 'SERVER:You are connected')
+        yield self.login(a, 'bob')
+        yield self.command(a, u'#create room Кафе')
+        yield self.read_until(a, u'SERVER:You are connected to room: &quot;Кафе&quot;')
+        # Rooms of user are loaded from DataBase on login
+        b = yield self.connect()
+        yield self.read_until(b, 'SERVER:You are connected')
+        answer = yield self.command(b, '#login bob pw')
+        self.assertIn('You are logged in', answer)
+        # Message is posted to rooms of user, the first connection
+        # is subscribed to them
+        b.write_message(u'привет')
+        frames = yield self.read_until(a, 'MESSAGE:')
+        frames += yield self.read_until(a, 'MESSAGE:')
+        self.assertEqual(sorted(x.split(':', 2)[2] for x in frames),
+                         [u'[Free Chat] bob: привет', u'[Кафе] bob: привет'])
+
+    @gen_test
+    def test_resume_sends_missed_messages(self):
+        a = yield self.connect()
+        yield self.read_until(a, 'SERVER:You are connected')
+        ids = yield self.send_messages(a, 5)
+        b = yield self.connect(last_seen={'Free Chat': ids[2]})
+        frames = yield self.read_until(b, 'SERVER:You are connected')
+        self.assertEqual(len(frames), 2)
+        self.assertEqual(history_ids(frames[0]), ids[3:])
+
+    @gen_test
+    def test_resume_gap_when_too_many_missed(self):
+        self._app.settings['resume_limit'] = 2
+        a = yield self.connect()
+        yield self.read_until(a, 'SERVER:You are connected')
+        ids = yield self.send_messages(a, 5)
+        b = yield self.connect(last_seen={'Free Chat': ids[0]})
+        frames = yield self.read_until(b, 'SERVER:You are connected')
+        self.assertEqual(json.loads(frames[0][len('GAP:'):]),
+                         dict(room='Free Chat', last_seen=ids[0]))
+        self.assertEqual(history_ids(frames[1])[-5:], ids)
+
+    @gen_test
+    def test_history_command_pages(self):
+        a = yield self.connect()
+        yield self.read_until(a, 'SERVER:You are connected')
+        sent = yield self.send_messages(a, 9)
+        frame = yield self.command(a, '#history room free chat limit 100', 'HISTORY:')
+        ids = history_ids(frame)
+        self.assertEqual(ids[-9:], sent)
+        frame = yield self.command(a, '#history room free chat limit 3', 'HISTORY:')
+        self.assertEqual(history_ids(frame), ids[-3:])
+        # Older pages
+        frame = yield self.command(a, '#history room free chat before %d limit 3' % ids[-3],
+                                   'HISTORY:')
+        self.assertEqual(history_ids(frame), ids[-6:-3])
+        frame = yield self.command(a, '#history room FREE CHAT before %d limit 3' % ids[-6],
+                                   'HISTORY:')
+        self.assertEqual(history_ids(frame), ids[-9:-6])
+        # Back to newer page
+        frame = yield self.command(a, '#history room free chat before %d limit 2' % ids[-1],
+                                   'HISTORY:')
+        self.assertEqual(history_ids(frame), ids[-3:-1])
+        answer = yield self.command(a, '#history room free chat before %d' % ids[0])
+        self.assertEqual(answer, 'SERVER:No more messages in room &quot;Free Chat&quot;')
+
+    @gen_test
+    def test_history_command_arguments(self):
+        a = yield self.connect()
+        yield self.read_until(a, 'SERVER:You are connected')
+        yield self.send_messages(a, 1)
+        for command in ('#history', '#history free chat', '#history room free chat limit 0',
+                        '#history room free chat limit 00'):
+            answer = yield self.command(a, command)
+            self.assertEqual(answer, 'SERVER:Wrong command usage')
+        answer = yield self.command(a, '#history room python developers')
+        self.assertEqual(answer, 'SERVER:You were not joined to room '
+                                 '&quot;python developers&quot;')
+
+
+class CompressionTest(ChatTestCase):
+    settings = dict(compression=dict(min_size=100, level=6, mem_level=8))
+
+    @gen_test
+    def test_long_messages_only_are_compressed(self):
+        a = yield self.connect(compression_options=dict())
+        yield self.read_until(a, 'SERVER:You are connected')
+        self.assertIsNotNone(a.protocol._decompressor)
+        compressed = COMPRESSION_BYTES_IN.labels().value
+        a.write_message('short')
+        frame = yield a.read_message()
+        self.assertEqual(frame, 'MESSAGE:1:[Free Chat] Anonymous: short')
+        self.assertEqual(COMPRESSION_BYTES_IN.labels().value, compressed)
+        a.write_message('long ' * 100)
+        frame = yield a.read_message()
+        self.assertEqual(frame, 'MESSAGE:2:[Free Chat] Anonymous: ' + 'long ' * 100)
+        self.assertEqual(COMPRESSION_BYTES_IN.labels().value, compressed + len(frame))
+
+
+class SlowConsumerTest(ChatTestCase):
+    settings = dict(outbound_queue_size=2, outbound_policy='disconnect')
+
+    @gen_test
+    def test_slow_consumer_is_disconnected(self):
+        a = yield self.connect()
+        yield self.read_until(a, 'SERVER:You are connected')
+        handler, = ChatMixin.connections
+        # Client of handler doesn't read, stream never drains
+        handler.stream.writing = lambda: True
+        handler.stream.write = lambda data, callback=None: None
+        b = yield self.connect()
+        yield self.read_until(b, 'SERVER:You are connected')
+        for n in range(3):
+            b.write_message('m%d' % n)
+            yield b.read_message()
+        self.assertEqual(handler.outbound.dropped, 1)
+        self.assertTrue(handler.stream.closed())
+        self.assertNotIn(handler, ChatMixin.connections)
+        self.assertIsNone((yield a.read_message()))
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisChatTest(ChatTest):
+    """ The same chat on REDIS DataBase (fake REDIS in process) """
+    def make_db(self):
+        return AsyncDBRedis(r=fakeredis.FakeRedis(decode_responses=True), hasher=PasswordHasher(0))
+
+    @unittest.skipIf(lupa is None, 'lupa is not installed, fakeredis runs no Lua scripts')
+    def test_change_nick(self):
+        super(RedisChatTest, self).test_change_nick()
@@ -0,0 +1,65 @@
+# coding: utf-8
+import inspect
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from wschat import server
+from wschat.config import DEFAULTS, parse_args
+
+
+CONNECTION_OPTIONS = ('outbound_queue_size', 'outbound_policy', 'resume_limit', 'compression',
+                      'compression_min_size', 'compression_level', 'compression_mem_level')
+
+
+def app_settings(options):
+    """ Application settings of connection options """
+    return server.app_settings(**dict((x, options[x]) for x in CONNECTION_OPTIONS))
+
+
+class ConfigTest(unittest.TestCase):
+    def test_defaults(self):
+        self.assertEqual(parse_args([]), DEFAULTS)
+
+    def test_every_option_is_accepted_by_server(self):
+        args, varargs, keywords, defaults = inspect.getargspec(server.main)
+        options = set(args) | set(inspect.getargspec(server.app_settings)[0])
+        self.assertEqual(set(DEFAULTS) - options, set())
+
+    def test_defaults_of_connections_match_application(self):
+        app = server.make_app()
+        for name, value in app_settings(DEFAULTS).items():
+            self.assertEqual(app.settings[name], value)
+
+    def test_connection_options(self):
+        options = parse_args(['--outbound-queue-size', '16', '--outbound-policy', 'disconnect',
+                              '--resume-limit', '5', '--compression-min-size', '64',
+                              '--compression-level', '1'])
+        self.assertEqual(app_settings(options),
+                         dict(outbound_queue_size=16, outbound_policy='disconnect', resume_limit=5,
+                              compression=dict(min_size=64, level=1, mem_level=8)))
+
+    def test_compression_is_disabled(self):
+        options = parse_args(['--no-compression'])
+        self.assertIs(options['compression'], False)
+        self.assertIsNone(server.app_settings(compression=False)['compression'])
+
+    def test_command_line_overwrites_config_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'wschat.json')
+        with open(path, 'w') as f:
+            json.dump(dict(resume_limit=10, compression=False, port=9000), f)
+        options = parse_args(['--config', path, '--port', '9001'])
+        self.assertEqual((options['resume_limit'], options['compression'], options['port']),
+                         (10, False, 9001))
+
+    def test_unknown_option_of_config_file(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'wschat.json')
+        with open(path, 'w') as f:
+            json.dump(dict(outbound_queue_policy='disconnect'), f)
+        self.assertRaises(ValueError, parse_args, ['--config', path])
@@ -0,0 +1,169 @@
+# coding: utf-8
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from wschat import disk
+from wschat.db import Message
+from wschat.disk import DBDisk, AsyncDBDisk, pack_record
+from wschat.server import shutdown
+
+
+ROOM = 'Free Chat'
+
+
+class DiskTest(unittest.TestCase):
+    """ DataBase in files: history, restart and compaction """
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.db = None
+
+    def tearDown(self):
+        if self.db is not None:
+            self.db.close()
+
+    def open(self, **kwargs):
+        """ (Re)open DataBase of directory, compaction is started
+            only by test
+        """
+        if self.db is not None:
+            self.db.close()
+        kwargs.setdefault('compact_interval', 3600)
+        self.db = DBDisk(self.path, **kwargs)
+        return self.db
+
+    def texts(self, messages):
+        return [x.text for x in messages]
+
+    def segments(self):
+        return sorted(x for x in os.listdir(self.path) if x.startswith('segment-'))
+
+    def test_messages_are_paged(self):
+        db = self.open()
+        ids = [db.new_message(ROOM, u'm%d' % n).id for n in range(20)]
+        self.assertEqual(ids, range(1, 21))
+        self.assertEqual(self.texts(db.get_messages(ROOM, limit=3)), ['m17', 'm18', 'm19'])
+        self.assertEqual(self.texts(db.get_messages(ROOM, before=5, limit=10)),
+                         ['m0', 'm1', 'm2', 'm3'])
+        self.assertEqual(self.texts(db.get_messages_since(ROOM, 18)), ['m17', 'm18', 'm19'])
+        self.assertEqual(db.get_messages('No such room'), [])
+
+    def test_data_is_restored_after_restart(self):
+        db = self.open()
+        db.new_user('bob', 'hash')
+        db.new_room(u'Кафе')
+        db.add_room_to_current('bob', u'Кафе')
+        db.change_nick_in_room('bob', u'Кафе', 'Bobby')
+        for n in range(5):
+            db.new_message(u'Кафе', u'привет %d' % n)
+        db = self.open()
+        self.assertEqual(db.get_password_hash('bob'), 'hash')
+        self.assertEqual(db.resolve_room(u'кафе'), u'Кафе')
+        self.assertEqual(db.get_current_nicks('bob'), [(u'Кафе', 'Bobby')])
+        self.assertEqual(self.texts(db.get_messages(u'Кафе', limit=2)),
+                         [u'привет 3', u'привет 4'])
+        self.assertEqual(db.new_message(u'Кафе', u'again').id, 6)
+
+    def test_torn_records_are_dropped(self):
+        db = self.open()
+        for n in range(3):
+            db.new_message(ROOM, u'm%d' % n)
+        segment, end = db._segment, db._size
+        db.close()
+        self.db = None
+        # Crash in the middle of writes of message and of user
+        with open(os.path.join(self.path, 'segment-%08d.log' % segment), 'r+b') as f:
+            f.seek(end)
+            f.write(pack_record(4, time.time(), ROOM, u'torn message')[:-3])
+        with open(os.path.join(self.path, 'meta.log'), 'ab') as f:
+            f.write(b'{"user": "torn", "pass_h')
+        db = self.open()
+        self.assertEqual(self.texts(db.get_messages(ROOM)), ['m0', 'm1', 'm2'])
+        self.assertIsNone(db.get_password_hash('torn'))
+        # New records overwrite torn ones
+        self.assertEqual(db.new_message(ROOM, u'm3').id, 4)
+        db.new_user('alice', 'hash')
+        db = self.open()
+        self.assertEqual(self.texts(db.get_messages(ROOM)), ['m0', 'm1', 'm2', 'm3'])
+        self.assertEqual(db.get_password_hash('alice'), 'hash')
+
+    def test_compaction_removes_old_segments(self):
+        db = self.open(history_size=10, segment_size=1024)
+        for n in range(200):
+            db.new_message(ROOM, u'message %d' % n)
+        before = len(self.segments())
+        # Copy is made without lock
+        opened = []
+
+        def unlocked_open(name, *args):
+            if name.endswith('.tmp'):
+                opened.append(db._lock.acquire(False))
+                db._lock.release()
+            return open(name, *args)
+        disk.open = unlocked_open
+        self.addCleanup(delattr, disk, 'open')
+        db.compact()
+        self.assertEqual(opened, [True])
+        self.assertLess(len(self.segments()), before)
+        expected = ['message %d' % n for n in range(190, 200)]
+        self.assertEqual(self.texts(db.get_messages(ROOM)), expected)
+        db = self.open(history_size=10, segment_size=1024)
+        self.assertEqual(self.texts(db.get_messages(ROOM)), expected)
+        self.assertEqual(db.new_message(ROOM, u'next').id, 201)
+
+    def test_ids_survive_compaction_of_all_messages(self):
+        db = self.open(history_size=10, segment_size=1024, history_ttl=0.05)
+        for n in range(50):
+            db.new_message(ROOM, u'message %d' % n)
+        time.sleep(0.1)
+        db.compact()
+        db = self.open(history_size=10, segment_size=1024, history_ttl=0.05)
+        self.assertEqual(db.get_messages(ROOM), [])
+        self.assertEqual(db.new_message(ROOM, u'next').id, 51)
+
+    def test_unused_reserved_ids_dont_make_gap(self):
+        db = self.open()
+        first = db.reserve_ids(ROOM, 100)
+        self.assertEqual(db.reserve_ids(ROOM, 100), first + 100)
+        db.add_messages([(ROOM, Message(first + n, time.time(), u'm%d' % n)) for n in range(3)])
+        # Ids reserved but not used before restart are given again
+        db = self.open()
+        self.assertEqual(db.reserve_ids(ROOM, 100), first + 3)
+        db.add_messages([(ROOM, Message(first + 3, time.time(), u'm3'))])
+        self.assertEqual(self.texts(db.get_messages(ROOM, before=first + 3)), ['m0', 'm1', 'm2'])
+
+    def test_history_starts_after_gap_of_ids(self):
+        db = self.open()
+        db.add_messages([(ROOM, Message(n, time.time(), u'm%d' % n)) for n in (1, 2, 3, 10, 11)])
+        # Ids of history must go one by one
+        db = self.open()
+        self.assertEqual(self.texts(db.get_messages(ROOM)), ['m10', 'm11'])
+        self.assertEqual(self.texts(db.get_messages(ROOM, before=11)), ['m10'])
+        self.assertEqual(db.new_message(ROOM, u'm12').id, 12)
+
+
+class DiskShutdownTest(AsyncTestCase):
+    def setUp(self):
+        super(DiskShutdownTest, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+    @gen_test
+    def test_shutdown_closes_database(self):
+        db = AsyncDBDisk(self.path, sync=False)
+        yield db.new_message(ROOM, u'last words')
+        # IOLoop of test is stopped by test, not by shutdown
+        self.io_loop.stop = lambda: None
+        try:
+            yield shutdown([], db)
+        finally:
+            del self.io_loop.stop
+        self.assertTrue(db.db._closed)
+        db = DBDisk(self.path)
+        self.addCleanup(db.close)
+        self.assertEqual([x.text for x in db.get_messages(ROOM)], ['last words'])
@@ -0,0 +1,91 @@
+# coding: utf-8
+import gc
+import resource
+import time
+import unittest
+
+from wschat.db import DBPython, DBRedis
+
+from .base import fakeredis
+
+
+TEXT = u'Bender: Bite my shiny metal ass! ' * 4
+
+
+def rss_kb():
+    """ Current resident set size of process in KB,
+        None if it is not known (not linux)
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except IOError:
+        return None
+    return pages * resource.getpagesize() // 1024
+
+
+class HistoryTest(unittest.TestCase):
+    """ History of room keeps history_size messages, so memory
+        used by room doesn't grow under sustained traffic
+    """
+    history_size = 100
+    # Messages written to room, many more than history_size
+    messages = 50000
+    # Allowed growth of RSS, unbounded history of messages
+    # would take tens of MB
+    max_rss_growth_kb = 4096
+
+    def make_db(self, history_ttl=None):
+        return DBPython(history_size=self.history_size, history_ttl=history_ttl)
+
+    def stored(self, db, room):
+        """ Number of stored messages of room """
+        return len(db._rooms[room])
+
+    def fill(self, db, room, count):
+        for _ in xrange(count):
+            db.new_message(room, TEXT)
+
+    def test_history_size_is_kept(self):
+        db = self.make_db()
+        room = db.default_room
+        self.fill(db, room, self.messages)
+        self.assertEqual(self.stored(db, room), self.history_size)
+        last = db.get_messages(room, limit=self.history_size + 1)
+        self.assertEqual(len(last), self.history_size)
+        self.assertEqual(last[-1].id - last[0].id, self.history_size - 1)
+
+    def test_footprint_stays_flat(self):
+        db = self.make_db()
+        room = db.default_room
+        # Warm up: history is full, allocator has its arenas
+        self.fill(db, room, self.history_size * 10)
+        gc.collect()
+        objects, rss = len(gc.get_objects()), rss_kb()
+        self.fill(db, room, self.messages)
+        gc.collect()
+        # Stored messages are replaced, not added
+        self.assertLess(len(gc.get_objects()) - objects, self.history_size)
+        if rss is not None:
+            self.assertLess(rss_kb() - rss, self.max_rss_growth_kb)
+
+    def test_old_messages_expire(self):
+        db = self.make_db(history_ttl=0.05)
+        room = db.default_room
+        self.fill(db, room, 5)
+        time.sleep(0.1)
+        self.fill(db, room, 2)
+        self.assertEqual(len(db.get_messages(room, limit=10)), 2)
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisHistoryTest(HistoryTest):
+    """ The same on REDIS (fake REDIS keeps data in process) """
+    messages = 5000
+
+    def make_db(self, history_ttl=None):
+        return DBRedis(fakeredis.FakeRedis(decode_responses=True), history_size=self.history_size,
+                       history_ttl=history_ttl)
+
+    def stored(self, db, room):
+        return db.r.zcard(db._history_key(room))
@@ -0,0 +1,81 @@
+# coding: utf-8
+import unittest
+
+from tornado.testing import gen_test
+
+from wschat.metrics import (Registry, Counter, Gauge, CallbackGauge, Histogram, MESSAGES,
+                            bounded_label)
+
+from .base import ChatTestCase
+
+
+class RegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter_and_gauge(self):
+        counter = Counter('requests_total', 'Requests', ['path'], registry=self.registry)
+        counter.labels('/').inc()
+        counter.labels(u'/"кафе"\n').inc(2)
+        gauge = Gauge('depth', 'Depth', registry=self.registry)
+        gauge.set(1.5)
+        CallbackGauge('rooms', 'Rooms', lambda: [((), 3)], registry=self.registry)
+        self.assertEqual(self.registry.render().splitlines(), [
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{path="/"} 1',
+            u'requests_total{path="/\\"кафе\\"\\n"} 2'.encode('utf-8'),
+            '# HELP depth Depth',
+            '# TYPE depth gauge',
+            'depth 1.5',
+            '# HELP rooms Rooms',
+            '# TYPE rooms gauge',
+            'rooms 3',
+        ])
+
+    def test_histogram(self):
+        histogram = Histogram('latency', 'Latency', buckets=(0.1, 1), registry=self.registry)
+        for value in (0.05, 0.1, 0.5, 2):
+            histogram.observe(value)
+        self.assertEqual(self.registry.render().splitlines()[2:], [
+            'latency_bucket{le="0.1"} 2',
+            'latency_bucket{le="1.0"} 3',
+            'latency_bucket{le="+Inf"} 4',
+            'latency_sum 2.65',
+            'latency_count 4',
+        ])
+
+    def test_wrong_labels(self):
+        counter = Counter('requests_total', 'Requests', ['path'], registry=self.registry)
+        self.assertRaises(ValueError, counter.labels, '/', 'GET')
+
+    def test_bounded_label(self):
+        known = ('Free Chat', 'Python Developers')
+        self.assertEqual(bounded_label('Free Chat', known), 'Free Chat')
+        self.assertEqual(bounded_label('Rust', known), 'other')
+
+
+class MetricsHandlerTest(ChatTestCase):
+    @gen_test
+    def test_messages_of_user_rooms_share_label(self):
+        before = dict((x, MESSAGES.labels(x).value) for x in ('Free Chat', 'other'))
+        a = yield self.connect()
+        yield self.read_until(a, 'SERVER:You are connected')
+        yield self.login(a, 'bob')
+        for room in ('Rust', 'Go'):
+            yield self.command(a, '#create room %s' % room)
+            yield self.read_until(a, 'SERVER:You are connected to room: &quot;%s&quot;' % room)
+        a.write_message('hi')
+        for _ in range(3):
+            yield self.read_until(a, 'MESSAGE:')
+        self.assertEqual(MESSAGES.labels('Free Chat').value - before['Free Chat'], 1)
+        self.assertEqual(MESSAGES.labels('other').value - before['other'], 2)
+        self.assertNotIn(('Rust',), MESSAGES._children)
+        response = yield self.http_client.fetch(self.get_url('/metrics'))
+        self.assertEqual(response.headers['Content-Type'],
+                         'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.body.splitlines()
+        self.assertIn('wschat_messages_total{room="other"} %d' % MESSAGES.labels('other').value,
+                      lines)
+        self.assertIn('wschat_connections 1', lines)
+        self.assertIn('wschat_room_connections{room="Rust"} 1', lines)
@@ -0,0 +1,52 @@
+# coding: utf-8
+import json
+import unittest
+
+from wschat.db import DBRedis
+
+from .base import fakeredis
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class MigrateTest(unittest.TestCase):
+    """ Data of older versions in REDIS is migrated once,
+        workers only check version of data
+    """
+    def setUp(self):
+        self.r = fakeredis.FakeRedis(decode_responses=True)
+        self.r.flushall()
+        # History of room before ids and hash of rooms
+        self.r.rpush('RamblerTaskChat:ROOM:Old', 'plain', json.dumps([1.0, 'timed']),
+                     '[admin]: hello', '[1, 2]')
+        self.r.hset('RamblerTaskChat:USER:bob', 'current_rooms', json.dumps([['Old', 'Bob']]))
+        self.types = 0
+        type_ = self.r.type
+
+        def counted_type(key):
+            self.types += 1
+            return type_(key)
+        self.r.type = counted_type
+
+    def test_old_data_is_migrated(self):
+        db = DBRedis(self.r)
+        self.assertIn('Old', db.rooms)
+        # Plain messages of nicks in brackets are not json
+        self.assertEqual([x.text for x in db.get_messages('Old')],
+                         ['plain', 'timed', '[admin]: hello', '[1, 2]'])
+        self.assertEqual(db.get_current_nick('bob', 'Old'), 'Bob')
+        self.assertTrue(db.is_migrated())
+
+    def test_migration_runs_once(self):
+        DBRedis(self.r)
+        types = self.types
+        db = DBRedis(self.r)
+        self.assertEqual(self.types, types)
+        self.assertFalse(db.migrate())
+        self.assertEqual(db.r.zcard(db._history_key('Old')), 4)
+        self.assertEqual(db.r.zcard(db._history_key(db.default_room)), 1)
+
+    def test_worker_doesnt_migrate(self):
+        self.assertRaises(RuntimeError, DBRedis, self.r, migrate=False)
+        DBRedis(self.r)
+        db = DBRedis(self.r, migrate=False)
+        self.assertIn('Old', db.rooms)
@@ -0,0 +1,85 @@
+# coding: utf-8
+import hashlib
+import unittest
+
+from tornado.testing import gen_test
+
+from wschat import passwords
+from wschat.db import AsyncDBRedis
+from wschat.passwords import PasswordHasher, hash_password, verify_password, needs_rehash
+
+from .base import ChatTestCase, fakeredis
+
+
+def md5(password):
+    """ Hash of first versions """
+    return hashlib.md5(password).hexdigest()
+
+
+class PasswordsTest(unittest.TestCase):
+    def test_pbkdf2(self):
+        pass_hash = hash_password(u'пароль', iterations=1000)
+        algorithm, iterations, salt, digest = pass_hash.split('$')
+        self.assertEqual((algorithm, iterations), ('pbkdf2_sha256', '1000'))
+        self.assertTrue(verify_password(u'пароль', pass_hash))
+        self.assertFalse(verify_password(u'парол', pass_hash))
+        # Salt is random
+        self.assertNotEqual(hash_password(u'пароль', iterations=1000), pass_hash)
+
+    def test_md5(self):
+        self.assertTrue(verify_password('secret', md5('secret')))
+        self.assertFalse(verify_password('Secret', md5('secret')))
+
+    def test_unknown_hash(self):
+        self.assertFalse(verify_password('secret', 'sha1$1000$salt$digest'))
+        self.assertFalse(verify_password('secret', 'secret'))
+
+    def test_needs_rehash(self):
+        self.assertTrue(needs_rehash(md5('secret')))
+        self.assertTrue(needs_rehash(hash_password('secret', iterations=1000)))
+        self.assertFalse(needs_rehash(hash_password('secret')))
+
+
+class LoginTest(ChatTestCase):
+    """ Login of users with hashes of current and first versions """
+    def setUp(self):
+        super(LoginTest, self).setUp()
+        self.db.db.new_user('old', md5('secret'))
+        self.db.db.new_user('new', hash_password('secret'))
+
+    def stored_hash(self, login):
+        return self.db.db.get_password_hash(login)
+
+    @gen_test
+    def test_md5_hash_is_replaced_on_login(self):
+        conn = yield self.connect()
+        yield self.read_until(conn, 'SERVER:You are connected')
+        answer = yield self.command(conn, '#login old secret')
+        self.assertEqual(answer, 'SERVER:You are logged in as &quot;old&quot;')
+        pass_hash = self.stored_hash('old')
+        self.assertTrue(pass_hash.startswith('pbkdf2_sha256$%d$' % passwords.ITERATIONS))
+        self.assertTrue(verify_password('secret', pass_hash))
+        self.assertTrue((yield self.db.is_correct_user('old', 'secret')))
+        self.assertEqual(self.stored_hash('old'), pass_hash)
+
+    @gen_test
+    def test_wrong_password_is_rejected(self):
+        conn = yield self.connect()
+        yield self.read_until(conn, 'SERVER:You are connected')
+        for login in ('old', 'new'):
+            pass_hash = self.stored_hash(login)
+            answer = yield self.command(conn, '#login %s Secret' % login)
+            self.assertEqual(answer, 'SERVER:Password incorrect')
+            # Hash is not replaced without correct password
+            self.assertEqual(self.stored_hash(login), pass_hash)
+        answer = yield self.command(conn, '#login nobody secret')
+        self.assertEqual(answer, 'SERVER:No such user')
+        answer = yield self.command(conn, '#login new secret')
+        self.assertEqual(answer, 'SERVER:You are logged in as &quot;new&quot;')
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisLoginTest(LoginTest):
+    def make_db(self):
+        return AsyncDBRedis(r=fakeredis.FakeRedis(decode_responses=True),
+                            hasher=PasswordHasher(0))
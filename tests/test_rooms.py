@@ -0,0 +1,80 @@
+# coding: utf-8
+import time
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from wschat.db import AsyncDBPython, Message
+from wschat.passwords import PasswordHasher
+from wschat.rooms import RoomManager
+
+
+class RoomManagerTest(AsyncTestCase):
+    def setUp(self):
+        super(RoomManagerTest, self).setUp()
+        self.rooms = RoomManager(idle_ttl=60, max_rooms=3, history_depth=3)
+        self.db = AsyncDBPython(hasher=PasswordHasher(0))
+        self.loads = []
+        get_room_history = self.db.get_room_history
+
+        def counted_get_room_history(room):
+            self.loads.append(room)
+            return get_room_history(room)
+        self.db.get_room_history = counted_get_room_history
+
+    def age(self, name, seconds):
+        """ Make room unused for seconds """
+        self.rooms.get(name).used = time.time() - seconds
+
+    def test_idle_rooms_are_evicted(self):
+        connection = object()
+        self.rooms.subscribe('a', connection)
+        self.rooms.get('b')
+        self.rooms.get('c')
+        for name in 'abc':
+            self.age(name, 120)
+        self.rooms.get('c')
+        self.assertEqual(self.rooms.evict(), 1)
+        # Room with subscriber and recently used one stay
+        self.assertEqual(sorted(name for name, room in self.rooms.items()), ['a', 'c'])
+        self.rooms.unsubscribe('a', connection)
+        self.age('a', 120)
+        self.assertEqual(self.rooms.evict(), 1)
+        self.assertNotIn('a', self.rooms)
+
+    def test_least_recently_used_idle_room_is_evicted_over_max_rooms(self):
+        self.rooms.subscribe('a', object())
+        self.rooms.get('b')
+        self.rooms.get('c')
+        self.rooms.get('b')
+        self.rooms.get('d')
+        self.assertEqual(len(self.rooms), 3)
+        self.assertNotIn('c', self.rooms)
+        self.assertIn('a', self.rooms)
+
+    def test_waiters_dont_create_room(self):
+        self.assertEqual(tuple(self.rooms.waiters('a')), ())
+        self.assertNotIn('a', self.rooms)
+
+    @gen_test
+    def test_history_is_loaded_once_and_updated_by_messages(self):
+        for n in range(5):
+            yield self.db.new_message('Free Chat', 'm%d' % n)
+        history = yield self.rooms.get_history('Free Chat', self.db)
+        self.assertEqual([x.text for x in history], ['m2', 'm3', 'm4'])
+        self.rooms.on_message('Free Chat', Message(6, time.time(), 'm5'))
+        history = yield self.rooms.get_history('Free Chat', self.db)
+        self.assertEqual([x.text for x in history], ['m3', 'm4', 'm5'])
+        self.assertEqual(self.loads, ['Free Chat'])
+
+    @gen_test
+    def test_history_is_loaded_again_after_eviction(self):
+        yield self.rooms.get_history('Free Chat', self.db)
+        self.age('Free Chat', 120)
+        self.rooms.evict()
+        yield self.rooms.get_history('Free Chat', self.db)
+        self.assertEqual(self.loads, ['Free Chat'] * 2)
+
+    @gen_test
+    def test_history_of_unknown_room(self):
+        history = yield self.rooms.get_history('No such room', self.db)
+        self.assertIsNone(history)
@@ -0,0 +1,158 @@
+# coding: utf-8
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+import unittest
+
+from wschat import server
+from wschat.db import redis
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Connections are forbidden, as in benchmarks/bench_startup.py
+IMPORT = """
+import socket, sys
+def connect(*args):
+    raise AssertionError('connection on import')
+socket.socket.connect = connect
+socket.socket.connect_ex = connect
+sys.path.insert(0, %r)
+import wschat.server
+""" % ROOT
+
+STARTUP = """
+import sys, time
+sys.path.insert(0, %r)
+start = time.time()
+from wschat import server
+db, bus = server.create_backends('memory')
+server.make_app(db, bus)
+print(time.time() - start)
+""" % ROOT
+
+
+def run(code):
+    """ Run code in fresh python process
+    :return: (exit code, output)
+    """
+    process = subprocess.Popen([sys.executable, '-c', code], stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT)
+    output = process.communicate()[0]
+    return process.returncode, output
+
+
+class StartupTest(unittest.TestCase):
+    # Seconds to import server and create application, it takes
+    # about 0.1 s, going to network or loading data would take more
+    budget = 1
+
+    def test_import_doesnt_connect(self):
+        code, output = run(IMPORT)
+        self.assertEqual(code, 0, output)
+
+    def test_application_is_created_in_budget(self):
+        code, output = run(STARTUP)
+        self.assertEqual(code, 0, output)
+        self.assertLess(float(output.split()[-1]), self.budget)
+
+
+class RecordsHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record.getMessage())
+
+
+class LogTestCase(unittest.TestCase):
+    """ Messages of log records are collected in self.log.records """
+    def setUp(self):
+        self.log = RecordsHandler()
+        logging.getLogger().addHandler(self.log)
+        self.addCleanup(logging.getLogger().removeHandler, self.log)
+
+
+class SelectBackendTest(LogTestCase):
+    def uninstall(self, name):
+        """ Server module works as if package is not installed """
+        self.addCleanup(setattr, server, name, getattr(server, name))
+        setattr(server, name, None)
+
+    def test_auto_prefers_disk_with_data_dir(self):
+        self.assertEqual(server.select_backend('auto', 'data'), 'disk')
+
+    def test_auto_falls_back_to_memory_without_redis_py(self):
+        self.uninstall('redis')
+        self.assertEqual(server.select_backend('auto'), 'memory')
+        self.assertEqual(self.log.records,
+                         ['redis-py is not installed, all data will be lost on restart'])
+
+    def test_auto_falls_back_to_memory_without_futures(self):
+        self.uninstall('ThreadPoolExecutor')
+        self.assertEqual(server.select_backend('auto'), 'memory')
+        self.assertIn('futures is not installed', self.log.records[0])
+
+    @unittest.skipIf(server.redis is None or server.ThreadPoolExecutor is None,
+                     'redis-py or futures is not installed')
+    def test_auto_selects_redis(self):
+        self.assertEqual(server.select_backend('auto'), 'redis')
+        self.assertEqual(self.log.records, [])
+
+    def test_wrong_backends(self):
+        self.uninstall('redis')
+        self.assertRaises(RuntimeError, server.select_backend, 'redis')
+        self.assertRaises(ValueError, server.select_backend, 'disk')
+        self.assertEqual(server.select_backend('memory'), 'memory')
+
+
+class FlakyRedis(object):
+    """ REDIS which is available after failures pings """
+    def __init__(self, failures):
+        self.failures = failures
+        self.pings = 0
+
+    def ping(self):
+        self.pings += 1
+        if self.pings <= self.failures:
+            raise redis.exceptions.ConnectionError('Connection refused')
+        return True
+
+
+@unittest.skipIf(redis is None, 'redis-py is not installed')
+class WaitForRedisTest(LogTestCase):
+    def connect_to(self, r):
+        """ REDIS of every url is r """
+        self.addCleanup(setattr, redis.Redis, 'from_url', redis.Redis.__dict__['from_url'])
+        redis.Redis.from_url = classmethod(lambda cls, url, **kwargs: r)
+
+    def test_connection_is_retried(self):
+        r = FlakyRedis(2)
+        self.connect_to(r)
+        server.wait_for_redis('redis://db:6379/0', retries=3, delay=0)
+        self.assertEqual(r.pings, 3)
+        self.assertEqual(len(self.log.records), 2)
+        self.assertIn('attempt 2 of 3', self.log.records[-1])
+
+    def test_error_after_retries(self):
+        # Nothing listens on free port
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        url = 'redis://127.0.0.1:%d/0' % sock.getsockname()[1]
+        sock.close()
+        start = time.time()
+        with self.assertRaises(RuntimeError) as context:
+            server.wait_for_redis(url, retries=3, delay=0.05)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        message = str(context.exception)
+        self.assertIn('REDIS at %s is not available after 3 attempts' % url, message)
+        self.assertEqual(len(self.log.records), 2)
+
+    def test_one_attempt_at_least(self):
+        r = FlakyRedis(1)
+        self.connect_to(r)
+        self.assertRaises(RuntimeError, server.wait_for_redis, 'redis://db:6379/0', retries=0)
+        self.assertEqual(r.pings, 1)
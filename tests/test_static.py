@@ -0,0 +1,122 @@
+# coding: utf-8
+import gzip
+import os
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+
+from tornado.testing import gen_test
+
+from wschat import server
+from wschat.server import MainHandler
+from wschat.static import PrecompressedStaticFileHandler, compress_static
+
+from .base import ChatTestCase
+
+
+class StaticTestCase(ChatTestCase):
+    """ Server of copies of templates and static files,
+        so test can change them
+    """
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        package = os.path.dirname(server.__file__)
+        for name in ('templates', 'static'):
+            shutil.copytree(os.path.join(package, name), os.path.join(self.path, name))
+        self.settings = dict(template_path=os.path.join(self.path, 'templates'),
+                             static_path=os.path.join(self.path, 'static'))
+        # Versions of templates are computed once per process
+        MainHandler._template_versions.clear()
+        self.addCleanup(MainHandler._template_versions.clear)
+        super(StaticTestCase, self).setUp()
+
+
+class IndexEtagTest(StaticTestCase):
+    @gen_test
+    def test_not_modified(self):
+        response = yield self.http_client.fetch(self.get_url('/'))
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+        # Page sets xsrf cookie, it has no Etag
+        self.assertNotIn('Etag', response.headers)
+        cookie = response.headers['Set-Cookie'].split(';')[0]
+        response = yield self.http_client.fetch(self.get_url('/'), headers={'Cookie': cookie})
+        etag = response.headers['Etag']
+        response = yield self.http_client.fetch(
+            self.get_url('/'), headers={'Cookie': cookie, 'If-None-Match': etag},
+            raise_error=False)
+        self.assertEqual(response.code, 304)
+        self.assertEqual(response.body, '')
+        # Other user (or xsrf cookie) gets new page
+        response = yield self.http_client.fetch(
+            self.get_url('/'), headers={'Cookie': '_xsrf=other', 'If-None-Match': etag})
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers['Etag'], etag)
+
+    @gen_test
+    def test_etag_changes_with_template(self):
+        headers = {'Cookie': '_xsrf=token'}
+        response = yield self.http_client.fetch(self.get_url('/'), headers=headers)
+        etag = response.headers['Etag']
+        with open(os.path.join(self.path, 'templates', 'index.html'), 'ab') as f:
+            f.write(b'<!-- changed -->\n')
+        # Server is restarted with new template
+        MainHandler._template_versions.clear()
+        headers['If-None-Match'] = etag
+        response = yield self.http_client.fetch(self.get_url('/'), headers=headers)
+        self.assertEqual(response.code, 200)
+        self.assertNotEqual(response.headers['Etag'], etag)
+
+
+class PrecompressedStaticTest(StaticTestCase):
+    def setUp(self):
+        super(PrecompressedStaticTest, self).setUp()
+        self.static_path = self.settings['static_path']
+        self.written = compress_static(self.static_path)
+
+    def read(self, name):
+        with open(os.path.join(self.static_path, name), 'rb') as f:
+            return f.read()
+
+    def fetch_js(self, **headers):
+        return self.http_client.fetch(self.get_url('/static/client.js?v=1'), headers=headers,
+                                      decompress_response=False)
+
+    def test_compressed_copies(self):
+        self.assertEqual(sorted(self.written), [os.path.join(self.static_path, x)
+                                                for x in ('client.js.gz', 'index.css.gz')])
+        # Small files are not compressed
+        self.assertEqual(compress_static(self.static_path, min_size=1024),
+                         [os.path.join(self.static_path, 'client.js.gz')])
+        with gzip.GzipFile(fileobj=StringIO(self.read('client.js.gz'))) as f:
+            self.assertEqual(f.read(), self.read('client.js'))
+
+    @gen_test
+    def test_gzip_is_sent_to_accepting_clients(self):
+        response = yield self.fetch_js(**{'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        # Type of original file
+        self.assertIn('javascript', response.headers['Content-Type'])
+        self.assertEqual(response.body, self.read('client.js.gz'))
+        self.assertEqual(response.headers['Cache-Control'],
+                         'public, max-age=%d, immutable' %
+                         PrecompressedStaticFileHandler.CACHE_MAX_AGE)
+        self.assertEqual(PrecompressedStaticFileHandler.CACHE_MAX_AGE, 31536000)
+
+    @gen_test
+    def test_original_is_sent_to_other_clients(self):
+        response = yield self.fetch_js()
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(response.body, self.read('client.js'))
+
+    @gen_test
+    def test_stale_copy_is_not_sent(self):
+        path = os.path.join(self.static_path, 'client.js')
+        mtime = time.time() + 10
+        os.utime(path, (mtime, mtime))
+        response = yield self.fetch_js(**{'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.body, self.read('client.js'))
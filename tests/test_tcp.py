@@ -0,0 +1,97 @@
+# coding: utf-8
+from tornado import gen
+from tornado.iostream import StreamClosedError
+from tornado.tcpclient import TCPClient
+from tornado.testing import bind_unused_port, gen_test
+
+from wschat.tcp import ChatTCPServer, LineConnection
+
+from .base import ChatTestCase
+
+
+class LineClient(object):
+    """ Client of line protocol with methods of WebSocket client
+        used by ChatTestCase helpers
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write_message(self, mess):
+        self.stream.write(mess.encode('utf-8') + b'\n')
+
+    @gen.coroutine
+    def read_message(self):
+        """ Line without '\n', None if connection is closed """
+        try:
+            line = yield self.stream.read_until(b'\n')
+        except StreamClosedError:
+            raise gen.Return(None)
+        raise gen.Return(line[:-1].decode('utf-8'))
+
+
+class TCPTest(ChatTestCase):
+    def setUp(self):
+        super(TCPTest, self).setUp()
+        sock, self.tcp_port = bind_unused_port()
+        self.tcp_server = ChatTCPServer(self.db, self.bus, self._app.settings,
+                                        io_loop=self.io_loop)
+        self.tcp_server.add_socket(sock)
+
+    def tearDown(self):
+        self.tcp_server.stop()
+        super(TCPTest, self).tearDown()
+
+    @gen.coroutine
+    def connect_tcp(self):
+        stream = yield TCPClient(io_loop=self.io_loop).connect('127.0.0.1', self.tcp_port)
+        client = LineClient(stream)
+        yield self.read_until(client, 'SERVER:You are connected')
+        raise gen.Return(client)
+
+    @gen_test
+    def test_messages_are_shared_with_websocket(self):
+        tcp = yield self.connect_tcp()
+        ws = yield self.connect()
+        yield self.read_until(ws, 'SERVER:You are connected')
+        yield self.login(tcp, 'bob')
+        answer = yield self.command(tcp, '#join room python developers')
+        self.assertIn('Python Developers', answer)
+        tcp.write_message(u'привет')
+        frame = yield ws.read_message()
+        self.assertRegexpMatches(frame, ur'^MESSAGE:\d+:\[Free Chat\] bob: привет$')
+        lines = yield self.read_until(tcp, 'MESSAGE:')
+        lines += yield self.read_until(tcp, 'MESSAGE:')
+        self.assertEqual(sorted(x.split(':', 2)[2] for x in lines),
+                         [u'[Free Chat] bob: привет', u'[Python Developers] bob: привет'])
+        # Line breaks of message are replaced in lines
+        ws.write_message(u'hello\nbob')
+        line = yield tcp.read_message()
+        self.assertRegexpMatches(line, r'^MESSAGE:\d+:\[Free Chat\] Anonymous: hello bob$')
+
+    @gen_test
+    def test_lines_of_partial_reads(self):
+        tcp = yield self.connect_tcp()
+        data = u'первое\r\n#log'.encode('utf-8')
+        # Parts end in the middle of utf-8 character and of line
+        for part in (data[:3], data[3:13], data[13:], b'out\n'):
+            tcp.stream.write(part)
+            yield gen.sleep(0.01)
+        frame = yield tcp.read_message()
+        self.assertRegexpMatches(frame, ur'^MESSAGE:\d+:\[Free Chat\] Anonymous: первое$')
+        self.assertEqual((yield tcp.read_message()), 'SERVER:You are logged out')
+
+    @gen_test
+    def test_overlong_line_closes_connection(self):
+        tcp = yield self.connect_tcp()
+        other = yield self.connect_tcp()
+        tcp.stream.write(b'x' * (LineConnection.max_line_size + 1))
+        self.assertIsNone((yield tcp.read_message()))
+        # Other connections are served
+        answer = yield self.command(other, '#logout')
+        self.assertEqual(answer, 'SERVER:You are logged out')
+
+    @gen_test
+    def test_wrong_encoding(self):
+        tcp = yield self.connect_tcp()
+        tcp.stream.write(b'\xff\xfe\n')
+        self.assertEqual((yield tcp.read_message()), 'SERVER:Wrong encoding, utf-8 expected')
@@ -0,0 +1,67 @@
+# coding: utf-8
+import time
+import unittest
+
+from tornado.testing import AsyncTestCase, gen_test
+
+from wschat.db import AsyncDBPython, TTLCache
+from wschat.passwords import PasswordHasher
+
+
+class TTLCacheTest(unittest.TestCase):
+    def test_values_expire(self):
+        cache = TTLCache(ttl=0.05)
+        cache.set('bob', True)
+        self.assertTrue(cache.get('bob'))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('bob'))
+
+    def test_least_recently_used_is_dropped(self):
+        cache = TTLCache(maxsize=2)
+        cache.set('bob', True)
+        cache.set('alice', True)
+        cache.get('bob')
+        cache.set('carol', True)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('alice'))
+        self.assertTrue(cache.get('bob'))
+
+
+class UserCacheTest(AsyncTestCase):
+    """ Cache of user_exists """
+    def setUp(self):
+        super(UserCacheTest, self).setUp()
+        self.db = AsyncDBPython(hasher=PasswordHasher(0))
+        self.calls = []
+        get_password_hash = self.db.db.get_password_hash
+
+        def counted(login):
+            self.calls.append(login)
+            return get_password_hash(login)
+        self.db.db.get_password_hash = counted
+
+    @gen_test
+    def test_existing_user_is_cached(self):
+        self.db.db.new_user('bob', 'hash')
+        self.assertTrue((yield self.db.user_exists('bob')))
+        self.assertTrue((yield self.db.user_exists('bob')))
+        self.assertEqual(self.calls, ['bob'])
+
+    @gen_test
+    def test_unknown_user_is_not_cached(self):
+        self.assertFalse((yield self.db.user_exists('bob')))
+        self.assertNotIn('bob', self.db.users._data)
+        # User is created by another server process
+        self.db.db.new_user('bob', 'hash')
+        self.assertTrue((yield self.db.user_exists('bob')))
+        self.assertEqual(self.calls, ['bob', 'bob'])
+
+    @gen_test
+    def test_cache_is_updated_by_new_user_and_login(self):
+        yield self.db.new_user('bob', 'pw')
+        self.assertTrue((yield self.db.user_exists('bob')))
+        self.db.users.clear()
+        self.assertTrue((yield self.db.is_correct_user('bob', 'pw')))
+        del self.calls[:]
+        self.assertTrue((yield self.db.user_exists('bob')))
+        self.assertEqual(self.calls, [])
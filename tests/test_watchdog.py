@@ -0,0 +1,69 @@
+# coding: utf-8
+import json
+import logging
+import time
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from wschat.watchdog import LagWatchdog, LOOP_LAG, LOOP_STALLS
+
+
+class SlowHandler(object):
+    """ Handler running blocking command """
+    def recognize_command(self, command):
+        return self.user_command_slow()
+
+    def user_command_slow(self):
+        time.sleep(0.3)
+
+
+class RecordsHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class LagWatchdogTest(AsyncTestCase):
+    def setUp(self):
+        super(LagWatchdogTest, self).setUp()
+        self.watchdog = LagWatchdog(threshold=0.1, interval=0.02, handlers=(SlowHandler,))
+        self.watchdog.start()
+        self.addCleanup(self.watchdog.stop)
+        self.log = RecordsHandler()
+        logging.getLogger().addHandler(self.log)
+        self.addCleanup(logging.getLogger().removeHandler, self.log)
+
+    def stalls(self):
+        return [x for x in self.log.records if 'IOLoop was blocked' in x.getMessage()]
+
+    @gen_test
+    def test_blocked_loop_is_reported(self):
+        stalls = LOOP_STALLS.labels('SlowHandler', 'user_command_slow', 'slow').value
+        lag = LOOP_LAG.labels()
+        yield gen.sleep(0.1)
+        self.assertEqual(self.stalls(), [])
+        count, total = sum(lag.counts), lag.sum
+        self.io_loop.add_callback(SlowHandler().recognize_command, 'slow')
+        yield gen.sleep(0.1)
+        record, = self.stalls()
+        self.assertEqual(record.levelno, logging.WARNING)
+        stall = json.loads(record.getMessage().split(': ', 1)[1])
+        self.assertEqual(stall['event'], 'ioloop_stall')
+        self.assertGreaterEqual(stall['lag'], 0.2)
+        self.assertEqual((stall['handler'], stall['method'], stall['command']),
+                         ('SlowHandler', 'user_command_slow', 'slow'))
+        self.assertIn('user_command_slow', stall['stack'][-1])
+        self.assertEqual(LOOP_STALLS.labels('SlowHandler', 'user_command_slow', 'slow').value,
+                         stalls + 1)
+        self.assertGreater(sum(lag.counts), count)
+        self.assertGreaterEqual(lag.sum - total, 0.2)
+
+    @gen_test
+    def test_short_block_is_not_reported(self):
+        self.io_loop.add_callback(time.sleep, 0.05)
+        yield gen.sleep(0.15)
+        self.assertEqual(self.stalls(), [])
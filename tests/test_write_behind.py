@@ -0,0 +1,117 @@
+# coding: utf-8
+import unittest
+
+from tornado import gen
+from tornado.testing import AsyncTestCase, gen_test
+
+from wschat.db import AsyncDBPython, AsyncDBRedis, WriteBehind
+from wschat.passwords import PasswordHasher
+
+from .base import fakeredis
+
+
+ROOM = 'Free Chat'
+
+
+class WriteBehindTest(AsyncTestCase):
+    id_block = 100
+
+    def make_db(self, write_behind):
+        return AsyncDBPython(hasher=PasswordHasher(0), write_behind=write_behind)
+
+    def setUp(self):
+        super(WriteBehindTest, self).setUp()
+        self.write_behind = WriteBehind(id_block=self.id_block, retry_delay=0.01)
+        self.adb = self.make_db(self.write_behind)
+        self.db = self.adb.db
+        self.first_id = self.db.reserve_ids(ROOM, 1) + 1
+        # Count reservations and saves of messages
+        self.reserved = []
+        self.saved = []
+        reserve_ids, add_messages = self.db.reserve_ids, self.db.add_messages
+
+        def counted_reserve_ids(room, count):
+            self.reserved.append(count)
+            return reserve_ids(room, count)
+
+        def counted_add_messages(messages):
+            self.saved.append(len(messages))
+            return add_messages(messages)
+        self.db.reserve_ids = counted_reserve_ids
+        self.db.add_messages = counted_add_messages
+
+    def stored_ids(self):
+        return [x.id for x in self.db.get_messages(ROOM, limit=1000)]
+
+    @gen_test
+    def test_ids_are_reserved_by_blocks(self):
+        messages = []
+        for n in range(250):
+            message = yield self.adb.new_message(ROOM, 'm%d' % n)
+            messages.append(message)
+        ids = [x.id for x in messages]
+        self.assertEqual(ids, range(self.first_id, self.first_id + 250))
+        self.assertEqual(self.reserved, [self.id_block] * 3)
+
+    @gen_test
+    def test_concurrent_messages_wait_for_one_block(self):
+        messages = yield [self.adb.new_message(ROOM, 'm%d' % n) for n in range(10)]
+        self.assertEqual(sorted(x.id for x in messages),
+                         range(self.first_id, self.first_id + 10))
+        self.assertEqual(self.reserved, [self.id_block])
+
+    @gen_test
+    def test_drain_saves_buffer_in_one_batch(self):
+        # Buffer is not flushed by timer during test
+        self.write_behind.delay = 60
+        messages = []
+        for n in range(5):
+            message = yield self.adb.new_message(ROOM, 'm%d' % n)
+            messages.append(message)
+        # Published, but not saved yet
+        self.assertEqual(self.saved, [])
+        yield self.adb.drain()
+        self.assertEqual(self.saved, [5])
+        self.assertEqual(self.stored_ids()[-5:], [x.id for x in messages])
+
+    @gen_test
+    def test_history_waits_for_buffered_messages(self):
+        message = yield self.adb.new_message(ROOM, 'text')
+        history = yield self.adb.get_messages(ROOM, limit=1)
+        self.assertEqual(history, [message])
+
+    @gen_test
+    def test_failed_flush_is_retried(self):
+        add_messages = self.db.add_messages
+        failures = [1]
+
+        def failing_add_messages(messages):
+            if failures:
+                failures.pop()
+                raise IOError('DataBase is not available')
+            return add_messages(messages)
+        self.db.add_messages = failing_add_messages
+        message = yield self.adb.new_message(ROOM, 'text')
+        yield self.adb.drain()
+        self.assertEqual(failures, [])
+        self.assertEqual(self.stored_ids()[-1], message.id)
+
+    @gen_test
+    def test_new_messages_wait_when_too_many_pending(self):
+        self.write_behind.max_pending = 3
+        for n in range(7):
+            yield self.adb.new_message(ROOM, 'm%d' % n)
+        yield gen.moment
+        self.assertTrue(all(x <= 3 for x in self.saved))
+        yield self.adb.drain()
+        self.assertEqual(sum(self.saved), 7)
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisWriteBehindTest(WriteBehindTest):
+    """ Calls of REDIS go to threads, so reservation of
+        ids is really concurrent
+    """
+    def make_db(self, write_behind):
+        return AsyncDBRedis(r=fakeredis.FakeRedis(decode_responses=True), hasher=PasswordHasher(0),
+                            write_behind=write_behind)
@@ -1 +1,4 @@
-from .server import run as run_server
+def run_server(*args, **kwargs):
+    """ server.run, server module is imported on call only """
+    from .server import run
+    return run(*args, **kwargs)
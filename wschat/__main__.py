@@ -0,0 +1,10 @@
+# coding: utf-8
+""" Start server: python -m wschat [options], see config.py """
+import sys
+
+from .config import parse_args
+from .server import run
+
+
+if __name__ == '__main__':
+    run(**parse_args(sys.argv[1:]))
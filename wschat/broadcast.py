@@ -0,0 +1,196 @@
+# coding: utf-8
+import collections
+import struct
+import time
+import zlib
+
+import tornado.escape
+from tornado.iostream import StreamClosedError
+
+from .metrics import COMPRESSION_BYTES_IN, COMPRESSION_BYTES_OUT, COMPRESSION_SECONDS
+
+
+FIN = 0x80
+RSV1 = 0x40
+OPCODE_TEXT = 0x1
+
+# Slow consumer policies
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+DISCONNECT = 'disconnect'
+
+
+def build_frame(data, opcode=OPCODE_TEXT, flags=0):
+    """ Build server side (not masked) WebSocket frame
+        (RFC 6455, section 5.2) with whole message inside.
+    :param data: bytes of message payload
+    :param opcode: frame opcode, text frame by default
+    :param flags: additional bits of first byte (RSV1 etc.)
+    :return: bytes of frame ready to be written into stream
+    """
+    l = len(data)
+    if l < 126:
+        header = struct.pack('!BB', FIN | opcode | flags, l)
+    elif l <= 0xFFFF:
+        header = struct.pack('!BBH', FIN | opcode | flags, 126, l)
+    else:
+        header = struct.pack('!BBQ', FIN | opcode | flags, 127, l)
+    return header + data
+
+
+class PreparedMessage(object):
+    """ Text message which was encoded and framed only once,
+        so the same bytes may be written to any number of
+        connections without per connection work.
+    """
+    __slots__ = ('text', 'data', 'frame', '_line')
+
+    def __init__(self, text):
+        self.text = text
+        self.data = tornado.escape.utf8(text)
+        self.frame = build_frame(self.data)
+        self._line = None
+
+    @property
+    def line(self):
+        """ Message as one line of line protocol (see tcp.py),
+            built on first use. Line breaks inside of message
+            are replaced with spaces.
+        """
+        if self._line is None:
+            self._line = self.data.replace(b'\r', b' ').replace(b'\n', b' ') + b'\n'
+        return self._line
+
+    def __len__(self):
+        """ Size of shared frame, when message waits in OutboundQueue """
+        return len(self.frame)
+
+
+class DeflateCompressor(object):
+    """ Compressor of permessage-deflate extension (RFC 7692)
+        with tunable compression level and memory level.
+        Messages shorter than min_size are not compressed: extension
+        allows to send any message without compression, so such
+        messages use shared frame of PreparedMessage.
+    """
+    def __init__(self, min_size=1024, level=6, mem_level=8, max_wbits=zlib.MAX_WBITS,
+                 persistent=True):
+        """ :param min_size: min size of message payload to compress
+            :param level: zlib compression level, 1-9
+            :param mem_level: zlib memory level, 1-9
+            :param max_wbits: negotiated window bits
+            :param persistent: False if context takeover is
+                disabled (new context for each message)
+        """
+        self.min_size = min_size
+        self.level = level
+        self.mem_level = mem_level
+        self.max_wbits = max_wbits
+        self._compressor = self._create_compressor() if persistent else None
+
+    def _create_compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, -self.max_wbits, self.mem_level)
+
+    def compress(self, data):
+        """ Compressed payload of message """
+        start = time.time()
+        compressor = self._compressor or self._create_compressor()
+        compressed = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        # Tail of sync flush is not sent (RFC 7692, section 7.2.1)
+        compressed = compressed[:-4]
+        COMPRESSION_SECONDS.inc(time.time() - start)
+        COMPRESSION_BYTES_IN.inc(len(data))
+        COMPRESSION_BYTES_OUT.inc(len(compressed))
+        return compressed
+
+    def frame(self, mess):
+        """ Frame of PreparedMessage for connection:
+            compressed one or shared one for short messages
+        """
+        if len(mess.data) < self.min_size:
+            return mess.frame
+        return build_frame(self.compress(mess.data), flags=RSV1)
+
+
+class OutboundQueue(object):
+    """ Bounded queue of frames waiting to be written to one connection.
+
+        While stream has nothing buffered frames are written right away.
+        Otherwise they wait in queue until stream drains its buffer and
+        then are written all together with one write. If queue is full,
+        policy decides what to do with the new frame:
+          DROP_OLDEST: forget the oldest queued frame, queue the new one
+          DROP_NEWEST: forget the new frame
+          DISCONNECT: forget all queued frames and call on_overflow
+
+        If encode is given, queue keeps items (e.g. PreparedMessage)
+        and encode builds bytes of item right before it is written.
+        Frames compressed with context takeover depend on all frames
+        written before them, so they must be built in order of writing
+        and only for frames which are not dropped.
+    """
+    policies = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+    def __init__(self, stream, maxsize=256, policy=DROP_OLDEST, on_overflow=None, encode=None):
+        if policy not in self.policies:
+            raise ValueError('Unknown slow consumer policy "%s"' % policy)
+        if maxsize < 1:
+            raise ValueError('Queue size must be positive')
+        self.stream = stream
+        self.maxsize = maxsize
+        self.policy = policy
+        self.on_overflow = on_overflow
+        self.encode = encode
+        self.dropped = 0
+        self._frames = collections.deque()
+
+    @property
+    def depth(self):
+        """ Number of frames waiting for stream """
+        return len(self._frames)
+
+    @property
+    def size(self):
+        """ Bytes waiting in queue and in write buffer of stream """
+        buffered = getattr(self.stream, '_write_buffer', None) or ()
+        return sum(len(x) for x in self._frames) + sum(len(x) for x in buffered)
+
+    def put(self, frame):
+        """ Write frame to stream or queue it
+        :param frame: bytes of WebSocket frame, or item of encode
+        :return:
+            True: frame was written or queued
+            False: frame was dropped
+        """
+        if self.stream.closed():
+            raise StreamClosedError()
+        if not self._frames:
+            if not self.stream.writing():
+                self.stream.write(self._encode(frame))
+                return True
+            # Wait until stream drains. Callback (not future) is used,
+            # because any other write to stream orphans previous future
+            self.stream.write(b'', callback=self._flush)
+        elif len(self._frames) >= self.maxsize:
+            self.dropped += 1
+            if self.policy == DROP_NEWEST:
+                return False
+            elif self.policy == DISCONNECT:
+                self._frames.clear()
+                if self.on_overflow is not None:
+                    self.on_overflow()
+                return False
+            self._frames.popleft()
+        self._frames.append(frame)
+        return True
+
+    def _flush(self):
+        """ Called when stream wrote all buffered data """
+        if not self._frames or self.stream.closed():
+            return
+        data = b''.join(self._encode(x) for x in self._frames)
+        self._frames.clear()
+        self.stream.write(data)
+
+    def _encode(self, frame):
+        return frame if self.encode is None else self.encode(frame)
@@ -0,0 +1,133 @@
+# coding: utf-8
+import json
+import logging
+import threading
+import time
+import uuid
+
+from abc import ABCMeta, abstractmethod
+
+from tornado.ioloop import IOLoop
+
+from .db import redis, ThreadPoolExecutor
+
+
+class Bus(object):
+    """ Fanout bus of room events.
+        Event published by any server process is delivered to
+        subscribers of every process (including publisher itself).
+        Event is (kind, room, data), where data is json serializable:
+          'message', room, db.Message - new message in room
+          'join', room, [login, nick] - user joined room
+          'left', room, [login, nick] - user left room
+          'nick', room, [login, nick] - user changed nick in room
+          'room_created', room, None - new room was created
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self):
+        self._subscribers = list()
+
+    def subscribe(self, callback):
+        """ Call callback(kind, room, data) on every event """
+        self._subscribers.append(callback)
+
+    def start(self):
+        """ Start receiving events of other processes """
+        pass
+
+    def close(self):
+        pass
+
+    @abstractmethod
+    def publish(self, kind, room, data):
+        """ Publish event to subscribers of all processes """
+        pass
+
+    def _deliver(self, kind, room, data):
+        for callback in self._subscribers:
+            try:
+                callback(kind, room, data)
+            except Exception:
+                logging.exception('Error while delivering "%s" event of room "%s"', kind, room)
+
+
+class LocalBus(Bus):
+    """ Bus of one process: events are delivered
+        to subscribers right away.
+    """
+    def publish(self, kind, room, data):
+        self._deliver(kind, room, data)
+
+
+class RedisBus(Bus):
+    """ Bus over REDIS pub/sub, all processes use one channel.
+        Events are delivered to subscribers of own process right
+        away, without REDIS round trip, and are published in
+        background thread (publish doesn't block IOLoop). Events of
+        other processes are received by listening thread and passed
+        to IOLoop.
+    """
+    reconnect_delay = 1
+
+    def __init__(self, r=None, channel='RamblerTaskChat:BUS'):
+        """ :param r: redis.Redis compatible client, decoding responses
+                (see db.DBRedis), by default connection to localhost
+                is created
+            :param channel: pub/sub channel name
+        """
+        super(RedisBus, self).__init__()
+        if ThreadPoolExecutor is None:
+            raise RuntimeError('RedisBus requires concurrent.futures ("futures" package)')
+        self.r = redis.Redis(decode_responses=True) if r is None else r
+        self.channel = channel
+        # Events published by this bus are skipped by listener
+        self.origin = uuid.uuid4().hex
+        # One thread keeps order of published events
+        self._executor = ThreadPoolExecutor(1)
+        self._pubsub = None
+        self._closed = False
+        self.io_loop = None
+
+    def start(self):
+        """ Start listening thread. Must be called from
+            IOLoop thread (after fork, if processes are forked)
+        """
+        self.io_loop = IOLoop.current()
+        self._pubsub = self.r.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(self.channel)
+        thread = threading.Thread(target=self._listen, name='RedisBus')
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self._closed = True
+        if self._pubsub is not None:
+            self._pubsub.close()
+        self._executor.shutdown(wait=False)
+
+    def publish(self, kind, room, data):
+        self._deliver(kind, room, data)
+        event = json.dumps(dict(origin=self.origin, kind=kind, room=room, data=data))
+        return self._executor.submit(self.r.publish, self.channel, event)
+
+    def _listen(self):
+        while not self._closed:
+            try:
+                for item in self._pubsub.listen():
+                    self._receive(item['data'])
+            except redis.exceptions.ConnectionError:
+                if self._closed:
+                    return
+                logging.warning('RedisBus lost connection to REDIS, reconnecting')
+                time.sleep(self.reconnect_delay)
+
+    def _receive(self, event):
+        try:
+            event = json.loads(event)
+        except ValueError:
+            logging.warning('RedisBus received broken event: %r', event)
+            return
+        if event.get('origin') == self.origin:
+            return
+        self.io_loop.add_callback(self._deliver, event['kind'], event['room'], event['data'])
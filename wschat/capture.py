@@ -0,0 +1,106 @@
+# coding: utf-8
+import itertools
+import json
+import struct
+import time
+
+from tornado.escape import utf8, to_unicode
+from tornado.ioloop import PeriodicCallback
+
+
+OPEN, MESSAGE, CLOSE = 1, 2, 3
+# time, connection id, event, length of payload
+_header = struct.Struct('<dIBI')
+# Passwords are not written, replayer uses this one
+PASSWORD = '*'
+_password_commands = ('#login', '#register')
+
+
+def redact(mess):
+    """ Replace password in login and register commands """
+    words = mess.split(None, 2)
+    if words and words[0].lower() in _password_commands and len(words) == 3:
+        return u'%s %s %s' % (words[0], words[1], PASSWORD)
+    return mess
+
+
+def captured_users(events):
+    """ Logins of users of captured traffic: logged in by cookie
+        or by login and register commands
+    :param events: iterable of events (see read_capture)
+    :return: set of logins
+    """
+    users = set()
+    for timestamp, conn, event, payload in events:
+        if event == OPEN:
+            users.add(json.loads(payload)['user'])
+        elif event == MESSAGE:
+            words = payload.split(None, 2)
+            if words and words[0].lower() in _password_commands and len(words) == 3:
+                users.add(words[1])
+    users.discard(None)
+    return users
+
+
+class CaptureWriter(object):
+    """ Append-only file of connection events.
+        Every record is a binary header (time, connection id, event,
+        length) and utf-8 payload:
+          OPEN - json {"user": login of cookie or null}
+          MESSAGE - received frame
+          CLOSE - empty
+        File is written through buffer, which is flushed to disk once
+        per flush_interval seconds and on close.
+    """
+    def __init__(self, path, flush_interval=1):
+        """ :param path: capture file, appended if exists
+            :param flush_interval: seconds between flushes
+        """
+        self.path = path
+        self._file = open(path, 'ab')
+        self._ids = itertools.count(1)
+        self._flusher = PeriodicCallback(self.flush, flush_interval * 1000)
+        self._flusher.start()
+
+    def _write(self, conn, event, payload=b''):
+        payload = utf8(payload)
+        self._file.write(_header.pack(time.time(), conn, event, len(payload)) + payload)
+
+    def open(self, user=None):
+        """ Write opening of connection
+        :param user: login from cookie
+        :return: id of connection for next events
+        """
+        conn = next(self._ids)
+        self._write(conn, OPEN, json.dumps(dict(user=user)))
+        return conn
+
+    def message(self, conn, mess):
+        self._write(conn, MESSAGE, redact(mess))
+
+    def close(self, conn):
+        self._write(conn, CLOSE)
+
+    def flush(self):
+        self._file.flush()
+
+    def shutdown(self):
+        self._flusher.stop()
+        self._file.close()
+
+
+def read_capture(path):
+    """ Iterate events of capture file
+    :return: iterator of (time, connection id, event, payload)
+    """
+    with open(path, 'rb') as f:
+        while True:
+            header = f.read(_header.size)
+            if len(header) < _header.size:
+                # End of file or record which was not flushed completely
+                return
+            timestamp, conn, event, length = _header.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            yield timestamp, conn, event, to_unicode(payload)
@@ -0,0 +1,103 @@
+# coding: utf-8
+import argparse
+import json
+
+
+# Options of server.run, see server.main
+DEFAULTS = dict(
+    host='localhost',
+    port=8080,
+    processes=1,
+    reuse_port=False,
+    tcp_port=None,
+    lag_threshold=None,
+    capture=None,
+    # auto, redis, disk or memory
+    backend='auto',
+    redis_url='redis://localhost:6379/0',
+    redis_pool_size=10,
+    redis_retries=5,
+    redis_retry_delay=1,
+    data_dir=None,
+    history_size=1000,
+    history_ttl=None,
+    room_idle_ttl=300,
+    max_rooms=1000,
+    # Connections, see server.app_settings
+    outbound_queue_size=256,
+    # drop_oldest, drop_newest or disconnect
+    outbound_policy='drop_oldest',
+    resume_limit=100,
+    compression=True,
+    compression_min_size=1024,
+    compression_level=6,
+    compression_mem_level=8,
+)
+BACKENDS = ('auto', 'redis', 'disk', 'memory')
+# Slow consumer policies, see broadcast.OutboundQueue
+POLICIES = ('drop_oldest', 'drop_newest', 'disconnect')
+
+
+def load_config(path):
+    """ Read options from json file
+    :param path: file with json object of options (see DEFAULTS)
+    :return: dict of options
+    """
+    with open(path) as f:
+        config = json.load(f)
+    unknown = set(config) - set(DEFAULTS)
+    if unknown:
+        raise ValueError('Unknown options in %s: %s' % (path, ', '.join(sorted(unknown))))
+    return config
+
+
+def parse_args(argv=None):
+    """ Options of server from command line and config file.
+        Options given in command line overwrite the ones of file,
+        which overwrite defaults.
+    :param argv: arguments of command line
+    :return: dict of options for server.run
+    """
+    parser = argparse.ArgumentParser(prog='python -m wschat', description='WebSocket chat server',
+                                     argument_default=argparse.SUPPRESS)
+    parser.add_argument('--config', help='json file of options, named as flags with "_"')
+    parser.add_argument('--host')
+    parser.add_argument('--port', type=int)
+    parser.add_argument('--processes', type=int, help='0 - one per CPU')
+    parser.add_argument('--reuse-port', action='store_true', default=argparse.SUPPRESS)
+    parser.add_argument('--tcp-port', type=int, help='port of line protocol')
+    parser.add_argument('--lag-threshold', type=float, help='report IOLoop stalls, seconds')
+    parser.add_argument('--capture', help='file to capture WebSocket traffic to')
+    parser.add_argument('--backend', choices=BACKENDS,
+                        help='auto - disk if --data-dir is given, redis if redis-py is installed, '
+                             'memory otherwise')
+    parser.add_argument('--redis-url', help='e.g. redis://localhost:6379/0')
+    parser.add_argument('--redis-pool-size', type=int, help='REDIS connections of process')
+    parser.add_argument('--redis-retries', type=int, help='attempts to connect to REDIS on start')
+    parser.add_argument('--redis-retry-delay', type=float, help='seconds between attempts')
+    parser.add_argument('--data-dir', help='directory of disk backend')
+    parser.add_argument('--history-size', type=int, help='messages stored per room')
+    parser.add_argument('--history-ttl', type=float, help='max age of stored messages, seconds')
+    parser.add_argument('--room-idle-ttl', type=float,
+                        help='seconds to keep state of room without subscribers')
+    parser.add_argument('--max-rooms', type=int,
+                        help='number of rooms, over which idle ones are dropped')
+    parser.add_argument('--outbound-queue-size', type=int,
+                        help='frames per connection waiting for slow client')
+    parser.add_argument('--outbound-policy', choices=POLICIES,
+                        help='what to do when queue of slow client is full')
+    parser.add_argument('--resume-limit', type=int,
+                        help='max missed messages per room sent on reconnect')
+    parser.add_argument('--no-compression', dest='compression', action='store_false',
+                        default=argparse.SUPPRESS, help='disable permessage-deflate')
+    parser.add_argument('--compression-min-size', type=int,
+                        help='shorter messages are not compressed, bytes')
+    parser.add_argument('--compression-level', type=int, help='zlib level, 1-9')
+    parser.add_argument('--compression-mem-level', type=int, help='zlib memory level, 1-9')
+    args = vars(parser.parse_args(argv))
+    config = dict(DEFAULTS)
+    path = args.pop('config', None)
+    if path is not None:
+        config.update(load_config(path))
+    config.update(args)
+    return config
@@ -1,16 +1,75 @@
-import hashlib
 import collections
 import json
+import logging
+import time
 
 from abc import ABCMeta, abstractmethod, abstractproperty
 
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+
+from .metrics import DB_LATENCY, WRITE_BEHIND_FLUSH, WRITE_BEHIND_BATCH, WRITE_BEHIND_BUFFERED
+from .passwords import PasswordHasher, needs_rehash
+
 try:
     import redis
 except ImportError:
     redis = None
 
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    # python 2.7 without "futures" backport
+    ThreadPoolExecutor = None
+
 
 UserRecord = collections.namedtuple('UserRecord', "pass_hash allowed_rooms current_rooms")
+# Message of room history. id increases monotonically in each room
+Message = collections.namedtuple('Message', "id time text")
+
+
+class RoomRegistry(object):
+    """ Case-insensitive index of room names.
+        Maps lowercase room name to its right writing,
+        so room is found by any writing in O(1).
+    """
+    def __init__(self, rooms=()):
+        self._rooms = dict()
+        self.update(rooms)
+
+    def add(self, room):
+        """ Add room to registry
+        :param room: room name
+        :return:
+            False: if room with such name (in any case) already exists
+            True: after adding
+        """
+        key = room.lower()
+        if key in self._rooms:
+            return False
+        self._rooms[key] = room
+        return True
+
+    def update(self, rooms):
+        for room in rooms:
+            self.add(room)
+
+    def resolve(self, name):
+        """ Return right writing of room name
+        :param name: room name in any case
+        :return: room name or None if room doesn't exist
+        """
+        return self._rooms.get(name.lower())
+
+    def __contains__(self, name):
+        return name.lower() in self._rooms
+
+    def __iter__(self):
+        return iter(self._rooms.values())
+
+    def __len__(self):
+        return len(self._rooms)
 
 
 class DB(object):
@@ -18,17 +77,32 @@ class DB(object):
 
     _default_rooms = ('Free Chat', 'Python Developers', 'JavaScript Developers')
     _default_room = _default_rooms[0]
+    # Number of last messages returned by get_room_history
+    _history_depth = 10
+
+    def __init__(self, history_size=1000, history_ttl=None):
+        """ :param history_size: max number of messages stored per room
+            :param history_ttl: max age of stored messages in seconds,
+                None - messages are limited by number only
+        """
+        if history_size < self._history_depth:
+            raise ValueError('History size must be at least %d' % self._history_depth)
+        self.history_size = history_size
+        self.history_ttl = history_ttl
 
     @abstractmethod
-    def is_correct_user(self, login, password):
-        """ Check if passed login is in base and password is correct
+    def get_password_hash(self, login):
+        """ Stored hash of user password (see passwords.py)
+        :param login: user login
+        :return: hash or None if login not in database
+        """
+        pass
 
-        :param login: passed login
-        :param password: passed password (not hash)
-        :return:
-            None: if login not in database
-            True: if login in database and password is correct
-            False: if login in database but password is not correct
+    @abstractmethod
+    def set_password_hash(self, login, pass_hash):
+        """ Replace stored hash of user password
+        :param login: user login
+        :param pass_hash: new hash
         """
         pass
 
@@ -65,7 +139,28 @@ class DB(object):
         :param room: room name
         :return:
             None: if room doesn't exists
-            list: last 10 messages in room
+            list: last 10 messages (Message) in room
+        """
+        pass
+
+    @abstractmethod
+    def get_messages(self, room, before=None, limit=10):
+        """ Return page of room history
+        :param room: room name
+        :param before: return messages with id less than before,
+            None - return last messages
+        :param limit: max number of messages
+        :return: list of Message, from older to newer
+        """
+        pass
+
+    @abstractmethod
+    def get_messages_since(self, room, since, limit=10):
+        """ Return page of room history, starting from message id
+        :param room: room name
+        :param since: return messages with id not less than since
+        :param limit: max number of messages
+        :return: list of Message, from older to newer
         """
         pass
 
@@ -88,10 +183,18 @@ class DB(object):
         pass
 
     @abstractmethod
-    def new_user(self, login, password):
+    def get_current_nicks(self, login):
+        """ Return current rooms of user with his nickname in each
+        :param login: user login
+        :return: list/tuple of (room, nickname) pairs
+        """
+        pass
+
+    @abstractmethod
+    def new_user(self, login, pass_hash):
         """ Create new user
         :param login: passed login
-        :param password: passed password
+        :param pass_hash: hash of passed password (see passwords.py)
         :return:
             None: if user already exists
             list: default allowed rooms
@@ -110,10 +213,41 @@ class DB(object):
 
     @abstractmethod
     def new_message(self, room, mess):
-        """ Save new message into room history
+        """ Save new message into room history.
+            History keeps last history_size messages
+            not older than history_ttl
         :param room: room name
         :param mess: message
-        :return: None
+        :return: saved Message with new id
+        """
+        pass
+
+    @abstractmethod
+    def reserve_ids(self, room, count):
+        """ Reserve block of message ids in room for messages,
+            which are saved later by add_messages
+        :param room: room name
+        :param count: number of ids
+        :return: the first id of block
+        """
+        pass
+
+    @abstractmethod
+    def add_messages(self, messages):
+        """ Save messages with reserved ids into room histories
+            at once (see new_message)
+        :param messages: list of (room, Message), ids of room
+            messages go in increasing order
+        """
+        pass
+
+    @abstractmethod
+    def resolve_room(self, room):
+        """ Find room by name in any case
+        :param room: room name in any case
+        :return:
+            None: if room doesn't exists
+            str: room name in right writing
         """
         pass
 
@@ -134,23 +268,28 @@ class DB(object):
 
 
 class DBPython(DB):
-    def __init__(self):
+    def __init__(self, history_size=1000, history_ttl=None):
+        super(DBPython, self).__init__(history_size, history_ttl)
         self._users = dict()
         self._rooms = dict()
+        self._last_ids = dict()
+        self._registry = RoomRegistry()
         for room in self.default_rooms:
-            self._rooms[room] = list()
+            self.new_room(room)
 
-    def is_correct_user(self, login, password):
+    def get_password_hash(self, login):
         user = self._users.get(login, None)
-        if user is None:
-            return
-        return hashlib.md5(password).hexdigest() == user.pass_hash
+        return user.pass_hash if user is not None else None
+
+    def set_password_hash(self, login, pass_hash):
+        user = self._users[login]
+        self._users[login] = UserRecord(pass_hash, user.allowed_rooms, user.current_rooms)
 
     def get_current_rooms(self, login):
         rooms = (self.default_room,)
         if login in self._users:
             rooms = self._users[login].current_rooms
-            rooms = (x[0] for x in rooms)
+            rooms = [x[0] for x in rooms]
         return rooms
 
     def add_room_to_current(self, login, room):
@@ -171,10 +310,45 @@ class DBPython(DB):
         self._users[login] = UserRecord(user.pass_hash, user.allowed_rooms, tuple(rooms))
 
     def get_room_history(self, room):
+        if room not in self._rooms:
+            return None
+        return self.get_messages(room, limit=self._history_depth)
+
+    def get_messages(self, room, before=None, limit=10):
+        history = self._rooms.get(room, None)
+        if not history:
+            return []
+        self._expire_history(history)
+        if not history:
+            return []
+        # Ids in deque go one by one, so position of message
+        # is calculated from its id, deque is not scanned
+        end = len(history)
+        if before is not None:
+            end = min(max(before - history[0].id, 0), end)
+        start = max(end - limit, 0)
+        return [history[i] for i in xrange(start, end)]
+
+    def get_messages_since(self, room, since, limit=10):
         history = self._rooms.get(room, None)
-        if history is not None:
-            history = history[-10:]
-        return history
+        if not history:
+            return []
+        self._expire_history(history)
+        if not history:
+            return []
+        start = min(max(since - history[0].id, 0), len(history))
+        end = min(start + limit, len(history))
+        return [history[i] for i in xrange(start, end)]
+
+    def _expire_history(self, history):
+        """ Remove messages older than history_ttl
+        :param history: deque of Message
+        """
+        if self.history_ttl is None:
+            return
+        oldest = time.time() - self.history_ttl
+        while history and history[0].time < oldest:
+            history.popleft()
 
     def change_nick_in_room(self, login, room, nick):
         if login is None:
@@ -195,21 +369,45 @@ class DBPython(DB):
             if room == _room[0]:
                 return _room[1]
 
-    def new_user(self, login, password):
+    def get_current_nicks(self, login):
+        if login not in self._users:
+            return []
+        return list(self._users[login].current_rooms)
+
+    def new_user(self, login, pass_hash):
         if login in self._users:
             return
         allowed_rooms = (self.default_room,)
-        self._users[login] = UserRecord(hashlib.md5(password).hexdigest(), allowed_rooms, tuple())
+        self._users[login] = UserRecord(pass_hash, allowed_rooms, tuple())
         return allowed_rooms
 
     def new_room(self, room):
-        if room in self._rooms:
+        if not self._registry.add(room):
             return False
-        self._rooms[room] = list()
+        self._rooms[room] = collections.deque(maxlen=self.history_size)
         return True
 
     def new_message(self, room, mess):
-        self._rooms[room].append(mess)
+        history = self._rooms[room]
+        self._last_ids[room] = self._last_ids.get(room, 0) + 1
+        message = Message(self._last_ids[room], time.time(), mess)
+        history.append(message)
+        self._expire_history(history)
+        return message
+
+    def reserve_ids(self, room, count):
+        first = self._last_ids.get(room, 0) + 1
+        self._last_ids[room] = first + count - 1
+        return first
+
+    def add_messages(self, messages):
+        for room, message in messages:
+            history = self._rooms[room]
+            history.append(message)
+            self._expire_history(history)
+
+    def resolve_room(self, room):
+        return self._registry.resolve(room)
 
     @property
     def all_rooms(self):
@@ -217,101 +415,785 @@ class DBPython(DB):
 
 
 class DBRedis(DB):
-    def __init__(self):
-        self.r = redis.Redis()
+    # Version of data layout in REDIS, data of older versions is moved
+    # to current layout by migrate
+    SCHEMA_VERSION = 1
+
+    def __init__(self, r=None, history_size=1000, history_ttl=None, migrate=True):
+        """ :param r: redis.Redis compatible client, which decodes
+                responses (decode_responses=True), so room names and
+                messages are unicode as the ones of clients; by default
+                connection to localhost is created
+            :param migrate: migrate data of older versions (see migrate),
+                if False data must be migrated already, e.g. by main
+                process before workers are forked
+        """
+        super(DBRedis, self).__init__(history_size, history_ttl)
+        self.r = redis.Redis(decode_responses=True) if r is None else r
         self._pre = 'RamblerTaskChat:'
+        # Hash of all rooms: lowercase name -> room name,
+        # and its local copy
+        self._rooms_key = '%sROOMS' % self._pre
+        self._version_key = '%sSCHEMA_VERSION' % self._pre
+        self._nicks_migrated_key = '%sNICKS_MIGRATED' % self._pre
+        if migrate:
+            self.migrate()
+        elif not self.is_migrated():
+            raise RuntimeError('Data in REDIS is not migrated to version %d' % self.SCHEMA_VERSION)
+        self.rooms = RoomRegistry()
+        self.rooms.update(self.r.hvals(self._rooms_key))
+        self._change_nick = self.r.register_script(self._change_nick_script)
+
+    def is_migrated(self):
+        """ Is data in REDIS of current version """
+        version = self.r.get(self._version_key)
+        return version is not None and int(version) >= self.SCHEMA_VERSION
+
+    def migrate(self):
+        """ Move data of older versions to current layout and create
+            default rooms. Runs once, until version key is set, so
+            workers started later don't scan keys of REDIS again.
+            Must not run in several processes at once.
+        :return: True if data was migrated
+        """
+        if self.is_migrated():
+            return False
+        if not self.r.exists(self._rooms_key):
+            self._index_rooms()
         for room in self.default_rooms:
-            key = '%sROOM:%s' % (self._pre, room)
-            if not self.r.exists(key):
-                self.r.lpush(key, 'Created room "%s"' % room)
+            self.r.hsetnx(self._rooms_key, room.lower(), room)
+        for room in self.r.hvals(self._rooms_key):
+            self._migrate_history(room)
+        if not self.r.exists(self._nicks_migrated_key):
+            self._migrate_nicks()
+        for room in self.default_rooms:
+            if not self.r.exists(self._last_id_key(room)):
+                self.new_message(room, 'Created room "%s"' % room)
+        self.r.set(self._version_key, self.SCHEMA_VERSION)
+        return True
 
+    def _index_rooms(self):
+        """ Fill hash of rooms from history keys of rooms,
+            created before the hash was introduced.
+            Runs once, when there is no hash in REDIS.
+        """
+        pattern = '%sROOM:*' % self._pre
+        l = len(pattern) - 1
+        for key in self.r.scan_iter(pattern):
+            room = key[l:]
+            self.r.hsetnx(self._rooms_key, room.lower(), room)
 
-    def is_correct_user(self, login, password):
-        key = '%sUSER:%s' % (self.pre, login)
-        pass_hash = self.r.hget(key, 'pass_hash')
-        if pass_hash is None:
+    def _migrate_history(self, room):
+        """ Move history of room from list (without message ids),
+            used before, to sorted set of messages scored by id
+        """
+        key = '%sROOM:%s' % (self._pre, room)
+        if self.r.type(key) not in ('list', b'list'):
             return
-        return hashlib.md5(password).hexdigest() == pass_hash
+        history = [self._load_message(x) for x in self.r.lrange(key, -self.history_size, -1)]
+        pipe = self.r.pipeline()
+        for n, (t, mess) in enumerate(history, 1):
+            if t == float('inf'):
+                t = time.time()
+            pipe.zadd(self._history_key(room), {self._dump_message(Message(n, t, mess)): n})
+        pipe.set(self._last_id_key(room), len(history))
+        pipe.delete(key)
+        pipe.execute()
+
+    def _migrate_nicks(self):
+        """ Move current rooms of users from json list of (room, nick)
+            in "current_rooms" field of user hash, used before,
+            to hash of nicks. Runs once, until marker key is set.
+        """
+        pattern = '%sUSER:*' % self._pre
+        l = len(pattern) - 1
+        for key in self.r.scan_iter(pattern):
+            rooms = self.r.hget(key, 'current_rooms')
+            if rooms is None:
+                continue
+            pipe = self.r.pipeline()
+            for room, nick in json.loads(rooms):
+                pipe.hsetnx(self._nicks_key(key[l:]), room, nick)
+            pipe.hdel(key, 'current_rooms')
+            pipe.execute()
+        self.r.set(self._nicks_migrated_key, 1)
+
+    def _user_key(self, login):
+        """ Hash of user: pass_hash, allowed_rooms """
+        return '%sUSER:%s' % (self._pre, login)
+
+    def _nicks_key(self, login):
+        """ Hash of current rooms of user: room -> nick.
+            Hash keeps order of joining, while it is small
+            (hash-max-ziplist-entries)
+        """
+        return '%sNICKS:%s' % (self._pre, login)
+
+    # Nick is changed only in room user is joined to,
+    # so room left by another connection is not restored
+    _change_nick_script = """
+        if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+            return redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+        end
+        return -1
+    """
+
+    def _history_key(self, room):
+        """ Sorted set of room messages, scored by message id """
+        return '%sHISTORY:%s' % (self._pre, room)
+
+    def _last_id_key(self, room):
+        """ Counter of room message ids """
+        return '%sMESSAGE_ID:%s' % (self._pre, room)
+
+    def get_password_hash(self, login):
+        return self.r.hget(self._user_key(login), 'pass_hash')
+
+    def set_password_hash(self, login, pass_hash):
+        self.r.hset(self._user_key(login), 'pass_hash', pass_hash)
 
     def get_current_rooms(self, login):
-        key = '%sUSER:%s' % (self.pre, login)
-        rooms = self.r.hget(key, 'current_rooms')
-        rooms = json.loads(rooms)
-        return (x[0] for x in rooms)
+        return self.r.hkeys(self._nicks_key(login))
 
     def add_room_to_current(self, login, room):
-        if login is None or room in self.get_current_rooms(login):
+        if login is None:
             return
-        key = '%sUSER:%s' % (self.pre, login)
-        rooms = self.r.hget(key, 'current_rooms')
-        rooms = json.loads(rooms)
-        rooms.append((room, login,))
-        self.r.hset(key, 'current_rooms', json.dumps(rooms))
+        # Login is default nickname
+        self.r.hsetnx(self._nicks_key(login), room, login)
 
     def remove_room_from_current(self, login, room):
-        key = '%sUSER:%s' % (self.pre, login)
-        rooms = self.r.hget(key, 'current_rooms')
-        rooms = json.loads(rooms)
-        for n, _room in enumerate(rooms[:]):
-            if room == _room[0]:
-                rooms.pop(n)
-                break
-        self.r.hset(key, 'current_rooms', json.dumps(rooms))
+        self.r.hdel(self._nicks_key(login), room)
 
     def get_room_history(self, room):
-        key = '%sROOM:%s' % (self._pre, room)
-        return self.r.lrange(key, -10, -1)
+        return self.get_messages(room, limit=self._history_depth)
+
+    def get_messages(self, room, before=None, limit=10):
+        # Page is taken from sorted set index by score (id), so only
+        # requested messages are read
+        maximum = '+inf' if before is None else '(%d' % before
+        history = self.r.zrevrangebyscore(self._history_key(room), maximum, '-inf',
+                                          start=0, num=limit)
+        history = [self._load_message(x) for x in reversed(history)]
+        return self._expire_history(history)
+
+    def get_messages_since(self, room, since, limit=10):
+        history = self.r.zrangebyscore(self._history_key(room), since, '+inf',
+                                       start=0, num=limit)
+        history = [self._load_message(x) for x in history]
+        return self._expire_history(history)
+
+    def _expire_history(self, history):
+        """ Filter out messages older than history_ttl
+        :param history: list of Message
+        """
+        if self.history_ttl is None:
+            return history
+        oldest = time.time() - self.history_ttl
+        return [x for x in history if x.time >= oldest]
+
+    @staticmethod
+    def _dump_message(message):
+        return json.dumps(message)
+
+    @staticmethod
+    def _load_message(item):
+        """ Stored message is json list [id, time, message].
+            Messages stored before ids are json lists [time, message],
+            and before that - plain strings without time.
+        :return: Message, or (time, message) pair for old messages
+        """
+        if item.startswith('['):
+            # Plain strings are "nick: text", nick may start with "["
+            try:
+                loaded = json.loads(item)
+            except ValueError:
+                loaded = None
+            if (isinstance(loaded, list) and len(loaded) in (2, 3)
+                    and all(isinstance(x, (int, long, float)) for x in loaded[:-1])
+                    and isinstance(loaded[-1], basestring)):
+                return Message(*loaded) if len(loaded) == 3 else tuple(loaded)
+        return float('inf'), item
 
     def change_nick_in_room(self, login, room, nick):
-        key = '%sUSER:%s' % (self.pre, login)
-        rooms = self.r.hget(key, 'current_rooms')
-        rooms = json.loads(rooms)
-        for _room in rooms[:]:
-            if room == _room[0]:
-                rooms[rooms.index(_room)] = (room, nick,)
-        self.r.hset(key, 'current_rooms', json.dumps(rooms))
+        if login is None:
+            return
+        self._change_nick(keys=[self._nicks_key(login)], args=[room, nick])
 
     def get_current_nick(self, login, room):
         if login is None:
             return 'Anonymous'
-        key = '%sUSER:%s' % (self.pre, login)
-        rooms = self.r.hget(key, 'current_rooms')
-        rooms = json.loads(rooms)
-        for _room in rooms[:]:
-            if room == _room[0]:
-                return _room[1]
+        return self.r.hget(self._nicks_key(login), room)
 
-    def new_user(self, login, password):
-        key = '%sUSER:%s' % (self.pre, login)
+    def get_current_nicks(self, login):
+        # HGETALL is returned as dict, which loses order of rooms,
+        # keys and values are read in one transaction instead
+        pipe = self.r.pipeline()
+        pipe.hkeys(self._nicks_key(login))
+        pipe.hvals(self._nicks_key(login))
+        rooms, nicks = pipe.execute()
+        return zip(rooms, nicks)
+
+    def new_user(self, login, pass_hash):
+        key = self._user_key(login)
         if self.r.exists(key):
             return
         allowed_rooms = [self.default_room]
         vals = dict(
-            pass_hash=hashlib.md5(password).hexdigest(),
+            pass_hash=pass_hash,
             allowed_rooms=json.dumps(allowed_rooms),
-            current_rooms='[]'
         )
         self.r.hmset(key, vals)
         return allowed_rooms
 
     def new_room(self, room):
-        key = '%sROOM:%s' % (self._pre, room)
-        if self.r.exists(key):
+        if not self.r.hsetnx(self._rooms_key, room.lower(), room):
             return False
+        self.rooms.add(room)
         return True
 
     def new_message(self, room, mess):
-        key = '%sROOM:%s' % (self._pre, room)
-        self.r.rpush(key, mess)
+        key = self._history_key(room)
+        message = Message(self.r.incr(self._last_id_key(room)), time.time(), mess)
+        pipe = self.r.pipeline()
+        pipe.zadd(key, {self._dump_message(message): message.id})
+        pipe.zremrangebyrank(key, 0, -self.history_size - 1)
+        if self.history_ttl is not None:
+            # All messages are too old, if there were no new ones
+            # during history_ttl (in ms, EXPIRE 0 would delete key)
+            pipe.pexpire(key, int(self.history_ttl * 1000))
+        pipe.execute()
+        return message
+
+    def reserve_ids(self, room, count):
+        return self.r.incrby(self._last_id_key(room), count) - count + 1
+
+    def add_messages(self, messages):
+        pipe = self.r.pipeline()
+        rooms = set()
+        for room, message in messages:
+            pipe.zadd(self._history_key(room), {self._dump_message(message): message.id})
+            rooms.add(room)
+        for room in rooms:
+            key = self._history_key(room)
+            pipe.zremrangebyrank(key, 0, -self.history_size - 1)
+            if self.history_ttl is not None:
+                pipe.pexpire(key, int(self.history_ttl * 1000))
+        pipe.execute()
+
+    def resolve_room(self, room):
+        _room = self.rooms.resolve(room)
+        if _room is None:
+            # May be created by another server process
+            _room = self.r.hget(self._rooms_key, room.lower())
+            if _room is not None:
+                self.rooms.add(_room)
+        return _room
 
     @property
     def all_rooms(self):
-        key = '%sROOM:*' % self._pre
-        rooms = self.r.keys(key)
-        l = len(key) - 1
-        return [x[l:] for x in rooms]
+        rooms = self.r.hvals(self._rooms_key)
+        self.rooms.update(rooms)
+        return rooms
 
     @property
     def pre(self):
         return self._pre
 
+
+
+class TTLCache(object):
+    """ LRU cache of limited size, every value lives
+        no longer than ttl seconds.
+    """
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (value, expiration time), the least recently used first
+        self._data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.pop(key, None)
+        if item is None or item[1] < time.time():
+            return default
+        self._data[key] = item
+        return item[0]
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = (value, time.time() + self.ttl)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class AsyncDB(object):
+    """ Asynchronous variant of DB interface.
+        Every method returns Future, which resolves with the value
+        of the same method of DB, so handlers can yield them
+        in coroutines and IOLoop is never blocked by DataBase.
+    """
+    __metaclass__ = ABCMeta
+
+    _default_rooms = DB._default_rooms
+    _default_room = DB._default_room
+
+    @abstractmethod
+    def is_correct_user(self, login, password):
+        """ Check if passed login is in base and password is correct.
+            Password is verified out of IOLoop (see passwords.py).
+        :param login: passed login
+        :param password: passed password (not hash)
+        :return: Future of
+            None: if login not in database
+            True: if login in database and password is correct
+            False: if login in database but password is not correct
+        """
+        pass
+
+    @abstractmethod
+    def user_exists(self, login):
+        """ Future of True if login is in database.
+            Used to validate user of cookie on every request,
+            so result may be cached.
+        """
+        pass
+
+    @abstractmethod
+    def get_current_rooms(self, login):
+        """ Future of DB.get_current_rooms """
+        pass
+
+    @abstractmethod
+    def add_room_to_current(self, login, room):
+        """ Future of DB.add_room_to_current """
+        pass
+
+    @abstractmethod
+    def remove_room_from_current(self, login, room):
+        """ Future of DB.remove_room_from_current """
+        pass
+
+    @abstractmethod
+    def get_room_history(self, room):
+        """ Future of DB.get_room_history """
+        pass
+
+    @abstractmethod
+    def get_messages(self, room, before=None, limit=10):
+        """ Future of DB.get_messages """
+        pass
+
+    @abstractmethod
+    def get_messages_since(self, room, since, limit=10):
+        """ Future of DB.get_messages_since """
+        pass
+
+    @abstractmethod
+    def change_nick_in_room(self, login, room, nick):
+        """ Future of DB.change_nick_in_room """
+        pass
+
+    @abstractmethod
+    def get_current_nick(self, login, room):
+        """ Future of DB.get_current_nick """
+        pass
+
+    @abstractmethod
+    def get_current_nicks(self, login):
+        """ Future of DB.get_current_nicks """
+        pass
+
+    @abstractmethod
+    def new_user(self, login, password):
+        """ Future of DB.new_user, password is hashed
+            out of IOLoop.
+        :param password: passed password (not hash)
+        """
+        pass
+
+    @abstractmethod
+    def new_room(self, room):
+        """ Future of DB.new_room """
+        pass
+
+    @abstractmethod
+    def new_message(self, room, mess):
+        """ Future of DB.new_message """
+        pass
+
+    @abstractmethod
+    def resolve_room(self, room):
+        """ Future of DB.resolve_room """
+        pass
+
+    @abstractmethod
+    def get_all_rooms(self):
+        """ Future of DB.all_rooms """
+        pass
+
+    def drain(self):
+        """ Future resolved when all accepted writes are stored,
+            must be yielded before shutdown
+        """
+        return gen.maybe_future(None)
+
+    def close(self):
+        """ Release files and threads of DataBase, called after drain """
+        pass
+
+    @property
+    def default_room(self):
+        return self._default_room
+
+    @property
+    def default_rooms(self):
+        return self._default_rooms
+
+    @property
+    def history_ttl(self):
+        """ Max age of stored messages (see DB) """
+        return None
+
+
+class AsyncDBWrapper(AsyncDB):
+    """ AsyncDB over synchronous DB.
+        If executor is passed, DB methods are called in its threads,
+        otherwise they are called right away (fits DB which never
+        waits for network, e.g. DBPython) and returned as resolved
+        Futures.
+        Passwords are hashed by hasher (passwords.PasswordHasher).
+        Existing logins are cached in users cache, which is updated
+        when user is created and checked for correct password.
+        Users are never removed, so cached logins don't become stale.
+        Unknown logins are not cached: user created by another server
+        process must be seen at once.
+        If write_behind is passed, messages are saved by it in
+        background (see WriteBehind).
+    """
+    def __init__(self, db, executor=None, hasher=None, users=None, write_behind=None):
+        """ :param db: DB instance
+            :param executor: concurrent.futures.Executor for DB calls
+            :param hasher: passwords.PasswordHasher
+            :param users: TTLCache of known logins
+            :param write_behind: WriteBehind
+        """
+        self.db = db
+        self.executor = executor
+        self.hasher = PasswordHasher() if hasher is None else hasher
+        self.users = TTLCache() if users is None else users
+        self.write_behind = write_behind
+        if write_behind is not None:
+            write_behind.bind(self)
+
+    def _call(self, method, *args):
+        latency = DB_LATENCY.labels(method.__name__)
+        start = time.time()
+        if self.executor is None:
+            result = method(*args)
+            latency.observe(time.time() - start)
+            return gen.maybe_future(result)
+        return self.executor.submit(self._timed, latency, start, method, *args)
+
+    @staticmethod
+    def _timed(latency, start, method, *args):
+        """ Call method in thread of executor, time is
+            counted from submit, so wait in queue is included
+        """
+        try:
+            return method(*args)
+        finally:
+            latency.observe(time.time() - start)
+
+    @gen.coroutine
+    def is_correct_user(self, login, password):
+        pass_hash = yield self._call(self.db.get_password_hash, login)
+        if pass_hash is None:
+            raise gen.Return(None)
+        self.users.set(login, True)
+        correct = yield self.hasher.verify(password, pass_hash)
+        if correct and needs_rehash(pass_hash):
+            # Hash of old version, replace it while password is known
+            pass_hash = yield self.hasher.hash(password)
+            yield self._call(self.db.set_password_hash, login, pass_hash)
+        raise gen.Return(correct)
+
+    @gen.coroutine
+    def user_exists(self, login):
+        if self.users.get(login):
+            raise gen.Return(True)
+        pass_hash = yield self._call(self.db.get_password_hash, login)
+        if pass_hash is None:
+            raise gen.Return(False)
+        self.users.set(login, True)
+        raise gen.Return(True)
+
+    def get_current_rooms(self, login):
+        return self._call(self.db.get_current_rooms, login)
+
+    def add_room_to_current(self, login, room):
+        return self._call(self.db.add_room_to_current, login, room)
+
+    def remove_room_from_current(self, login, room):
+        return self._call(self.db.remove_room_from_current, login, room)
+
+    @gen.coroutine
+    def _read_history(self, method, room, *args):
+        if self.write_behind is not None:
+            # Published messages of room must be in history
+            yield self.write_behind.flush(room)
+        result = yield self._call(method, room, *args)
+        raise gen.Return(result)
+
+    def get_room_history(self, room):
+        return self._read_history(self.db.get_room_history, room)
+
+    def get_messages(self, room, before=None, limit=10):
+        return self._read_history(self.db.get_messages, room, before, limit)
+
+    def get_messages_since(self, room, since, limit=10):
+        return self._read_history(self.db.get_messages_since, room, since, limit)
+
+    def change_nick_in_room(self, login, room, nick):
+        return self._call(self.db.change_nick_in_room, login, room, nick)
+
+    def get_current_nick(self, login, room):
+        return self._call(self.db.get_current_nick, login, room)
+
+    def get_current_nicks(self, login):
+        return self._call(self.db.get_current_nicks, login)
+
+    @gen.coroutine
+    def new_user(self, login, password):
+        pass_hash = yield self.hasher.hash(password)
+        rooms = yield self._call(self.db.new_user, login, pass_hash)
+        if rooms is not None:
+            self.users.set(login, True)
+        raise gen.Return(rooms)
+
+    def new_room(self, room):
+        return self._call(self.db.new_room, room)
+
+    def new_message(self, room, mess):
+        if self.write_behind is not None:
+            return self.write_behind.new_message(room, mess)
+        return self._call(self.db.new_message, room, mess)
+
+    def resolve_room(self, room):
+        return self._call(self.db.resolve_room, room)
+
+    def get_all_rooms(self):
+        def all_rooms():
+            return list(self.db.all_rooms)
+        return self._call(all_rooms)
+
+    @property
+    def history_ttl(self):
+        return self.db.history_ttl
+
+    def drain(self):
+        if self.write_behind is not None:
+            return self.write_behind.flush()
+        return super(AsyncDBWrapper, self).drain()
+
+
+class WriteBehind(object):
+    """ Background saving of messages for AsyncDBWrapper.
+        Message gets id from block of ids reserved in DataBase once
+        per id_block messages of room, and is put to buffer, so it
+        is published without waiting for DataBase. Buffer is saved
+        by one call of DB.add_messages (one pipeline of REDIS) on the
+        next IOLoop iteration (or in delay seconds), right away when
+        it has max_size messages. Only one flush runs at once,
+        messages which come during it are saved by the next one.
+        When max_pending messages are not saved (e.g. DataBase is not
+        available, failed flush is repeated every retry_delay seconds),
+        new messages wait for flush, so no more than max_pending
+        messages are lost on crash.
+        NOTE: ids are reserved per process, so with several processes
+          message ids of room don't follow order of messages, if
+          id_block is greater than 1.
+    """
+    def __init__(self, delay=0, max_size=500, max_pending=10000, id_block=100, retry_delay=1):
+        """ :param delay: seconds between message and flush,
+                0 - flush on the next IOLoop iteration
+            :param max_size: number of messages to flush right away
+            :param max_pending: max number of not saved messages
+            :param id_block: number of ids reserved at once
+            :param retry_delay: seconds between failed flushes
+        """
+        self.delay = delay
+        self.max_size = max_size
+        self.max_pending = max_pending
+        self.id_block = id_block
+        self.retry_delay = retry_delay
+        self.adb = None
+        self._buffer = []
+        # Number of not saved messages by room
+        self._pending = collections.Counter()
+        # room -> [next id, last reserved id], Future of reservation
+        self._ids = dict()
+        self._reserving = dict()
+        # Futures resolved after flush of buffer, of running flush
+        self._waiters = []
+        self._flush_waiters = []
+        self._flushing = False
+        self._timeout = None
+        self._scheduled = False
+
+    def bind(self, adb):
+        """ :param adb: AsyncDBWrapper, which DB stores messages """
+        self.adb = adb
+
+    @gen.coroutine
+    def new_message(self, room, mess):
+        """ Future of Message with new id, resolved before
+            message is saved
+        """
+        if sum(self._pending.values()) >= self.max_pending:
+            yield self.flush()
+        message_id = yield self._next_id(room)
+        message = Message(message_id, time.time(), mess)
+        self._buffer.append((room, message))
+        self._pending[room] += 1
+        WRITE_BEHIND_BUFFERED.set(len(self._buffer))
+        self._schedule()
+        raise gen.Return(message)
+
+    @gen.coroutine
+    def _next_id(self, room):
+        ids = self._ids.get(room)
+        while ids is None or ids[0] > ids[1]:
+            reserving = self._reserving.get(room)
+            if reserving is None:
+                reserving = self._reserve(room)
+                if not reserving.done():
+                    # Other messages of room wait for the same block
+                    self._reserving[room] = reserving
+            yield reserving
+            ids = self._ids.get(room)
+        ids[0] += 1
+        raise gen.Return(ids[0] - 1)
+
+    @gen.coroutine
+    def _reserve(self, room):
+        try:
+            first = yield self.adb._call(self.adb.db.reserve_ids, room, self.id_block)
+        finally:
+            self._reserving.pop(room, None)
+        self._ids[room] = [first, first + self.id_block - 1]
+
+    def flush(self, room=None):
+        """ Future resolved when messages put before are saved
+        :param room: wait for messages of this room only
+        """
+        if room is not None and not self._pending[room] or not (self._buffer or self._flushing):
+            return gen.maybe_future(None)
+        future = Future()
+        if self._buffer:
+            self._waiters.append(future)
+            self._schedule(now=True)
+        else:
+            self._flush_waiters.append(future)
+        return future
+
+    def _schedule(self, now=False):
+        if self._flushing or self._scheduled and self._timeout is None:
+            return
+        io_loop = IOLoop.current()
+        if now or self.delay == 0 or len(self._buffer) >= self.max_size:
+            if self._timeout is not None:
+                io_loop.remove_timeout(self._timeout)
+                self._timeout = None
+            io_loop.add_callback(self._flush)
+            self._scheduled = True
+        elif self._timeout is None:
+            self._timeout = io_loop.call_later(self.delay, self._flush)
+            self._scheduled = True
+
+    @gen.coroutine
+    def _flush(self):
+        self._timeout = None
+        self._scheduled = False
+        if self._flushing or not self._buffer:
+            return
+        self._flushing = True
+        batch, self._buffer = self._buffer, []
+        self._flush_waiters, self._waiters = self._waiters, []
+        start = time.time()
+        try:
+            yield self.adb._call(self.adb.db.add_messages, batch)
+        except Exception:
+            logging.exception('Failed to save %d messages, retry in %s s', len(batch),
+                              self.retry_delay)
+            self._buffer[:0] = batch
+            self._waiters[:0] = self._flush_waiters
+            self._flush_waiters = []
+            yield gen.sleep(self.retry_delay)
+        else:
+            WRITE_BEHIND_FLUSH.observe(time.time() - start)
+            WRITE_BEHIND_BATCH.observe(len(batch))
+            for room, message in batch:
+                self._pending[room] -= 1
+            waiters, self._flush_waiters = self._flush_waiters, []
+            for future in waiters:
+                future.set_result(None)
+        finally:
+            self._flushing = False
+            WRITE_BEHIND_BUFFERED.set(len(self._buffer))
+        if self._buffer:
+            self._schedule(now=bool(self._waiters))
+
+
+class AsyncDBPython(AsyncDBWrapper):
+    """ In memory AsyncDB. All calls are resolved immediately """
+    def __init__(self, history_size=1000, history_ttl=None, hasher=None, users=None,
+                 write_behind=None):
+        db = DBPython(history_size, history_ttl)
+        super(AsyncDBPython, self).__init__(db, hasher=hasher, users=users,
+                                            write_behind=write_behind)
+
+
+class AsyncDBRedis(AsyncDBWrapper):
+    """ AsyncDB on REDIS. Blocking redis-py calls are made in
+        pool of threads, each thread takes connection from shared
+        pool of connections, so up to pool_size requests to REDIS
+        are in flight at once and IOLoop never waits for them.
+    """
+    def __init__(self, pool_size=10, r=None, history_size=1000, history_ttl=None,
+                 hasher=None, users=None, write_behind=None, migrate=True, **connection_kwargs):
+        """ :param pool_size: number of threads and REDIS connections
+            :param r: redis.Redis compatible client (e.g. fake REDIS
+                for tests), decoding responses (see DBRedis), by default
+                client with pool of connections to REDIS is created
+            :param history_size, history_ttl: see DB
+            :param hasher: passwords.PasswordHasher
+            :param users: TTLCache of known logins
+            :param write_behind: WriteBehind to save messages in background
+            :param migrate: see DBRedis
+            :param connection_kwargs: passed to redis connection pool
+                (host, port, db, etc.)
+        """
+        if ThreadPoolExecutor is None:
+            raise RuntimeError('AsyncDBRedis requires concurrent.futures ("futures" package)')
+        if r is None:
+            connection_kwargs.setdefault('decode_responses', True)
+            pool = redis.BlockingConnectionPool(max_connections=pool_size, **connection_kwargs)
+            r = redis.Redis(connection_pool=pool)
+        db = DBRedis(r, history_size, history_ttl, migrate)
+        super(AsyncDBRedis, self).__init__(db, ThreadPoolExecutor(pool_size), hasher, users,
+                                           write_behind)
+
+    def resolve_room(self, room):
+        # Known rooms are resolved without going to thread
+        _room = self.db.rooms.resolve(room)
+        if _room is not None:
+            return gen.maybe_future(_room)
+        return super(AsyncDBRedis, self).resolve_room(room)
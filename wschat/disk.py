@@ -0,0 +1,619 @@
+# coding: utf-8
+import collections
+import fcntl
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+
+from tornado import gen
+
+from .db import DB, UserRecord, Message, RoomRegistry, AsyncDBWrapper, ThreadPoolExecutor
+
+
+# crc32 of the rest of record, message id, time, length of room, length of text
+_header = struct.Struct('<IQdHI')
+_segment_re = re.compile(r'^segment-(\d{8})\.log$')
+# Position of message in segments
+Entry = collections.namedtuple('Entry', "id time segment offset")
+
+
+def pack_record(message_id, timestamp, room, text):
+    """ Binary record of message: header and utf-8 room and text """
+    room, text = room.encode('utf-8'), text.encode('utf-8')
+    body = _header.pack(0, message_id, timestamp, len(room), len(text))[4:] + room + text
+    return struct.pack('<I', zlib.crc32(body) & 0xffffffff) + body
+
+
+def scan_records(data, offset=0):
+    """ Iterate records of segment, stops at the end of segment,
+        at zeroed (preallocated) space or at damaged record
+    :param data: mmap or bytes of segment
+    :return: iterator of (offset, id, time, room, size of record)
+    """
+    while offset + _header.size <= len(data):
+        crc, message_id, timestamp, room_len, text_len = _header.unpack_from(data, offset)
+        size = _header.size + room_len + text_len
+        if message_id == 0 or offset + size > len(data):
+            return
+        if zlib.crc32(data[offset + 4:offset + size]) & 0xffffffff != crc:
+            return
+        start = offset + _header.size
+        yield offset, message_id, timestamp, data[start:start + room_len].decode('utf-8'), size
+        offset += size
+
+
+class DBDisk(DB):
+    """ DataBase in local append-only files of directory path:
+          meta.log - json lines of rooms, users and counters of
+            message ids, every change of user appends its full record,
+            log is rewritten when it is mostly made of old records;
+          segment-N.log - binary records of messages (see pack_record)
+            of all rooms. Writes go to the last (active) segment, which
+            is preallocated to segment_size and memory-mapped once, so
+            the fresh records are read from page cache without system
+            calls. Full segment is sealed and the next one is started.
+        Users and rooms are kept in memory, history is not: per room
+        only offsets of the last history_size messages are indexed
+        (rebuilt by scan of segments on start).
+        Writes are group-committed: every write returns after fsync,
+        but one fsync of committer thread covers all writes made while
+        previous fsync was running. With sync=False writes don't wait,
+        and the ones of the last fsync are lost on power failure.
+        Sealed segments, where the most of records left history, are
+        compacted: the rest of records are copied to a new file, which
+        replaces the first of them, and the others are removed.
+        NOTE: methods are thread-safe, but only one process may use
+          directory at once.
+    """
+    def __init__(self, path, history_size=1000, history_ttl=None, segment_size=64 * 2 ** 20,
+                 sync=True, compact_ratio=0.5, compact_interval=60):
+        """ :param path: directory of data, created if doesn't exist
+            :param history_size, history_ttl: see DB
+            :param segment_size: max size of segment file in bytes
+            :param sync: wait for fsync in writes
+            :param compact_ratio: sealed segment is compacted, when
+                part of its records which are in history is not greater
+            :param compact_interval: min seconds between compactions
+        """
+        super(DBDisk, self).__init__(history_size, history_ttl)
+        self.path = path
+        self.segment_size = segment_size
+        self.sync = sync
+        self.compact_ratio = compact_ratio
+        self.compact_interval = compact_interval
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lock_file = open(os.path.join(path, 'LOCK'), 'w')
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            raise RuntimeError('Data directory %s is used by another process' % path)
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._users = dict()
+        self._rooms = dict()
+        self._last_ids = dict()
+        self._reserved = dict()
+        self._registry = RoomRegistry()
+        # segment -> mmap, number of records, number of records in history
+        self._maps = dict()
+        self._total = collections.Counter()
+        self._live = collections.Counter()
+        # Active segment: number, descriptor, size of written records
+        self._segment = None
+        self._fd = None
+        self._size = 0
+        self._meta_fd = None
+        self._meta_records = 0
+        # Descriptors of sealed segments and old meta logs, which
+        # are closed by committer after the last fsync
+        self._retired = []
+        # Number of writes made and written to disk
+        self._written = 0
+        self._synced = 0
+        self._closed = False
+        self._compacted = time.time()
+        self._load()
+        for room in self.default_rooms:
+            self._new_room(room)
+        self.flush()
+        self._committer = threading.Thread(target=self._commit_loop, name='DBDisk committer')
+        self._committer.daemon = True
+        self._committer.start()
+
+    # Files
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _segment_file(self, segment):
+        return self._file('segment-%08d.log' % segment)
+
+    def _map(self, segment):
+        with open(self._segment_file(segment), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _load(self):
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp'):
+                # Copy of interrupted compaction or meta log rewrite
+                os.remove(self._file(name))
+        self._load_meta()
+        segments = sorted(int(_segment_re.match(name).group(1))
+                          for name in os.listdir(self.path) if _segment_re.match(name))
+        # room -> {id: Entry}, the same record may be in two segments
+        # if compaction was interrupted
+        found = collections.defaultdict(dict)
+        for segment in segments:
+            data = self._maps[segment] = self._map(segment)
+            end = 0
+            for offset, message_id, timestamp, room, size in scan_records(data):
+                found[room][message_id] = Entry(message_id, timestamp, segment, offset)
+                self._total[segment] += 1
+                end = offset + size
+        if segments:
+            self._open_segment(segments[-1], end)
+        else:
+            self._open_segment(1, 0)
+        for room, entries in found.items():
+            self._new_room(room)
+            ids = sorted(entries)
+            self._last_ids[room] = max(self._last_ids.get(room, 0), ids[-1])
+            # Ids in history go one by one (see get_messages)
+            start = len(ids) - 1
+            while start > 0 and ids[start - 1] == ids[start] - 1:
+                if len(ids) - start == self.history_size:
+                    break
+                start -= 1
+            history = self._rooms[room]
+            for message_id in ids[start:]:
+                history.append(entries[message_id])
+                self._live[entries[message_id].segment] += 1
+            self._expire_history(history)
+        if self._meta_records > 2 * (len(self._users) + len(self._registry)) + 100:
+            self._rewrite_meta()
+
+    def _load_meta(self):
+        path = self._file('meta.log')
+        end = 0
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        # Record which was not written completely
+                        break
+                    self._apply_meta(json.loads(line))
+                    self._meta_records += 1
+                    end += len(line)
+        self._meta_fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        os.ftruncate(self._meta_fd, end)
+
+    def _apply_meta(self, record):
+        if 'room' in record:
+            room = record['room']
+            if self._registry.add(room):
+                self._rooms[room] = collections.deque()
+        elif 'user' in record:
+            self._users[record['user']] = UserRecord(
+                record['pass_hash'], tuple(record['allowed_rooms']),
+                tuple(tuple(x) for x in record['current_rooms']))
+        elif 'ids' in record:
+            for room, last_id in record['ids'].items():
+                self._last_ids[room] = max(self._last_ids.get(room, 0), last_id)
+
+    def _meta_dump(self):
+        """ Meta records of current state """
+        for room in self._registry:
+            yield dict(room=room)
+        for login, user in self._users.items():
+            yield self._user_record(login, user)
+        yield dict(ids=self._last_ids)
+
+    @staticmethod
+    def _user_record(login, user):
+        return dict(user=login, pass_hash=user.pass_hash, allowed_rooms=user.allowed_rooms,
+                    current_rooms=user.current_rooms)
+
+    def _rewrite_meta(self):
+        """ Replace meta log by records of current state """
+        path = self._file('meta.log')
+        records = list(self._meta_dump())
+        with open(path + '.tmp', 'wb') as f:
+            f.write(b''.join(json.dumps(x) + b'\n' for x in records))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+        self._sync_dir()
+        self._retired.append(self._meta_fd)
+        self._meta_fd = os.open(path, os.O_WRONLY | os.O_APPEND)
+        self._meta_records = len(records)
+
+    def _sync_dir(self):
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _open_segment(self, segment, size):
+        """ Make segment active, it is preallocated and mapped whole """
+        path = self._segment_file(segment)
+        self._close_map(segment)
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self._fd).st_size < self.segment_size:
+            os.ftruncate(self._fd, self.segment_size)
+        self._segment, self._size = segment, size
+        self._maps[segment] = self._map(segment)
+
+    def _seal_segment(self):
+        """ Cut preallocated space of active segment and start the next one """
+        segment = self._segment
+        os.ftruncate(self._fd, self._size)
+        self._retired.append(self._fd)
+        self._close_map(segment)
+        self._maps[segment] = self._map(segment)
+        self._open_segment(segment + 1, 0)
+
+    def _close_map(self, segment):
+        data = self._maps.pop(segment, None)
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+    # Writes and commit
+
+    def _append(self, record):
+        """ Write record to active segment
+        :return: (segment, offset) of record
+        """
+        if len(record) > self.segment_size:
+            raise ValueError('Message is too long')
+        if self._size + len(record) > self.segment_size:
+            self._seal_segment()
+        os.lseek(self._fd, self._size, os.SEEK_SET)
+        os.write(self._fd, record)
+        position = (self._segment, self._size)
+        self._size += len(record)
+        self._total[self._segment] += 1
+        self._written += 1
+        return position
+
+    def _write_meta(self, record):
+        os.write(self._meta_fd, json.dumps(record) + b'\n')
+        self._meta_records += 1
+        self._written += 1
+
+    def _write_user(self, login):
+        self._write_meta(self._user_record(login, self._users[login]))
+
+    def _commit(self):
+        """ Wait until all writes are on disk, called under lock """
+        self._cond.notify_all()
+        if not self.sync:
+            return
+        written = self._written
+        while self._synced < written and not self._closed:
+            self._cond.wait()
+
+    def _commit_loop(self):
+        """ Thread of committer: every fsync covers all writes made
+            before it, writers which came during fsync are covered
+            by the next one
+        """
+        while True:
+            with self._lock:
+                while self._synced == self._written and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                written = self._written
+                fds = [self._fd, self._meta_fd]
+                retired, self._retired = self._retired, []
+            for fd in fds + retired:
+                os.fsync(fd)
+            for fd in retired:
+                os.close(fd)
+            with self._lock:
+                self._synced = written
+                self._cond.notify_all()
+                compact = time.time() - self._compacted > self.compact_interval
+            if compact:
+                self.compact()
+
+    def flush(self):
+        """ Write everything to disk right now """
+        with self._lock:
+            for fd in [self._fd, self._meta_fd] + self._retired:
+                os.fsync(fd)
+            self._synced = self._written
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._cond.notify_all()
+        self._committer.join()
+        self.flush()
+        with self._lock:
+            for fd in [self._fd, self._meta_fd] + self._retired:
+                os.close(fd)
+            self._retired = []
+            for segment in list(self._maps):
+                self._close_map(segment)
+        self._lock_file.close()
+
+    # Compaction
+
+    def compact(self):
+        """ Remove sealed segments, where part of records in history
+            is not greater than compact_ratio. Records in history are
+            copied to new file of the first of them, which replaces it.
+            Copy is made without lock, DB calls wait only while history
+            is switched to the copy. Called by committer thread.
+        """
+        with self._lock:
+            self._compacted = time.time()
+            for history in self._rooms.values():
+                self._expire_history(history)
+            segments = [x for x in sorted(self._maps) if x != self._segment and
+                        self._live[x] <= self._total[x] * self.compact_ratio]
+            if not segments:
+                return
+            # Counters of ids must survive removal of all messages of room
+            self._write_meta(dict(ids=self._last_ids))
+            meta_fd = self._meta_fd
+            entries = [(room, entry) for room, history in self._rooms.items()
+                       for entry in history if entry.segment in segments]
+            maps = dict((x, self._maps[x]) for x in segments)
+        # Sealed segments are not changed and their maps are closed
+        # by compaction only, so they are read without lock
+        target = segments[0]
+        path = self._segment_file(target)
+        offsets = dict()
+        size = 0
+        with open(path + '.tmp', 'wb') as f:
+            for room, entry in entries:
+                data = maps[entry.segment]
+                length = _header.size + sum(_header.unpack_from(data, entry.offset)[3:])
+                f.write(data[entry.offset:entry.offset + length])
+                offsets[room, entry.id] = size
+                size += length
+            f.flush()
+            os.fsync(f.fileno())
+        # Copies must be on disk before originals are removed
+        os.fsync(meta_fd)
+        os.rename(path + '.tmp', path)
+        self._sync_dir()
+        with self._lock:
+            live = 0
+            for room, history in self._rooms.items():
+                for n, entry in enumerate(history):
+                    if entry.segment in maps:
+                        history[n] = entry._replace(segment=target,
+                                                    offset=offsets[room, entry.id])
+                        live += 1
+            for segment in segments:
+                self._close_map(segment)
+                del self._total[segment], self._live[segment]
+            self._maps[target] = self._map(target)
+            self._total[target] = len(entries)
+            self._live[target] = live
+            if self._meta_records > 2 * (len(self._users) + len(self._registry)) + 100:
+                self._rewrite_meta()
+        for segment in segments[1:]:
+            os.remove(self._segment_file(segment))
+        self._sync_dir()
+
+    # History
+
+    def _read(self, entry):
+        data = self._maps[entry.segment]
+        crc, message_id, timestamp, room_len, text_len = _header.unpack_from(data, entry.offset)
+        start = entry.offset + _header.size + room_len
+        return Message(message_id, timestamp, data[start:start + text_len].decode('utf-8'))
+
+    def _drop_oldest(self, history):
+        self._live[history.popleft().segment] -= 1
+
+    def _expire_history(self, history):
+        """ Remove messages older than history_ttl
+        :param history: deque of Entry
+        """
+        if self.history_ttl is None:
+            return
+        oldest = time.time() - self.history_ttl
+        while history and history[0].time < oldest:
+            self._drop_oldest(history)
+
+    def get_room_history(self, room):
+        if room not in self._rooms:
+            return None
+        return self.get_messages(room, limit=self._history_depth)
+
+    def get_messages(self, room, before=None, limit=10):
+        with self._lock:
+            history = self._rooms.get(room, None)
+            if not history:
+                return []
+            self._expire_history(history)
+            if not history:
+                return []
+            # Ids in deque go one by one, so position of message
+            # is calculated from its id, deque is not scanned
+            end = len(history)
+            if before is not None:
+                end = min(max(before - history[0].id, 0), end)
+            start = max(end - limit, 0)
+            return [self._read(history[i]) for i in xrange(start, end)]
+
+    def get_messages_since(self, room, since, limit=10):
+        with self._lock:
+            history = self._rooms.get(room, None)
+            if not history:
+                return []
+            self._expire_history(history)
+            if not history:
+                return []
+            start = min(max(since - history[0].id, 0), len(history))
+            end = min(start + limit, len(history))
+            return [self._read(history[i]) for i in xrange(start, end)]
+
+    def _add_message(self, room, message):
+        history = self._rooms[room]
+        segment, offset = self._append(pack_record(message.id, message.time, room, message.text))
+        history.append(Entry(message.id, message.time, segment, offset))
+        self._live[segment] += 1
+        self._last_ids[room] = message.id
+        if len(history) > self.history_size:
+            self._drop_oldest(history)
+        self._expire_history(history)
+
+    def new_message(self, room, mess):
+        with self._lock:
+            message = Message(self._last_ids.get(room, 0) + 1, time.time(), mess)
+            self._add_message(room, message)
+            self._commit()
+        return message
+
+    def reserve_ids(self, room, count):
+        # Reserved ids are not written, so ids, which were reserved
+        # but not used before restart, don't make gap in history
+        with self._lock:
+            first = max(self._last_ids.get(room, 0), self._reserved.get(room, 0)) + 1
+            self._reserved[room] = first + count - 1
+        return first
+
+    def add_messages(self, messages):
+        with self._lock:
+            for room, message in messages:
+                self._add_message(room, message)
+            self._commit()
+
+    # Users and rooms
+
+    def get_password_hash(self, login):
+        user = self._users.get(login, None)
+        return user.pass_hash if user is not None else None
+
+    def set_password_hash(self, login, pass_hash):
+        with self._lock:
+            user = self._users[login]
+            self._users[login] = UserRecord(pass_hash, user.allowed_rooms, user.current_rooms)
+            self._write_user(login)
+            self._commit()
+
+    def get_current_rooms(self, login):
+        rooms = (self.default_room,)
+        if login in self._users:
+            rooms = self._users[login].current_rooms
+            rooms = [x[0] for x in rooms]
+        return rooms
+
+    def _update_rooms(self, login, rooms):
+        user = self._users[login]
+        self._users[login] = UserRecord(user.pass_hash, user.allowed_rooms, tuple(rooms))
+        self._write_user(login)
+        self._commit()
+
+    def add_room_to_current(self, login, room):
+        with self._lock:
+            if login is None or room in self.get_current_rooms(login):
+                return
+            rooms = list(self._users[login].current_rooms)
+            rooms.append((room, login,))
+            self._update_rooms(login, rooms)
+
+    def remove_room_from_current(self, login, room):
+        with self._lock:
+            rooms = [x for x in self._users[login].current_rooms if x[0] != room]
+            self._update_rooms(login, rooms)
+
+    def change_nick_in_room(self, login, room, nick):
+        if login is None:
+            return
+        with self._lock:
+            rooms = [(room, nick,) if x[0] == room else x
+                     for x in self._users[login].current_rooms]
+            self._update_rooms(login, rooms)
+
+    def get_current_nick(self, login, room):
+        if login is None:
+            return 'Anonymous'
+        for _room in self._users[login].current_rooms:
+            if room == _room[0]:
+                return _room[1]
+
+    def get_current_nicks(self, login):
+        if login not in self._users:
+            return []
+        return list(self._users[login].current_rooms)
+
+    def new_user(self, login, pass_hash):
+        with self._lock:
+            if login in self._users:
+                return
+            allowed_rooms = (self.default_room,)
+            self._users[login] = UserRecord(pass_hash, allowed_rooms, tuple())
+            self._write_user(login)
+            self._commit()
+        return allowed_rooms
+
+    def _new_room(self, room):
+        if not self._registry.add(room):
+            return False
+        self._rooms[room] = collections.deque()
+        self._write_meta(dict(room=room))
+        return True
+
+    def new_room(self, room):
+        with self._lock:
+            if not self._new_room(room):
+                return False
+            self._commit()
+        return True
+
+    def resolve_room(self, room):
+        return self._registry.resolve(room)
+
+    @property
+    def rooms(self):
+        return self._registry
+
+    @property
+    def all_rooms(self):
+        return self._rooms.keys()
+
+
+class AsyncDBDisk(AsyncDBWrapper):
+    """ AsyncDB on local files (see DBDisk). Writes wait for fsync,
+        so DB is called in pool of threads and writes made at once
+        share one fsync.
+    """
+    def __init__(self, path, pool_size=4, history_size=1000, history_ttl=None,
+                 hasher=None, users=None, write_behind=None, **kwargs):
+        """ :param path: directory of data
+            :param pool_size: number of threads
+            :param history_size, history_ttl: see DB
+            :param hasher: passwords.PasswordHasher
+            :param users: TTLCache of known logins
+            :param write_behind: WriteBehind to save messages in background
+            :param kwargs: passed to DBDisk (segment_size, sync, etc.)
+        """
+        if ThreadPoolExecutor is None:
+            raise RuntimeError('AsyncDBDisk requires concurrent.futures ("futures" package)')
+        db = DBDisk(path, history_size, history_ttl, **kwargs)
+        super(AsyncDBDisk, self).__init__(db, ThreadPoolExecutor(pool_size), hasher, users,
+                                          write_behind)
+
+    def resolve_room(self, room):
+        # Rooms are in memory, thread is not needed
+        return gen.maybe_future(self.db.resolve_room(room))
+
+    def close(self):
+        self.executor.shutdown()
+        self.db.close()
@@ -0,0 +1,248 @@
+# coding: utf-8
+import bisect
+import threading
+
+import tornado.web
+
+from tornado.escape import utf8
+
+
+class Registry(object):
+    """ Set of metrics rendered together in Prometheus text format.
+        Update of metric is a dict lookup and few additions, so
+        metrics are always on. Values which depend on state of
+        connections (e.g. connections per room) are computed on
+        scrape only (see CallbackGauge).
+    """
+    def __init__(self):
+        self._metrics = list()
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        """ All metrics in Prometheus text format """
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.doc))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for suffix, labels, value in metric.samples():
+                lines.append('%s%s%s %s' % (metric.name, suffix, format_labels(labels),
+                                            format_value(value)))
+        return '\n'.join(utf8(x) for x in lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    labels = ('%s="%s"' % (name, escape(value)) for name, value in labels)
+    return '{%s}' % ','.join(labels)
+
+
+def escape(value):
+    if not isinstance(value, basestring):
+        value = str(value)
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def bounded_label(value, known, other='other'):
+    """ Value of label if it is one of known values, other values
+        share one child, so number of children is bounded
+        (e.g. rooms created by users).
+    """
+    return value if value in known else other
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class Metric(object):
+    """ Metric with children per values of labels,
+        child is created on first use
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._children = dict()
+        if registry is not None:
+            registry.register(self)
+
+    def labels(self, *values):
+        """ Child of metric for values of labels """
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('%s expects labels %s' % (self.name, self.labelnames))
+            child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError()
+
+    def _labels(self, values, *extra):
+        return zip(self.labelnames, values) + list(extra)
+
+    def samples(self):
+        """ Iterable of (name suffix, labels, value) """
+        for values, child in sorted(self._children.items()):
+            yield '', self._labels(values), child.value
+
+
+class _Value(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+
+class Counter(Metric):
+    """ Monotonically increasing value """
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """ Value which goes up and down """
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self.labels().set(value)
+
+
+class CallbackGauge(Metric):
+    """ Gauge computed on scrape by collect function,
+        which returns iterable of (label values, value)
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, doc, collect, labelnames=(), registry=REGISTRY):
+        super(CallbackGauge, self).__init__(name, doc, labelnames, registry)
+        self.collect = collect
+
+    def samples(self):
+        for values, value in sorted(self.collect()):
+            yield '', self._labels(values), value
+
+
+class _Histogram(object):
+    """ Counts of observed values by buckets. Observation is
+        thread safe (values are observed by threads of DataBase)
+    """
+    __slots__ = ('buckets', 'counts', 'sum', '_lock')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last one is +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+class Histogram(Metric):
+    """ Distribution of observed values """
+    kind = 'histogram'
+    # Seconds
+    default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                       0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, name, doc, labelnames=(), buckets=None, registry=REGISTRY):
+        super(Histogram, self).__init__(name, doc, labelnames, registry)
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+
+    def _new_child(self):
+        return _Histogram(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        for values, child in sorted(self._children.items()):
+            total = 0
+            for le, count in zip(self.buckets + (float('inf'),), child.counts):
+                total += count
+                yield '_bucket', self._labels(values, ('le', format_value(float(le)))), total
+            yield '_sum', self._labels(values), child.sum
+            yield '_count', self._labels(values), total
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """ Metrics of server process in Prometheus text format """
+    def initialize(self, registry=REGISTRY):
+        self.registry = registry
+
+    def get(self):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(self.registry.render())
+
+
+DB_LATENCY = Histogram(
+    'wschat_db_call_seconds', 'Time of DataBase call, including wait in queue',
+    ['method']
+)
+COMMAND_LATENCY = Histogram(
+    'wschat_command_seconds', 'Time of handling user command', ['command']
+)
+MESSAGES = Counter(
+    'wschat_messages_total', 'Messages sent by users to room, rooms created by users '
+    'are counted as "other"', ['room']
+)
+FANOUT_LATENCY = Histogram(
+    'wschat_fanout_seconds', 'Time of sending message to waiters of room'
+)
+FANOUT_SIZE = Histogram(
+    'wschat_fanout_waiters', 'Number of waiters message is sent to',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+)
+COMPRESSION_BYTES_IN = Counter(
+    'wschat_compression_in_bytes_total', 'Bytes of messages before permessage-deflate'
+)
+COMPRESSION_BYTES_OUT = Counter(
+    'wschat_compression_out_bytes_total', 'Bytes of messages after permessage-deflate'
+)
+COMPRESSION_SECONDS = Counter(
+    'wschat_compression_seconds_total', 'Time spent in permessage-deflate'
+)
+WRITE_BEHIND_FLUSH = Histogram(
+    'wschat_write_behind_flush_seconds', 'Time of writing buffered messages to DataBase'
+)
+WRITE_BEHIND_BATCH = Histogram(
+    'wschat_write_behind_batch_messages', 'Number of messages written by one flush',
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+)
+WRITE_BEHIND_BUFFERED = Gauge(
+    'wschat_write_behind_buffered_messages', 'Messages waiting to be written to DataBase'
+)
@@ -0,0 +1,94 @@
+# coding: utf-8
+import binascii
+import hashlib
+import hmac
+import os
+import re
+
+from tornado import gen
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+
+ALGORITHM = 'pbkdf2_sha256'
+ITERATIONS = 100000
+SALT_SIZE = 16
+
+# Hashes of first versions: md5(password).hexdigest()
+_md5_re = re.compile(r'^[0-9a-f]{32}$')
+
+
+def hash_password(password, iterations=ITERATIONS, salt=None):
+    """ Slow salted hash of password:
+        "pbkdf2_sha256$iterations$salt$hash" (salt and hash in hex)
+    :param password: password (not hash)
+    """
+    if salt is None:
+        salt = binascii.hexlify(os.urandom(SALT_SIZE))
+    password = password.encode('utf-8') if isinstance(password, unicode) else password
+    digest = hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+    return '%s$%d$%s$%s' % (ALGORITHM, iterations, salt, binascii.hexlify(digest))
+
+
+def verify_password(password, pass_hash):
+    """ Check password against stored hash (of any known version)
+    :param password: password (not hash)
+    :param pass_hash: stored hash
+    :return: True if password is correct
+    """
+    password = password.encode('utf-8') if isinstance(password, unicode) else password
+    if _md5_re.match(pass_hash):
+        return hmac.compare_digest(hashlib.md5(password).hexdigest(), str(pass_hash))
+    try:
+        algorithm, iterations, salt, digest = pass_hash.split('$')
+        iterations = int(iterations)
+    except ValueError:
+        return False
+    if algorithm != ALGORITHM:
+        return False
+    return hmac.compare_digest(hash_password(password, iterations, str(salt)), str(pass_hash))
+
+
+def needs_rehash(pass_hash):
+    """ True if hash was made by old algorithm or with
+        less iterations than current
+    """
+    if _md5_re.match(pass_hash):
+        return True
+    try:
+        algorithm, iterations = pass_hash.split('$')[:2]
+        return algorithm != ALGORITHM or int(iterations) < ITERATIONS
+    except ValueError:
+        return True
+
+
+class PasswordHasher(object):
+    """ Hashing and verification of passwords in pool of threads.
+        Hash is slow on purpose, so it must never be computed on
+        IOLoop. hashlib releases GIL while hashing, so up to
+        max_workers passwords are hashed in parallel, other requests
+        wait in executor queue.
+        If max_workers is 0 or futures package is not installed,
+        passwords are hashed right away (blocking IOLoop).
+    """
+    def __init__(self, max_workers=4):
+        if max_workers and ThreadPoolExecutor is not None:
+            self.executor = ThreadPoolExecutor(max_workers)
+        else:
+            self.executor = None
+
+    def _call(self, method, *args):
+        if self.executor is None:
+            return gen.maybe_future(method(*args))
+        return self.executor.submit(method, *args)
+
+    def hash(self, password):
+        """ Future of hash_password """
+        return self._call(hash_password, password)
+
+    def verify(self, password, pass_hash):
+        """ Future of verify_password """
+        return self._call(verify_password, password, pass_hash)
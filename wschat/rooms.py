@@ -0,0 +1,158 @@
+# coding: utf-8
+import collections
+import time
+
+from tornado import gen
+
+
+class Room(object):
+    """ State of room in server process: connections subscribed
+        to room and cache of the last messages of room history
+    """
+    __slots__ = ('name', 'waiters', 'history', 'loading', 'arrived', 'used')
+
+    def __init__(self, name):
+        self.name = name
+        self.waiters = set()
+        # The last messages (db.Message), None - not loaded
+        self.history = None
+        # Future of history load, messages received during load
+        self.loading = None
+        self.arrived = []
+        self.used = time.time()
+
+
+class RoomManager(object):
+    """ Rooms of server process. State of room is created when room
+        is used first time (connection subscribes to it, its history
+        is requested) and is dropped, when room has no subscribers
+        and was not used for idle_ttl seconds, or there are more than
+        max_rooms rooms (the least recently used idle ones are dropped
+        first). Room itself and its history stay in DataBase.
+        History cache of room is loaded from DataBase once and then
+        updated by messages of room (see on_message), so subscription
+        to room doesn't go to DataBase.
+    """
+    def __init__(self, idle_ttl=300, max_rooms=1000, history_depth=10, history_ttl=None):
+        """ :param idle_ttl: seconds to keep room without subscribers
+            :param max_rooms: number of rooms, over which the least
+                recently used rooms without subscribers are dropped
+            :param history_depth: number of cached messages
+            :param history_ttl: max age of cached messages in seconds
+                (see db.DB)
+        """
+        self.idle_ttl = idle_ttl
+        self.max_rooms = max_rooms
+        self.history_depth = history_depth
+        self.history_ttl = history_ttl
+        # name -> Room, the least recently used first
+        self._rooms = collections.OrderedDict()
+
+    def get(self, name):
+        """ State of room, created if room has no state yet """
+        room = self._rooms.pop(name, None)
+        if room is None:
+            room = Room(name)
+            self._evict_oldest()
+        room.used = time.time()
+        self._rooms[name] = room
+        return room
+
+    def waiters(self, name):
+        """ Connections subscribed to room, without making room used """
+        room = self._rooms.get(name)
+        return room.waiters if room is not None else ()
+
+    def subscribe(self, name, connection):
+        self.get(name).waiters.add(connection)
+
+    def unsubscribe(self, name, connection):
+        room = self._rooms.get(name)
+        if room is not None:
+            room.waiters.discard(connection)
+            room.used = time.time()
+
+    @gen.coroutine
+    def get_history(self, name, db):
+        """ The last messages of room, cached
+        :param name: room name
+        :param db: db.AsyncDB instance to load history from
+        :return: list of db.Message or None if room doesn't exist
+        """
+        room = self.get(name)
+        if room.history is None:
+            loading = room.loading
+            if loading is None:
+                loading = self._load(room, db)
+                if not loading.done():
+                    # Messages received during load are kept
+                    room.loading = loading
+            yield loading
+            if room.history is None:
+                # Room doesn't exist
+                raise gen.Return(None)
+        raise gen.Return(self._expire(room.history))
+
+    @gen.coroutine
+    def _load(self, room, db):
+        try:
+            history = yield db.get_room_history(room.name)
+        finally:
+            room.loading = None
+        arrived, room.arrived = room.arrived, []
+        if history is None:
+            # Room doesn't exist, nothing to cache
+            raise gen.Return()
+        last_id = history[-1].id if history else 0
+        history.extend(x for x in arrived if x.id > last_id)
+        room.history = history[-self.history_depth:]
+
+    def on_message(self, name, message):
+        """ Add message to history cache of room
+        :param name: room name
+        :param message: db.Message
+        """
+        room = self._rooms.get(name)
+        if room is None:
+            return
+        if room.history is not None:
+            room.history.append(message)
+            del room.history[:-self.history_depth]
+        elif room.loading is not None:
+            room.arrived.append(message)
+
+    def _expire(self, history):
+        if self.history_ttl is None:
+            return list(history)
+        oldest = time.time() - self.history_ttl
+        return [x for x in history if x.time >= oldest]
+
+    def _evict_oldest(self):
+        """ Drop the least recently used idle room, if there are too many """
+        if len(self._rooms) < self.max_rooms:
+            return
+        for name, room in self._rooms.iteritems():
+            if not room.waiters and room.loading is None:
+                del self._rooms[name]
+                return
+
+    def evict(self):
+        """ Drop rooms without subscribers, which were not used
+            for idle_ttl seconds. Must be called periodically.
+        :return: number of dropped rooms
+        """
+        oldest = time.time() - self.idle_ttl
+        idle = [name for name, room in self._rooms.iteritems()
+                if not room.waiters and room.loading is None and room.used < oldest]
+        for name in idle:
+            del self._rooms[name]
+        return len(idle)
+
+    def __contains__(self, name):
+        return name in self._rooms
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def items(self):
+        return self._rooms.iteritems()
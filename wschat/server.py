@@ -1,33 +1,60 @@
 # coding: utf-8
 import os
+import re
+import signal
+import socket
 import logging
+import time
+import hashlib
 import tornado.web
 import tornado.websocket
 import tornado.escape
+import tornado.process
 
 from tornado.log import enable_pretty_logging
-enable_pretty_logging()
-from tornado.ioloop import IOLoop
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import StreamClosedError
+from tornado.locks import Lock
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
 from tornado import gen
 
-try:
-    import redis
-except ImportError:
-    redis = None
-    logging.warn(' redis-py is not installed, all data will be lost on restart')
+from .bus import LocalBus
+from .capture import CaptureWriter
+from .broadcast import PreparedMessage, OutboundQueue, DeflateCompressor
+from .db import redis, ThreadPoolExecutor, Message, AsyncDBPython, WriteBehind
+from .rooms import RoomManager
+from .metrics import (MetricsHandler, CallbackGauge, bounded_label, COMMAND_LATENCY,
+                      MESSAGES, FANOUT_LATENCY, FANOUT_SIZE)
+from .session import Session
+from .static import PrecompressedStaticFileHandler
+from .watchdog import LagWatchdog
 
-if redis is not None:
-    try:
-        r = redis.Redis()
-        r.info()
-        from .db import DBRedis as DBInterface
-    except redis.exceptions.ConnectionError:
-        logging.warn('Cant connect to REDIS, all data will be lost on restart')
-        from .db import DBPython as DBInterface
-else:
-    from .db import DBPython as DBInterface
 
-DB = DBInterface()
+def format_message(room, message):
+    """ Text of user message frame: "MESSAGE:id:[room] nickname: mess"
+    :param room: room name
+    :param message: db.Message
+    """
+    return 'MESSAGE:%d:[%s] %s' % (message.id, room, message.text)
+
+
+def format_history(room, history):
+    """ Text of history frame, all messages are packed into one frame:
+        'HISTORY:{"room": room, "messages": [[id, "nickname: mess"], ...]}'
+    :param room: room name
+    :param history: list/tuple of db.Message
+    """
+    history = dict(room=room, messages=[(x.id, x.text) for x in history])
+    return 'HISTORY:%s' % tornado.escape.json_encode(history)
+
+
+def format_gap(room, last_seen):
+    """ Text of frame which tells that messages of room after
+        last seen one can not be sent, the last messages follow:
+        'GAP:{"room": room, "last_seen": id}'
+    """
+    return 'GAP:%s' % tornado.escape.json_encode(dict(room=room, last_seen=last_seen))
 
 
 class CommandsMixin(object):
@@ -38,6 +65,8 @@ class CommandsMixin(object):
           Arguments: all commands methods must expect one argument -
             utf-8 string to recognize needed arguments itself, or
             ignore them
+          Asynchronous: all commands methods are coroutines,
+            DataBase (db.AsyncDB) calls are yielded
     """
     def __init__(self):
         # Original variable
@@ -47,11 +76,13 @@ class CommandsMixin(object):
             register=self.user_command_register,
             join=self.user_command_join_room,
             left=self.user_command_left_room,
-            change=self.user_command_change_nick
+            change=self.user_command_change_nick,
+            history=self.user_command_history,
+            create=self.user_command_create_room
         )
         # Must be overwritten
         self.db = None
-        self._user = None
+        self.session = None
 
     # Child Implementation methods
     def send_server_message(self, mess):
@@ -59,22 +90,21 @@ class CommandsMixin(object):
         raise NotImplementedError('"send_server_message" method must be overwritten')
 
     def connect_to_room(self, room):
-        """ Must be overwritten """
+        """ Must be overwritten. Coroutine """
         raise NotImplementedError('"connect_to_room" method must be overwritten')
 
     def disconnect_from_room(self, room):
-        """ Must be overwritten """
+        """ Must be overwritten. Coroutine """
         raise NotImplementedError('"disconnect_from_room" method must be overwritten')
 
-    @property
-    def current_rooms(self):
+    def send_history(self, room, history):
         """ Must be overwritten """
-        raise NotImplementedError('"current_rooms" property must be overwritten')
+        raise NotImplementedError('"send_history" method must be overwritten')
 
     @property
-    def all_rooms(self):
+    def current_rooms(self):
         """ Must be overwritten """
-        raise NotImplementedError('"all_rooms" property must be overwritten')
+        raise NotImplementedError('"current_rooms" property must be overwritten')
 
     @property
     def current_user(self):
@@ -82,6 +112,7 @@ class CommandsMixin(object):
         raise NotImplementedError('"current_user" property must be overwritten')
 
     # Original methods
+    @gen.coroutine
     def recognize_command(self, mess):
         """ Recognize received command and try to call
             suitable method.
@@ -93,11 +124,15 @@ class CommandsMixin(object):
         mess = mess[1:].split(' ', 1)
         command = mess[0].lower()
         args = mess[1] if len(mess) - 1 else ''
+        start = time.time()
         if command not in self.known_commands:
             self.send_server_message('Unknown command')
+            command = 'unknown'
         else:
-            self.known_commands[command.lower()](args)
+            yield self.known_commands[command.lower()](args)
+        COMMAND_LATENCY.labels(command).observe(time.time() - start)
 
+    @gen.coroutine
     def user_command_login(self, login_password):
         """ Login user.
             Required command view: 'login user_login password'.
@@ -107,9 +142,10 @@ class CommandsMixin(object):
         mess = ''
         try:
             login, password = login_password[0], login_password[1]
-            user = self.db.is_correct_user(login, password)
         except IndexError:
             mess = 'Wrong command usage'
+        else:
+            user = yield self.db.is_correct_user(login, password)
         if mess:
             pass
         elif user is None:
@@ -119,21 +155,23 @@ class CommandsMixin(object):
         else:
             # No error during login
             mess = 'You are logged in as "%s"' % login
-            self._user = login
-            if (self in self.waiters[self.db.default_room]
+            yield self.session.login_as(login)
+            if (self.db.default_room in self.subscribed
                 and self.db.default_room not in self.current_rooms):
-                self.db.add_room_to_current(login, self.db.default_room)
+                yield self.session.add_room(self.db.default_room)
 
         self.send_server_message(mess)
 
+    @gen.coroutine
     def user_command_logout(self, args):
         """ Logout.
             Just change own user value to None
         :param args: not needed. Ignored.
         """
-        self._user = None
+        self.session.logout()
         self.send_server_message('You are logged out')
 
+    @gen.coroutine
     def user_command_register(self, login_password):
         """ Register new user.
             Required command view: 'register user_login password'.
@@ -146,13 +184,14 @@ class CommandsMixin(object):
         except IndexError:
             mess = 'Wrong command usage'
         if not mess:
-            user = self.db.new_user(login, password)
+            user = yield self.db.new_user(login, password)
             if user is None:
                 mess = 'Such user already exists'
             else:
                 mess = 'User "%s" successfully created. Try to login.' % login
         self.send_server_message(mess)
 
+    @gen.coroutine
     def user_command_join_room(self, room_room):
         """ Adding self to waiters of room.
             Required command view: 'join room room_name'.
@@ -168,18 +207,50 @@ class CommandsMixin(object):
             pass
         elif room.lower() != 'room':
             mess = 'Unknown join'
-        elif room_name.lower() not in map(lambda x: x.lower(), self.all_rooms):
-            mess = 'Cannot join. Unknown room'
         else:
             # Find right room name writing
-            for room in self.all_rooms:
-                if room_name.lower() == room.lower():
-                    room_name = room
-                    break
-            self.connect_to_room(room_name)
+            room = yield self.db.resolve_room(room_name)
+            if room is None:
+                mess = 'Cannot join. Unknown room'
+            else:
+                yield self.connect_to_room(room)
         if mess:
             self.send_server_message(mess)
 
+    room_name_re = re.compile(r'^[\w .\-]{1,64}$', re.UNICODE)
+
+    @gen.coroutine
+    def user_command_create_room(self, room_room):
+        """ Create new room and join it.
+            Required command view: 'create room room_name'.
+        :param room_room: separated part "room room_name"
+        """
+        room_room = room_room.strip(' ').split(' ', 1)
+        mess = ''
+        try:
+            room, room_name = room_room[0], room_room[1].strip(' ')
+        except IndexError:
+            mess = 'Wrong command usage'
+        if mess:
+            pass
+        elif room.lower() != 'room':
+            mess = 'What must I create?'
+        elif self.current_user is None:
+            mess = 'Only logged in users can create rooms'
+        elif self.room_name_re.match(room_name) is None:
+            mess = 'Room name must be up to 64 letters, digits, spaces, ".", "-" or "_"'
+        else:
+            created = yield self.db.new_room(room_name)
+            if not created:
+                mess = 'Room "%s" already exists' % room_name
+            else:
+                self.bus.publish('room_created', room_name, None)
+                self.send_server_message('Room "%s" created' % room_name)
+                yield self.connect_to_room(room_name)
+        if mess:
+            self.send_server_message(mess)
+
+    @gen.coroutine
     def user_command_left_room(self, room_room):
         """ Removing self from waiters of room.
             Required command view: 'left room room_name'.
@@ -195,18 +266,17 @@ class CommandsMixin(object):
             pass
         elif room.lower() != 'room':
             mess = 'What must I left?'
-        elif room_name.lower() not in map(lambda x: x.lower(), self.current_rooms):
-            mess = 'You were not joined to room "%s"' % room_name
         else:
             # Find right room name writing
-            for room in self.current_rooms:
-                if room_name.lower() == room.lower():
-                    room_name = room
-                    break
-            self.disconnect_from_room(room_name)
+            room = yield self.db.resolve_room(room_name)
+            if room is None or room not in self.current_rooms:
+                mess = 'You were not joined to room "%s"' % room_name
+            else:
+                yield self.disconnect_from_room(room)
         if mess:
             self.send_server_message(mess)
 
+    @gen.coroutine
     def user_command_change_nick(self, args):
         """ Changing nickname in room or all rooms
             Required command view: 'change nick room_name new_nick'
@@ -229,36 +299,155 @@ class CommandsMixin(object):
                 room, nick = args.split(' ', 1)
                 nick = nick.strip(' ')
         # Checking arguments
+        rooms = self.current_rooms
+        if not mess and room and room != '*':
+            # Find right room name writing
+            _room = yield self.db.resolve_room(room)
+            rooms = [_room] if _room in rooms else []
         if mess:
             pass
         elif not(room and nick):
             mess = 'Wrong command usage'
-        elif room != '*' and room.lower() not in map(lambda x: x.lower(), self.current_rooms):
+        elif not rooms and room != '*':
             mess = 'You were not joined to room "%s"' % room
         else:
-            # Find right room name writing
-            rooms = self.current_rooms
-            if room != '*':
-                for _room in self.current_rooms:
-                    if room.lower() == _room.lower():
-                        rooms = [_room]
-                        break
             for room in rooms:
                 mess = 'Your nick changed to "%s" in room "%s"' % (nick, room)
-                self.db.change_nick_in_room(self.current_user, room, nick)
+                yield self.session.change_nick(room, nick)
                 self.send_server_message(mess)
 
+    history_command_re = re.compile(
+        r'^room\s+(?P<room>.+?)(?:\s+before\s+(?P<before>\d+))?(?:\s+limit\s+(?P<limit>\d+))?\s*$',
+        re.IGNORECASE
+    )
+    history_max_limit = 100
+
+    @gen.coroutine
+    def user_command_history(self, args):
+        """ Send page of room history, older than given message id.
+            Required command view: 'history room room_name [before id] [limit n]'
+        :param args: separated part 'room room_name before id limit n'
+        """
+        mess = ''
+        match = self.history_command_re.match(args.strip(' '))
+        limit = int(match.group('limit') or 10) if match is not None else 0
+        if limit < 1:
+            mess = 'Wrong command usage'
+        else:
+            room_name = match.group('room')
+            before = match.group('before')
+            before = int(before) if before is not None else None
+            limit = min(limit, self.history_max_limit)
+            room = yield self.db.resolve_room(room_name)
+            if room is None or room not in self.current_rooms:
+                mess = 'You were not joined to room "%s"' % room_name
+            else:
+                history = yield self.db.get_messages(room, before, limit)
+                if history:
+                    self.send_history(room, history)
+                else:
+                    mess = 'No more messages in room "%s"' % room
+        if mess:
+            self.send_server_message(mess)
+
+
+class IndexCache(object):
+    """ Rendered list of rooms of index page, shared by all requests.
+        Rooms are loaded from DataBase once and rendered again only
+        when room is created (room_created event of bus, so rooms
+        created by other processes are seen too) or after ttl seconds
+        (rooms created not by server).
+    """
+    def __init__(self, db, ttl=60):
+        """ :param db: db.AsyncDB instance
+            :param ttl: seconds to keep rendered list
+        """
+        self.db = db
+        self.ttl = ttl
+        # (html, hash of html), None - not rendered
+        self._rendered = None
+        self._expires = 0
+        self._loading = None
+        # Changed on invalidation, so load started before is not cached
+        self._generation = 0
+
+    @gen.coroutine
+    def get(self, render):
+        """ Rendered list of rooms
+        :param render: function(rooms) -> html, called on cache miss
+        :return: (html, hash of html)
+        """
+        start = time.time()
+        while self._rendered is None or self._expires < start:
+            loading = self._loading
+            if loading is None:
+                loading = self._load(render)
+                if not loading.done():
+                    # Concurrent requests wait for the same load
+                    self._loading = loading
+            yield loading
+        raise gen.Return(self._rendered)
+
+    @gen.coroutine
+    def _load(self, render):
+        generation = self._generation
+        try:
+            rooms = yield self.db.get_all_rooms()
+        finally:
+            if generation == self._generation:
+                self._loading = None
+        if generation == self._generation:
+            html = render(sorted(rooms))
+            self._rendered = html, hashlib.sha1(html).hexdigest()
+            self._expires = time.time() + self.ttl
+
+    def invalidate(self):
+        self._generation += 1
+        self._rendered = None
+        self._loading = None
+
+    def on_bus_event(self, kind, room, data):
+        """ Called by bus on every room event (see bus.Bus) """
+        if kind == 'room_created':
+            self.invalidate()
+
 
 class MainHandler(tornado.web.RequestHandler):
-    def initialize(self):
-        self.db = DB
+    # Path of template -> hash of its content
+    _template_versions = dict()
+
+    def initialize(self, db, index_cache):
+        """ :param db: db.AsyncDB instance
+            :param index_cache: IndexCache instance
+        """
+        self.db = db
+        self.index_cache = index_cache
+        self.rooms_hash = None
+
+    @gen.coroutine
+    def prepare(self):
+        """ Get authorized user from cookie record """
+        user = self.get_secure_cookie('user')
+        if user is not None and not (yield self.db.user_exists(user)):
+            # Non-existent in database user
+            self.clear_cookie('user')
+            user = None
+        self.current_user = user
 
     @gen.coroutine
     def get(self):
         usr = self.current_user
         if usr is not None:
             usr = tornado.escape.xhtml_escape(usr)
-        self.render("index.html", usr=usr, error='', rooms=self.all_rooms)
+        rooms_html, self.rooms_hash = yield self.index_cache.get(self.render_rooms)
+        # Page depends on cookies, it is revalidated by Etag every time
+        self.set_header('Cache-Control', 'private, no-cache')
+        self.set_header('Vary', 'Cookie')
+        self.set_etag_header()
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.render("index.html", usr=usr, error='', rooms_html=rooms_html)
 
     @gen.coroutine
     def post(self):
@@ -279,110 +468,171 @@ class MainHandler(tornado.web.RequestHandler):
         # Check empty/not given fields
         if None in (login, password) or not (login and password):
             error = 'Empty field'
-            self.render('index.html', usr=None, error=error, rooms=self.all_rooms)
+            rooms_html, _ = yield self.index_cache.get(self.render_rooms)
+            self.render('index.html', usr=None, error=error, rooms_html=rooms_html)
             return
         if create:
             # Registration
-            user = self.db.new_user(login, password)
+            user = yield self.db.new_user(login, password)
             if user is None:
                 error = 'Such user already exists'
         else:
             # Login
-            user = self.db.is_correct_user(login, password)
+            user = yield self.db.is_correct_user(login, password)
             if user is None:
                 error = "No such user"
             elif not user:
                 error = 'Wrong password'
         if error:
             # Error during Login/Registration
-            self.render('index.html', usr=None, error=error, rooms=self.all_rooms)
+            rooms_html, _ = yield self.index_cache.get(self.render_rooms)
+            self.render('index.html', usr=None, error=error, rooms_html=rooms_html)
             return
         self.set_secure_cookie('user', login)
-        self.db.add_room_to_current(login, self.db.default_room)
+        yield self.db.add_room_to_current(login, self.db.default_room)
         self.redirect('/')
 
-    def get_current_user(self):
-        """ Get authorized user from cookie record """
-        user = self.get_secure_cookie('user')
-        if self.db.is_correct_user(user, '') is None:
-            # Non-existent in database user
-            self.clear_cookie('user')
-            user = None
-        return user
+    def render_rooms(self, rooms):
+        """ Render list of rooms of page (see IndexCache) """
+        return self.render_string('rooms.html', rooms=rooms)
 
-    @property
-    def all_rooms(self):
-        """ Value of all created rooms, stored in DataBase """
-        return self.db.all_rooms
+    def compute_etag(self):
+        """ Etag of page is computed from what it is rendered
+            of, before rendering (see get). Page is the same for
+            the same template, static files, rooms, user and
+            xsrf cookie (form token is masked by random on every
+            render, so content hash would always differ).
+        """
+        xsrf = self.get_cookie('_xsrf')
+        if xsrf is None or self.rooms_hash is None:
+            # New xsrf cookie is set by page
+            return None
+        hasher = hashlib.sha1()
+        for part in (self.template_version('index.html'), self.static_url('index.css'),
+                     self.static_url('client.js'), self.rooms_hash, xsrf,
+                     self.current_user or ''):
+            hasher.update(part)
+            hasher.update('\0')
+        return '"%s"' % hasher.hexdigest()
 
+    def template_version(self, name):
+        """ Hash of template content, computed once per process """
+        path = os.path.join(self.get_template_path(), name)
+        version = self._template_versions.get(path)
+        if version is None:
+            with open(path, 'rb') as f:
+                version = hashlib.sha1(f.read()).hexdigest()
+            self._template_versions[path] = version
+        return version
 
-class ChatHandler(tornado.websocket.WebSocketHandler, CommandsMixin):
-    waiters = dict()
-    for room in DB.all_rooms:
-        waiters[room] = set()
 
-    def __init__(self, *args, **kwargs):
-        super(ChatHandler, self).__init__(*args, **kwargs)
-        self.db = DB
-        self._user = None
+class ChatMixin(CommandsMixin):
+    """ Transport independent part of chat connection: rooms
+        subscription, messages handling and fanout. Rooms and their
+        waiters are shared by all transports (WebSocket, TCP).
+        Child must implement write_prepared and call setup_connection
+        before connection is used and unsubscribe when it is closed.
+    """
+    rooms = RoomManager()
+    # All opened connections
+    connections = set()
 
-    def check_origin(self, origin):
-        return True
+    def setup_connection(self, db, bus):
+        """ :param db: db.AsyncDB instance
+            :param bus: bus.Bus instance
+        """
+        self.db = db
+        self.bus = bus
+        self.session = Session(self.db, self.bus)
+        self.outbound = None
+        # Messages of connection are handled one by one
+        self._lock = Lock()
+        # room -> id of last message received by client before reconnect
+        self.last_seen = dict()
+        # Rooms connection is subscribed to
+        self.subscribed = set()
 
-    def open(self):
-        user = self.get_secure_cookie('user')
-        if user is None:
-            self.connect_to_room(self.db.default_room)
-        else:
-            self._user = user
-            for room in self.db.get_current_rooms(user):
-                self.connect_to_room(room)
+    def write_prepared(self, mess):
+        """ Must be overwritten """
+        raise NotImplementedError('"write_prepared" method must be overwritten')
 
-    def on_close(self):
-        # Remove self from message waiters (unsubscribe)
-        for room in self.current_rooms:
-            if self in self.waiters[room]:
-                self.waiters[room].remove(self)
+    def unsubscribe(self):
+        """ Remove self from message waiters of all rooms """
+        self.connections.discard(self)
+        self.session.close()
+        for room in self.subscribed:
+            self.rooms.unsubscribe(room, self)
+        self.subscribed.clear()
 
-    def on_message(self, mess):
-        """ Called when was received a message. Checking and
-            saving message. If message contains contains
-            command to server, call suitable method.
+    @gen.coroutine
+    def handle_message(self, mess):
+        """ Checking and saving received message. If message
+            contains command to server, call suitable method.
         :param mess: utf-8 string, if mess starts with '#' -
             it is a command for server. In general view:
             '#command arg1 arg2 arg3 ... argN'
         """
-        rooms = self.current_rooms
-        user = self.current_user
+        with (yield self._lock.acquire()):
+            try:
+                yield self._handle_message(mess)
+            except (tornado.websocket.WebSocketClosedError, StreamClosedError):
+                # Connection was closed while message was handled
+                pass
+
+    @gen.coroutine
+    def _handle_message(self, mess):
         if mess.startswith('#'):
             # Command
-            logging.info('Recieved command: `%s`', mess)
-            self.recognize_command(mess)
+            logging.debug('Recieved command: `%s`', mess)
+            yield self.recognize_command(mess)
         else:
-            if not list(self.current_rooms):
+            rooms = self.current_rooms
+            if not rooms:
                 self.send_server_message('You are not connected to any room')
             for room in rooms:
-                nick = self.db.get_current_nick(user, room)
+                nick = self.session.get_nick(room)
                 # Message
                 _mess = '%s: %s' % (nick, tornado.escape.xhtml_escape(mess))
-                self.db.new_message(room, _mess)
-                self.send_to_waiters(room, _mess)
+                message = yield self.db.new_message(room, _mess)
+                MESSAGES.labels(bounded_label(room, self.db.default_rooms)).inc()
+                self.bus.publish('message', room, message)
 
-    def send_to_waiters(self, room, mess):
+    @classmethod
+    def on_bus_event(cls, kind, room, data):
+        """ Called by bus on every room event of any server process
+            (see bus.Bus). Messages are sent to waiters of this
+            process, membership events are applied to sessions.
+        """
+        if kind == 'message':
+            message = Message(*data)
+            cls.rooms.on_message(room, message)
+            cls.send_to_waiters(room, message)
+        elif kind in ('join', 'left', 'nick'):
+            login, nick = data
+            Session.apply_event(kind, room, login, nick)
+
+    @classmethod
+    def send_to_waiters(cls, room, message):
         """ Send received message to all waiters of room.
             This method sends users messages only, not
             server answers. General view of sending
-            message: "MESSAGE:[room] nickname: mess"
+            message: "MESSAGE:id:[room] nickname: mess"
         :param room: room name where message was sent
-        :param mess: received message
+        :param message: saved message (db.Message)
         """
-        mess = 'MESSAGE:[%s] %s' % (room, mess)
-        for waiter in self.waiters[room]:
+        start = time.time()
+        mess = PreparedMessage(format_message(room, message))
+        waiters = cls.rooms.waiters(room)
+        for waiter in waiters:
             try:
-                waiter.write_message(mess)
-            except:
+                waiter.write_prepared(mess)
+            except (tornado.websocket.WebSocketClosedError, StreamClosedError):
+                # Connection is closing, it will be unsubscribed on close
                 pass
+        FANOUT_LATENCY.observe(time.time() - start)
+        FANOUT_SIZE.observe(len(waiters))
 
+    @gen.coroutine
     def connect_to_room(self, room):
         """ Add self to waiters of rooms (subscribe)
             NOTE: you must check if room exists
@@ -392,35 +642,61 @@ class ChatHandler(tornado.websocket.WebSocketHandler, CommandsMixin):
         user = self.current_user
         current_rooms = set(self.current_rooms)
         for _room in self.current_rooms:
-            if self not in self.waiters[_room]:
+            if _room not in self.subscribed:
                 current_rooms.remove(_room)
         if user is None:
-            allowed_rooms = [self.db.default_room]
+            allowed = room == self.db.default_room
         else:
-            allowed_rooms = set(self.all_rooms) - current_rooms
-        if self in self.waiters[room]:
+            allowed = (yield self.db.resolve_room(room)) == room
+        if room in self.subscribed:
             mess = 'You are already connected to room "%s"' % room
-        elif room not in allowed_rooms:
+        elif not allowed:
             mess = 'You cant connect to room "%s"' % room
         else:
-            self.waiters[room].add(self)
+            self.subscribed.add(room)
+            self.rooms.subscribe(room, self)
             if room not in current_rooms:
-                self.db.add_room_to_current(user, room)
+                yield self.session.add_room(room)
             mess = 'You are connected to room: "%s" as "%s"' % \
-                   (room, self.db.get_current_nick(user, room))
-            history = self.db.get_room_history(room)
-            self.send_history(room, history)
+                   (room, self.session.get_nick(room))
+            last_seen = self.last_seen.pop(room, None)
+            if last_seen is None:
+                history = yield self.rooms.get_history(room, self.db)
+                self.send_history(room, history)
+            else:
+                yield self.send_history_since(room, last_seen)
         self.send_server_message(mess)
 
+    @gen.coroutine
+    def send_history_since(self, room, last_seen):
+        """ Send messages of room, which client missed after
+            last seen one. If there are too many of them, or history
+            doesn't contain last seen message any more, GAP frame
+            and last messages are sent.
+        :param room: room name
+        :param last_seen: id of last message client has
+        """
+        limit = self.settings.get('resume_limit', 100)
+        # Last seen message, up to limit missed ones and one more
+        # to know there are too many of them
+        history = yield self.db.get_messages_since(room, last_seen, limit + 2)
+        if history and history[0].id == last_seen and len(history) <= limit + 1:
+            self.send_history(room, history[1:])
+        else:
+            self.write_prepared(PreparedMessage(format_gap(room, last_seen)))
+            history = yield self.rooms.get_history(room, self.db)
+            self.send_history(room, history)
+
+    @gen.coroutine
     def disconnect_from_room(self, room):
         """ Remove self from waiters of room (unsubscribe)
             NOTE: you must check if room exists
               before calling this method
         :param room: room name to unsubscribe
         """
-
-        self.waiters[room].remove(self)
-        self.db.remove_room_from_current(self.current_user, room)
+        self.subscribed.discard(room)
+        self.rooms.unsubscribe(room, self)
+        yield self.session.remove_room(room)
         self.send_server_message('You are disconnected from room: "%s"' % room)
 
     def send_server_message(self, mess):
@@ -432,33 +708,32 @@ class ChatHandler(tornado.websocket.WebSocketHandler, CommandsMixin):
         """
         mess = 'SERVER:%s' % mess
         mess = tornado.escape.xhtml_escape(mess)
-        self.write_message(mess)
+        self.write_prepared(PreparedMessage(mess))
 
     def send_history(self, room, history):
-        """ Send last N messages of room to user.
+        """ Send last N messages of room to user in one frame
+            (see format_history).
         :param room: room name
-        :param history: list/tuple of last messages taken from db.
-            DataBase stores messages as "user: mess", so for
-            general view "MESSAGE:[room] user: mess" we need to
-            add "MESSAGE:[room] "
+        :param history: list/tuple of last messages (db.Message)
+            taken from db.
         """
-        for mess in history:
-            mess = 'MESSAGE:[%s] %s' % (room, mess)
-            self.write_message(mess)
+        if history:
+            self.write_prepared(PreparedMessage(format_history(room, history)))
 
     @property
     def current_user(self):
-        """ Rewritten property of current user. By default tornado
-            caches value given from "get_current_user", so we need
-            rewrite it to receive actual user.
-        """
-        return self.get_current_user()
+        """ Login of logged in user or None """
+        return self.session.login
 
-    def get_current_user(self):
-        """ Rewritten method to get current user. Our Handler
-            stores own value of current user per connection.
-        """
-        return self._user
+    @property
+    def queue_depth(self):
+        """ Number of frames waiting in outbound queue """
+        return self.outbound.depth if self.outbound is not None else 0
+
+    @property
+    def dropped_messages(self):
+        """ Number of frames dropped by slow consumer policy """
+        return self.outbound.dropped if self.outbound is not None else 0
 
     @property
     def current_rooms(self):
@@ -467,34 +742,452 @@ class ChatHandler(tornado.websocket.WebSocketHandler, CommandsMixin):
         user = self.current_user
         if user is None:
             droom = self.db.default_room
-            return [droom] if self in self.waiters[droom] else list()
+            return [droom] if droom in self.subscribed else list()
         else:
-            return self.db.get_current_rooms(user)
+            return self.session.rooms
+
+
+CallbackGauge(
+    'wschat_connections', 'Opened connections',
+    lambda: [((), len(ChatMixin.connections))]
+)
+CallbackGauge(
+    'wschat_room_connections', 'Connections subscribed to room',
+    lambda: [((name,), len(room.waiters)) for name, room in ChatMixin.rooms.items()],
+    ['room']
+)
+CallbackGauge(
+    'wschat_rooms', 'Rooms with state in process (see rooms.RoomManager)',
+    lambda: [((), len(ChatMixin.rooms))]
+)
+CallbackGauge(
+    'wschat_outbound_frames', 'Frames waiting in outbound queues of connections',
+    lambda: [((), sum(x.queue_depth for x in ChatMixin.connections))]
+)
+CallbackGauge(
+    'wschat_outbound_bytes', 'Bytes waiting to be written to connections',
+    lambda: [((), sum(x.outbound.size for x in ChatMixin.connections if x.outbound))]
+)
+CallbackGauge(
+    'wschat_outbound_max_bytes', 'Bytes waiting to be written to the slowest connection',
+    lambda: [((), max([x.outbound.size for x in ChatMixin.connections if x.outbound] or [0]))]
+)
+
+
+class ChatHandler(tornado.websocket.WebSocketHandler, ChatMixin):
+    def initialize(self, db, bus):
+        """ :param db: db.AsyncDB instance
+            :param bus: bus.Bus instance
+        """
+        self.setup_connection(db, bus)
+        # capture.CaptureWriter, if traffic is captured
+        self.capture = self.settings.get('capture')
+        self.capture_id = None
+        # broadcast.DeflateCompressor, if compression is negotiated
+        self.compressor = None
+
+    def check_origin(self, origin):
+        return True
+
+    def get_compression_options(self):
+        """ Allow permessage-deflate if 'compression' setting is given:
+            dict(min_size=..., level=..., mem_level=...), see
+            broadcast.DeflateCompressor
+        """
+        options = self.settings.get('compression')
+        return None if options is None else dict()
+
+    def setup_compressor(self):
+        """ Replace compressor created by Tornado (it always uses
+            default compression level and compresses every message)
+            with own one, negotiated parameters are kept
+        """
+        conn = self.ws_connection
+        if conn is None or conn._compressor is None:
+            return
+        negotiated = conn._compressor
+        self.compressor = DeflateCompressor(
+            max_wbits=negotiated._max_wbits,
+            persistent=negotiated._compressor is not None,
+            **self.settings['compression']
+        )
+        conn._compressor = self.compressor
+
+    @gen.coroutine
+    def open(self):
+        self.setup_compressor()
+        self.outbound = OutboundQueue(
+            self.stream,
+            maxsize=self.settings.get('outbound_queue_size', 256),
+            policy=self.settings.get('outbound_policy', 'drop_oldest'),
+            on_overflow=self.on_slow_consumer,
+            # Compressed frames are built when they are written
+            encode=None if self.compressor is None else self.compressor.frame
+        )
+        self.connections.add(self)
+        if self.capture is not None:
+            self.capture_id = self.capture.open(self.get_secure_cookie('user'))
+        self.last_seen = self.parse_last_seen(self.get_argument('last_seen', None))
+        with (yield self._lock.acquire()):
+            user = self.get_secure_cookie('user')
+            if user is not None and not (yield self.db.user_exists(user)):
+                # Non-existent in database user
+                user = None
+            if user is None:
+                yield self.connect_to_room(self.db.default_room)
+            else:
+                yield self.session.login_as(user)
+                for room in self.session.rooms:
+                    yield self.connect_to_room(room)
+
+    @staticmethod
+    def parse_last_seen(value):
+        """ Parse last seen messages, passed by client on reconnect
+            as json object {room: id}. Wrong values are ignored.
+        """
+        if not value:
+            return dict()
+        try:
+            value = tornado.escape.json_decode(value)
+            return dict((room, int(_id)) for room, _id in value.items())
+        except (ValueError, TypeError, AttributeError):
+            return dict()
+
+    def on_close(self):
+        if self.capture_id is not None:
+            self.capture.close(self.capture_id)
+        self.unsubscribe()
+
+    def on_message(self, mess):
+        """ Called when was received a message (see ChatMixin.handle_message) """
+        if self.capture_id is not None:
+            self.capture.message(self.capture_id, mess)
+        return self.handle_message(mess)
+
+    def write_prepared(self, mess):
+        """ Put message which was already encoded and framed
+            (see broadcast.PreparedMessage) to outbound queue.
+            Frame is used as is, except long messages on connections
+            with negotiated compression, which need own frame. Such
+            frame is built by queue when it is written, so messages
+            dropped by queue don't break shared compression context.
+        :param mess: PreparedMessage instance
+        """
+        if self.ws_connection is None or self.outbound is None:
+            raise tornado.websocket.WebSocketClosedError()
+        self.outbound.put(mess if self.compressor is not None else mess.frame)
+
+    def on_slow_consumer(self):
+        """ Called when outbound queue overflows with 'disconnect' policy """
+        logging.warning('Slow consumer %s (user: %s) disconnected, %d messages dropped',
+                        self.request.remote_ip, self.current_user, self.outbound.dropped)
+        self.stream.close()
 
     @property
-    def all_rooms(self):
-        """ Value of all created rooms, stored in DataBase """
-        return self.db.all_rooms
+    def current_user(self):
+        """ Rewritten property of current user. By default tornado
+            caches value given from "get_current_user", so we need
+            rewrite it to receive actual user.
+        """
+        return self.get_current_user()
 
+    def get_current_user(self):
+        """ Rewritten method to get current user. Our Handler
+            stores own value of current user per connection.
+        """
+        return self.session.login
 
-def main(host, port):
-    handlers = [
-        (r"/", MainHandler),
-        (r"/chat", ChatHandler)
-    ]#join room Python Developers
+
+def make_app(db=None, bus=None, **settings):
+    """ Create application with own DataBase and bus.
+        NOTE: in multi-process mode it must be called after fork,
+          so connections to DataBase are not shared between processes.
+    :param db: db.AsyncDB instance, in memory one if not given
+    :param bus: bus.Bus instance, bus of process if not given
+        (see create_backends)
+    :param settings: overwrite default application settings
+    """
+    if db is None:
+        db = AsyncDBPython()
+    if bus is None:
+        bus = LocalBus()
+    bus.subscribe(ChatHandler.on_bus_event)
     sett = {
         'cookie_secret': '%RamblerTask-WebSocketChat%',
         'template_path': os.path.join(os.path.dirname(__file__), 'templates'),
         'static_path': os.path.join(os.path.dirname(__file__), 'static'),
+        # Sends "file.gz" copies if there are (see static.compress_static)
+        'static_handler_class': PrecompressedStaticFileHandler,
         'xsrf_cookies': True,
+        # Seconds to keep rendered list of rooms of index page
+        'index_cache_ttl': 60,
+        # Frames per connection waiting for slow client
+        'outbound_queue_size': 256,
+        # What to do when queue is full: drop_oldest, drop_newest, disconnect
+        'outbound_policy': 'drop_oldest',
+        # Max number of missed messages per room sent on reconnect
+        'resume_limit': 100,
+        # permessage-deflate: None - disabled, or
+        # dict(min_size=1024, level=6, mem_level=8)
+        'compression': dict(min_size=1024, level=6, mem_level=8),
+        'bus': bus,
     }
-    app = tornado.web.Application(handlers, **sett)
-    app.listen(port, host)
+    sett.update(settings)
+    index_cache = IndexCache(db, sett['index_cache_ttl'])
+    bus.subscribe(index_cache.on_bus_event)
+    handlers = [
+        (r"/", MainHandler, dict(db=db, index_cache=index_cache)),
+        (r"/chat", ChatHandler, dict(db=db, bus=bus)),
+        (r"/metrics", MetricsHandler),
+    ]
+    return tornado.web.Application(handlers, **sett)
+
+
+def app_settings(outbound_queue_size=256, outbound_policy='drop_oldest', resume_limit=100,
+                 compression=True, compression_min_size=1024, compression_level=6,
+                 compression_mem_level=8):
+    """ Application settings of connections (see make_app)
+        from options of server
+    :param compression: enable permessage-deflate with
+        compression_min_size, compression_level and compression_mem_level
+        (see broadcast.DeflateCompressor)
+    """
+    settings = dict(
+        outbound_queue_size=outbound_queue_size,
+        outbound_policy=outbound_policy,
+        resume_limit=resume_limit,
+        compression=None,
+    )
+    if compression:
+        settings['compression'] = dict(min_size=compression_min_size, level=compression_level,
+                                       mem_level=compression_mem_level)
+    return settings
+
+
+def bind_reuse_port(port, host):
+    """ Bind listening sockets with SO_REUSEPORT option, so every
+        process binds own socket and kernel balances connections
+        between them (linux 3.9+).
+        NOTE: bind_sockets of Tornado 4.2 has no such option.
+    """
+    reuse_port = getattr(socket, 'SO_REUSEPORT', None)
+    if reuse_port is None:
+        raise ValueError('SO_REUSEPORT is not supported on this platform')
+    sockets = []
+    addresses = socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM,
+                                   0, socket.AI_PASSIVE)
+    for family, socktype, proto, canonname, sockaddr in sorted(set(addresses)):
+        sock = socket.socket(family, socktype, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, reuse_port, 1)
+        if family == socket.AF_INET6:
+            sock.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+        sock.setblocking(0)
+        sock.bind(sockaddr)
+        sock.listen(128)
+        sockets.append(sock)
+    return sockets
+
+
+@gen.coroutine
+def shutdown(servers, db, capture=None):
+    """ Stop accepting connections, save data accepted
+        by DataBase (see db.WriteBehind) and stop IOLoop
+    :param servers: listening servers
+    :param db: db.AsyncDB instance
+    :param capture: capture.CaptureWriter
+    """
+    logging.info('Shutting down')
+    for server in servers:
+        server.stop()
+    yield db.drain()
+    # Writes, which are not on disk yet, are flushed
+    db.close()
+    if capture is not None:
+        capture.shutdown()
+    IOLoop.current().stop()
+
+
+def select_backend(backend='auto', data_dir=None):
+    """ Name of DataBase backend to use
+    :param backend: auto, redis, disk or memory. auto - disk if
+        data_dir is given, redis if redis-py and futures are
+        installed, memory otherwise
+    :param data_dir: directory of disk backend
+    """
+    if backend == 'auto':
+        if data_dir is not None:
+            backend = 'disk'
+        elif redis is None:
+            logging.warn('redis-py is not installed, all data will be lost on restart')
+            backend = 'memory'
+        elif ThreadPoolExecutor is None:
+            logging.warn('futures is not installed, all data will be lost on restart')
+            backend = 'memory'
+        else:
+            backend = 'redis'
+    if backend == 'disk' and data_dir is None:
+        raise ValueError('Disk backend requires data directory')
+    if backend == 'redis' and (redis is None or ThreadPoolExecutor is None):
+        raise RuntimeError('REDIS backend requires redis-py and futures packages')
+    return backend
+
+
+def wait_for_redis(url, retries=5, delay=1):
+    """ Check connection to REDIS, retrying while it is not available
+    :param url: REDIS url
+    :param retries: number of attempts, at least one is made
+    :param delay: seconds between attempts
+    :raise: RuntimeError if REDIS is not available after the last attempt
+    """
+    retries = max(retries, 1)
+    r = redis.Redis.from_url(url)
+    for attempt in range(1, retries + 1):
+        try:
+            r.ping()
+            return
+        except redis.exceptions.ConnectionError as e:
+            if attempt == retries:
+                raise RuntimeError('REDIS at %s is not available after %d attempts: %s' %
+                                   (url, retries, e))
+            logging.warn('Cant connect to REDIS at %s (%s), attempt %d of %d', url, e,
+                         attempt, retries)
+            time.sleep(delay)
+
+
+def migrate_redis(url):
+    """ Migrate data in REDIS to current version once, before
+        workers are started (see db.DBRedis.migrate)
+    :param url: REDIS url
+    """
+    from .db import DBRedis
+    start = time.time()
+    # DataBase migrates data on creation
+    DBRedis(redis.Redis.from_url(url, decode_responses=True))
+    logging.info('Data in REDIS checked in %.3f s', time.time() - start)
+
+
+def create_backends(backend, redis_url=None, redis_pool_size=10, data_dir=None,
+                    history_size=1000, history_ttl=None, write_behind=None, migrate=True):
+    """ Create DataBase and bus of process
+    :param backend: redis, disk or memory (see select_backend)
+    :param redis_url, redis_pool_size: REDIS url and number of
+        connections (see db.AsyncDBRedis)
+    :param data_dir: directory of disk backend
+    :param history_size, history_ttl: see db.DB
+    :param write_behind: db.WriteBehind for REDIS and disk
+    :param migrate: migrate data in REDIS, if False it must be migrated
+        already (see migrate_redis)
+    :return: (db.AsyncDB, bus.Bus)
+    """
+    if backend == 'redis':
+        from .bus import RedisBus
+        from .db import AsyncDBRedis
+        # Responses are decoded, names of rooms are unicode as in
+        # events of bus and commands of clients
+        pool = redis.BlockingConnectionPool.from_url(redis_url, max_connections=redis_pool_size,
+                                                     decode_responses=True)
+        db = AsyncDBRedis(redis_pool_size, redis.Redis(connection_pool=pool), history_size,
+                          history_ttl, write_behind=write_behind, migrate=migrate)
+        return db, RedisBus(redis.Redis.from_url(redis_url, decode_responses=True))
+    if backend == 'disk':
+        from .disk import AsyncDBDisk
+        db = AsyncDBDisk(data_dir, history_size=history_size, history_ttl=history_ttl,
+                         write_behind=write_behind)
+        return db, LocalBus()
+    return AsyncDBPython(history_size, history_ttl), LocalBus()
+
+
+def main(host, port, processes=1, reuse_port=False, tcp_port=None, lag_threshold=None,
+         capture=None, backend='auto', redis_url='redis://localhost:6379/0', redis_pool_size=10,
+         redis_retries=5, redis_retry_delay=1, data_dir=None, history_size=1000,
+         history_ttl=None, room_idle_ttl=300, max_rooms=1000, **connection_options):
+    """ Start server.
+    :param processes: number of worker processes, 0 - one per CPU.
+        Workers are forked by tornado.process.fork_processes, which
+        restarts crashed workers.
+    :param reuse_port: every worker binds own socket with SO_REUSEPORT
+        instead of sharing one socket bound before fork
+    :param tcp_port: port of line protocol (see tcp.py),
+        not started if not given
+    :param lag_threshold: report IOLoop stalls longer than lag_threshold
+        seconds (see watchdog.py), not watched if not given
+    :param capture: file to capture WebSocket traffic to (see capture.py),
+        every worker process appends ".N" (number of worker) to it
+    :param backend: DataBase: auto, redis, disk or memory
+        (see select_backend)
+    :param redis_url, redis_pool_size: see create_backends
+    :param redis_retries, redis_retry_delay: attempts to connect to
+        REDIS on start and seconds between them, server is not started
+        if REDIS is not available
+    :param data_dir: store data in files of this directory (see
+        disk.py), one process only
+    :param history_size, history_ttl: see db.DB
+    :param room_idle_ttl, max_rooms: state of rooms without subscribers
+        is dropped after room_idle_ttl seconds, or when there are more
+        than max_rooms rooms (see rooms.RoomManager)
+    :param connection_options: outbound queues, resume and compression
+        of connections, see app_settings
+    """
+    from .tcp import ChatTCPServer
+    enable_pretty_logging()
+    start = time.time()
+    backend = select_backend(backend, data_dir)
+    if processes != 1 and backend != 'redis':
+        logging.warn('Data of %s backend cant be shared between processes, starting one process',
+                     backend)
+        processes = 1
+    if backend == 'redis':
+        wait_for_redis(redis_url, redis_retries, redis_retry_delay)
+        # Migrations scan keys of REDIS and must not run in several
+        # workers at once, workers only check version of data
+        migrate_redis(redis_url)
+    ports = [port] if tcp_port is None else [port, tcp_port]
+    sockets = None
+    if processes != 1:
+        if not reuse_port:
+            # Bind once, workers inherit listening sockets
+            sockets = [bind_sockets(p, host) for p in ports]
+        tornado.process.fork_processes(processes)
+    if sockets is None:
+        bind = bind_reuse_port if reuse_port else bind_sockets
+        sockets = [bind(p, host) for p in ports]
+    # DataBase and bus are created in every worker after fork.
+    # Messages are saved in background, ids are reserved by blocks
+    # in one process only, so they follow order of messages
+    write_behind = WriteBehind(id_block=100 if processes == 1 else 1)
+    db, bus = create_backends(backend, redis_url, redis_pool_size, data_dir, history_size,
+                              history_ttl, write_behind, migrate=False)
+    ChatMixin.rooms = RoomManager(room_idle_ttl, max_rooms, history_ttl=history_ttl)
+    settings = app_settings(**connection_options)
+    if capture is not None:
+        task_id = tornado.process.task_id()
+        if task_id is not None:
+            capture = '%s.%d' % (capture, task_id)
+        settings['capture'] = CaptureWriter(capture)
+    app = make_app(db, bus, **settings)
+    servers = [HTTPServer(app)]
+    if tcp_port is not None:
+        servers.append(ChatTCPServer(db, bus, app.settings))
+    for server, _sockets in zip(servers, sockets):
+        server.add_sockets(_sockets)
+
+    def on_signal(signum, frame):
+        IOLoop.current().add_callback_from_signal(shutdown, servers, db, settings.get('capture'))
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    bus.start()
+    PeriodicCallback(ChatMixin.rooms.evict, 60 * 1000).start()
+    if lag_threshold is not None:
+        LagWatchdog(lag_threshold, handlers=(tornado.web.RequestHandler, ChatMixin)).start()
+    logging.info('Started in %.3f s with %s backend on %s:%d', time.time() - start, backend,
+                 host, port)
     IOLoop.current().start()
 
 
-def run(host='localhost', port=8080):
-    main(host, port)
+def run(host='localhost', port=8080, **options):
+    """ Start server, see main for options """
+    main(host, port, **options)
 
 if __name__ == '__main__':
-    run()
\ No newline at end of file
+    run()
@@ -0,0 +1,119 @@
+# coding: utf-8
+import collections
+
+from tornado import gen
+
+
+class Session(object):
+    """ Write-through cache of logged in user state for one connection:
+        current rooms of user and his nickname in each of them.
+        State is read from DataBase once on login, every change is
+        written to DataBase first and then to cache, so reads never
+        go to DataBase.
+        Every change is published to bus as membership event, so
+        sessions of other connections of the same user (in any server
+        process) apply it to their caches too (see Session.apply_event).
+    """
+    anonymous_nick = 'Anonymous'
+    # login -> sessions of logged in user in this process
+    by_login = collections.defaultdict(set)
+
+    def __init__(self, db, bus=None):
+        """ :param db: db.AsyncDB instance
+            :param bus: bus.Bus instance, membership events are
+              not published if not given
+        """
+        self.db = db
+        self.bus = bus
+        self.login = None
+        # room -> nickname, in order of joining
+        self._nicks = collections.OrderedDict()
+
+    @gen.coroutine
+    def login_as(self, login):
+        """ Load state of user from DataBase
+        :param login: user login
+        """
+        nicks = yield self.db.get_current_nicks(login)
+        self._unregister()
+        self.login = login
+        self._nicks = collections.OrderedDict(nicks)
+        self.by_login[login].add(self)
+
+    def logout(self):
+        self._unregister()
+        self.login = None
+        self._nicks.clear()
+
+    def close(self):
+        """ Must be called when connection is closed """
+        self._unregister()
+
+    def _unregister(self):
+        sessions = self.by_login.get(self.login)
+        if sessions is not None:
+            sessions.discard(self)
+            if not sessions:
+                del self.by_login[self.login]
+
+    def _publish(self, kind, room, nick):
+        if self.bus is not None:
+            self.bus.publish(kind, room, [self.login, nick])
+
+    @classmethod
+    def apply_event(cls, kind, room, login, nick):
+        """ Apply membership event of user to sessions of
+            his connections. Events are applied to caches only,
+            DataBase was changed by connection which published event.
+        :param kind: 'join', 'left' or 'nick'
+        :param room: room name
+        :param login: user login
+        :param nick: nickname of user in room
+        """
+        for session in cls.by_login.get(login, ()):
+            if kind == 'join':
+                session._nicks.setdefault(room, nick)
+            elif kind == 'left':
+                session._nicks.pop(room, None)
+            elif kind == 'nick' and room in session._nicks:
+                session._nicks[room] = nick
+
+    @property
+    def rooms(self):
+        """ List of current rooms of logged in user """
+        return list(self._nicks)
+
+    def get_nick(self, room):
+        """ Return nickname of user in room """
+        if self.login is None:
+            return self.anonymous_nick
+        return self._nicks.get(room)
+
+    @gen.coroutine
+    def add_room(self, room):
+        """ Add room to current rooms of user """
+        if self.login is None or room in self._nicks:
+            return
+        yield self.db.add_room_to_current(self.login, room)
+        # DataBase uses login as default nickname
+        self._nicks[room] = self.login
+        self._publish('join', room, self.login)
+
+    @gen.coroutine
+    def remove_room(self, room):
+        """ Remove room from current rooms of user """
+        if self.login is None:
+            return
+        yield self.db.remove_room_from_current(self.login, room)
+        nick = self._nicks.pop(room, None)
+        self._publish('left', room, nick)
+
+    @gen.coroutine
+    def change_nick(self, room, nick):
+        """ Change nickname of user in room """
+        if self.login is None:
+            return
+        yield self.db.change_nick_in_room(self.login, room, nick)
+        if room in self._nicks:
+            self._nicks[room] = nick
+        self._publish('nick', room, nick)
@@ -0,0 +1,75 @@
+# coding: utf-8
+""" Static files of chat page.
+
+    Usage: python -m wschat.static [static_path]
+      writes gzip compressed copies ("client.js.gz") of static files,
+      they are sent by PrecompressedStaticFileHandler instead of
+      originals to clients accepting gzip.
+"""
+import gzip
+import os
+import sys
+
+import tornado.web
+
+
+STATIC_PATH = os.path.join(os.path.dirname(__file__), 'static')
+
+
+class PrecompressedStaticFileHandler(tornado.web.StaticFileHandler):
+    """ Static files with versioned URLs (see static_url) cached by
+        clients forever. If file has gzip compressed copy with ".gz"
+        suffix not older than file, the copy is sent to clients
+        accepting gzip, so files are not compressed per request.
+    """
+    # One year, the longest time allowed by RFC 2616
+    CACHE_MAX_AGE = 86400 * 365
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = super(PrecompressedStaticFileHandler, self).validate_absolute_path(
+            root, absolute_path)
+        if absolute_path is None:
+            return None
+        compressed = absolute_path + '.gz'
+        try:
+            fresh = os.path.getmtime(compressed) >= os.path.getmtime(absolute_path)
+        except OSError:
+            # No compressed copy
+            return absolute_path
+        self.set_header('Vary', 'Accept-Encoding')
+        if fresh and 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            # Etag is hash of compressed copy, type is guessed from
+            # its name without ".gz"
+            self.set_header('Content-Encoding', 'gzip')
+            return compressed
+        return absolute_path
+
+    def set_extra_headers(self, path):
+        if 'v' in self.request.arguments:
+            # URL changes with content, file is never revalidated
+            self.set_header('Cache-Control', 'public, max-age=%d, immutable' % self.CACHE_MAX_AGE)
+
+
+def compress_static(static_path=STATIC_PATH, min_size=256):
+    """ Write gzip compressed copies of static files
+    :param static_path: directory of static files
+    :param min_size: smaller files are not compressed
+    :return: list of written files
+    """
+    written = []
+    for dir_path, dir_names, file_names in os.walk(static_path):
+        for name in file_names:
+            path = os.path.join(dir_path, name)
+            if name.endswith('.gz') or os.path.getsize(path) < min_size:
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            with gzip.GzipFile(path + '.gz', 'wb', 9, mtime=0) as f:
+                f.write(data)
+            written.append(path + '.gz')
+    return written
+
+
+if __name__ == '__main__':
+    for path in compress_static(*sys.argv[1:2]):
+        print(path)
@@ -6,27 +6,56 @@ function check_ws(){
     }
 }
 
-var ws = new WebSocket(socket_path);
+var ws = null;
 elem_to_write = document.getElementById('chat');
+// Id of last received message in each room, sent to server
+// on reconnect to receive only missed messages
+var last_seen = {};
+var reconnect_delay = 3000;
 
-ws.onmessage = function(evnt){
+function connect(){
+    var path = socket_path;
+    if (Object.keys(last_seen).length){
+        path += '?last_seen=' + encodeURIComponent(JSON.stringify(last_seen));
+    }
+    ws = new WebSocket(path);
+    ws.onmessage = on_message;
+    ws.onclose = on_close;
+}
+
+function on_message(evnt){
     console.log(evnt.data)
     var mess = evnt.data;
     var num = mess.indexOf(':');
     var command = mess.substr(0, num);
     mess = mess.substr(num+1);
     if (command=='MESSAGE'){
+        // "id:[room] nickname: text"
+        num = mess.indexOf(':');
+        var id = parseInt(mess.substr(0, num));
+        mess = mess.substr(num+1);
+        last_seen[mess.substring(1, mess.indexOf('] '))] = id;
         write_message(mess);
+    }else if (command=='HISTORY'){
+        var history = JSON.parse(mess);
+        if (history.messages.length){
+            last_seen[history.room] = history.messages[history.messages.length-1][0];
+        }
+        write_history(history);
+    }else if (command=='GAP'){
+        write_server_message('Too many messages were missed in room "' +
+                             JSON.parse(mess).room + '", showing the last ones');
     }else if (command=='SERVER'){
         write_server_message(mess);
     }
-};
+}
 
-ws.onclose = function(){
+function on_close(){
     var source = elem_to_write.innerHTML;
     source  = source + '<br><p>&nbsp;</p><error>You was disconnected.' +
-    '<br>Refresh page to create new connection.</error>';
+    '<br>Reconnecting...</error>';
     elem_to_write.innerHTML = source;
+    setTimeout(connect, reconnect_delay);
 }
 
 function write_message(mess){
@@ -34,6 +63,15 @@ function write_message(mess){
     elem_to_write.innerHTML = source + '<p>'+mess+'</p>';
 }
 
+function write_history(history){
+    // All messages of history are added to page at once
+    var source = '';
+    for (var i = 0; i < history.messages.length; i++){
+        source += '<p>[' + history.room + '] ' + history.messages[i][1] + '</p>';
+    }
+    elem_to_write.innerHTML = elem_to_write.innerHTML + source;
+}
+
 function write_server_message(mess){
     var source = elem_to_write.innerHTML;
     elem_to_write.innerHTML = source + '<server>'+mess+'</server>';
@@ -53,5 +91,6 @@ function sender_enter_key(event){
 }
 
 
+connect();
 document.getElementById('sender_button').onclick = sender_click;
 document.getElementById('sendmessage').onkeyup = sender_enter_key;
@@ -0,0 +1,94 @@
+# coding: utf-8
+import logging
+
+from tornado import gen
+from tornado.iostream import StreamClosedError, UnsatisfiableReadError
+from tornado.tcpserver import TCPServer
+
+from .broadcast import OutboundQueue
+from .server import ChatMixin
+
+
+class LineConnection(ChatMixin):
+    """ Chat connection over raw TCP.
+        Protocol is the same as WebSocket one, but every message
+        of client and server is one utf-8 line ended with '\n'.
+        Connection is not logged in on start (there are no cookies)
+        and is connected to default room.
+    """
+    max_line_size = 64 * 1024
+
+    def __init__(self, stream, address, db, bus, settings):
+        """ :param stream: tornado.iostream.IOStream of connection
+            :param address: address of client
+            :param db: db.AsyncDB instance
+            :param bus: bus.Bus instance
+            :param settings: application settings (outbound queue)
+        """
+        super(LineConnection, self).__init__()
+        self.setup_connection(db, bus)
+        self.stream = stream
+        self.address = address
+        self.outbound = OutboundQueue(
+            stream,
+            maxsize=settings.get('outbound_queue_size', 256),
+            policy=settings.get('outbound_policy', 'drop_oldest'),
+            on_overflow=self.on_slow_consumer
+        )
+
+    @gen.coroutine
+    def serve(self):
+        """ Read and handle lines until connection is closed """
+        self.connections.add(self)
+        self.stream.set_close_callback(self.unsubscribe)
+        try:
+            with (yield self._lock.acquire()):
+                yield self.connect_to_room(self.db.default_room)
+            while True:
+                line = yield self.stream.read_until(b'\n', max_bytes=self.max_line_size)
+                try:
+                    mess = line.decode('utf-8').rstrip(u'\r\n')
+                except UnicodeDecodeError:
+                    self.send_server_message('Wrong encoding, utf-8 expected')
+                    continue
+                if mess:
+                    yield self.handle_message(mess)
+        except UnsatisfiableReadError:
+            # Stream is closed by tornado
+            logging.warning('Line of %s is longer than %d bytes, connection closed',
+                            self.address[0], self.max_line_size)
+        except StreamClosedError:
+            pass
+
+    def write_prepared(self, mess):
+        """ Put line of message (see broadcast.PreparedMessage)
+            to outbound queue.
+        :param mess: PreparedMessage instance
+        """
+        if self.stream.closed():
+            raise StreamClosedError()
+        self.outbound.put(mess.line)
+
+    def on_slow_consumer(self):
+        """ Called when outbound queue overflows with 'disconnect' policy """
+        logging.warning('Slow consumer %s (user: %s) disconnected, %d messages dropped',
+                        self.address[0], self.current_user, self.outbound.dropped)
+        self.stream.close()
+
+
+class ChatTCPServer(TCPServer):
+    """ Server of line protocol, shares rooms with WebSocket
+        connections of the same process.
+    """
+    def __init__(self, db, bus, settings=None, **kwargs):
+        """ :param db: db.AsyncDB instance
+            :param bus: bus.Bus instance, shared with application
+            :param settings: application settings
+        """
+        super(ChatTCPServer, self).__init__(**kwargs)
+        self.db = db
+        self.bus = bus
+        self.settings = settings or dict()
+
+    def handle_stream(self, stream, address):
+        return LineConnection(stream, address, self.db, self.bus, self.settings).serve()
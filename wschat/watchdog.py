@@ -0,0 +1,118 @@
+# coding: utf-8
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+
+import tornado.web
+
+from tornado.ioloop import IOLoop
+
+from .metrics import Counter, Histogram
+
+
+LOOP_LAG = Histogram(
+    'wschat_ioloop_lag_seconds', 'Delay of IOLoop timer callbacks'
+)
+LOOP_STALLS = Counter(
+    'wschat_ioloop_stalls_total', 'IOLoop blocked longer than threshold',
+    ['handler', 'method', 'command']
+)
+
+
+class LagWatchdog(object):
+    """ Measures how late IOLoop runs timer callbacks.
+        IOLoop callback beats every interval seconds. Sampling thread
+        checks the beats, and if IOLoop hasn't beat for threshold
+        seconds, takes stack of IOLoop thread, which is running blocking
+        code right now. When IOLoop beats again, stall is reported as
+        one json log record and in metrics, attributed to the handler
+        (its method) and the command found in the stack.
+    """
+    command_prefix = 'user_command_'
+
+    def __init__(self, threshold=0.1, interval=0.05, handlers=(tornado.web.RequestHandler,)):
+        """ :param threshold: lag in seconds to report stall
+            :param interval: seconds between beats
+            :param handlers: classes of handlers to attribute stall to
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.handlers = tuple(handlers)
+        self.io_loop = None
+        self._loop_thread = None
+        # Time of next beat
+        self._expected = None
+        # Stack captured by sampling thread: (expected time, frames)
+        self._stall = None
+        self._stopped = False
+
+    def start(self):
+        """ Start watching IOLoop of current thread """
+        self.io_loop = IOLoop.current()
+        self._loop_thread = threading.current_thread().ident
+        self._expected = time.time() + self.interval
+        self.io_loop.call_later(self.interval, self._beat)
+        thread = threading.Thread(target=self._sample, name='LagWatchdog')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._stopped = True
+
+    def _beat(self):
+        if self._stopped:
+            return
+        now = time.time()
+        lag = max(now - self._expected, 0)
+        LOOP_LAG.observe(lag)
+        stall, self._stall = self._stall, None
+        if stall is not None and stall[0] == self._expected:
+            self.report(lag, stall[1])
+        self._expected = now + self.interval
+        self.io_loop.call_later(self.interval, self._beat)
+
+    def _sample(self):
+        while not self._stopped:
+            time.sleep(self.interval / 2.0)
+            expected = self._expected
+            if time.time() - expected < self.threshold:
+                continue
+            if self._stall is not None and self._stall[0] == expected:
+                # Stack of this stall is already taken
+                continue
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is not None:
+                self._stall = (expected, self.describe(frame))
+
+    def describe(self, frame):
+        """ Stack and attribution of code running in frame
+        :return: dict of handler, method, command and stack
+        """
+        handler = method = command = None
+        f = frame
+        while f is not None:
+            code = f.f_code
+            if command is None and code.co_name.startswith(self.command_prefix):
+                command = code.co_name[len(self.command_prefix):]
+            elif command is None and code.co_name == 'recognize_command':
+                command = f.f_locals.get('command')
+            if handler is None and isinstance(f.f_locals.get('self'), self.handlers):
+                handler = type(f.f_locals['self']).__name__
+                method = code.co_name
+            f = f.f_back
+        stack = ['%s:%d %s' % (filename, line, name)
+                 for filename, line, name, text in traceback.extract_stack(frame)]
+        return dict(handler=handler, method=method, command=command, stack=stack)
+
+    def report(self, lag, stall):
+        """ Write stall to log and metrics
+        :param lag: seconds IOLoop was blocked
+        :param stall: result of describe
+        """
+        LOOP_STALLS.labels(str(stall['handler']), str(stall['method']),
+                           str(stall['command'])).inc()
+        record = dict(event='ioloop_stall', lag=round(lag, 4), **stall)
+        logging.warning('IOLoop was blocked for %.3f s: %s', lag, json.dumps(record))